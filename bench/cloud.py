@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Benchmark the server side Concept Cloud layout.
+
+Usage: python bench/cloud.py [concept counts...]
+
+Concepts are generated with bench/markers.py's synthetic markers files (50 to 1,000 concepts by default) and
+parsed with utils.get_concepts, then given word-like names of 3 to 12 letters and weights falling off with rank the
+way Leximancer's do (the markers files' are uniform, which no real text gives). Each count is laid out with NumPy,
+if it is installed, and with the pure Python board; both are checked to place the same words in the same spots and
+no two placed words are allowed to overlap. Reports the words placed and the time each board takes.
+"""
+import gc
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from django.conf import settings
+if not settings.configured:
+    settings.configure()
+
+from tib import cloud
+from tib import utils
+import markers as markers_bench
+
+LETTERS = 'etaoinshrdlcumwfgypbvk'
+
+def make_concepts(count, seed=42):
+    rand = random.Random(seed)
+    concepts = utils.get_concepts(markers_bench.make_markers(count))[0]
+    ranks = range(1, len(concepts) + 1)
+    rand.shuffle(ranks)
+    for concept, rank in zip(concepts.values(), ranks):
+        concept['value'] = ''.join(rand.choice(LETTERS) for i in xrange(rand.randint(3, 12)))
+        concept['weight'] = 100.0 * rank ** -0.9
+    return concepts
+
+def check_overlaps(concepts, result, conf):
+    """
+    Check no two placed words' sprites share a board cell.
+    """
+    taken = set()
+    words = result['words']
+    for i, id in enumerate(words['id']):
+        x, y = (words['x'][i] + result['width'] // 2) // cloud.GRID, (words['y'][i] + result['height'] // 2) // cloud.GRID
+        mine = set()
+        for left, right, top, bottom in cloud.word_sprite(concepts[id]['value'], words['size'][i],
+                                                          words['rotate'][i], conf):
+            # Boxes of the same word can share cells, boxes of different words can't
+            mine.update((row, column) for row in xrange(y + top, y + bottom) for column in xrange(x + left, x + right))
+        assert not (mine & taken), 'Word {0} overlaps another'.format(id)
+        taken |= mine
+
+def timed(concepts, conf):
+    gc.collect()
+    start = time.time()
+    result = cloud.layout(concepts, conf, 'bench')
+    return result, time.time() - start
+
+def main(counts):
+    conf = cloud.get_config()
+    numpy = cloud.numpy
+    if numpy is None:
+        print 'NumPy is not installed, only the pure Python board is measured'
+
+    print '{0:>8} {1:>8} {2:>12} {3:>12}'.format('concepts', 'placed', 'numpy (ms)', 'python (ms)')
+    for count in counts:
+        concepts = make_concepts(count)
+        cloud.numpy = None
+        expected, python_time = timed(concepts, conf)
+        cloud.numpy = numpy
+        check_overlaps(concepts, expected, conf)
+        numpy_time = None
+        if numpy is not None:
+            result, numpy_time = timed(concepts, conf)
+            assert result == expected, 'The NumPy and pure Python boards placed words differently'
+        print '{0:>8} {1:>8} {2:>12} {3:>12.1f}'.format(count, len(expected['words']['id']),
+                                                        '-' if numpy_time is None else '{0:.1f}'.format(numpy_time * 1000),
+                                                        python_time * 1000)
+
+if __name__ == '__main__':
+    main([int(c) for c in sys.argv[1:]] or [50, 100, 250, 500, 1000])
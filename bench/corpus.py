@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Benchmark sampling large uploaded documents.
+
+Usage: python bench/corpus.py [size in MB ...]
+
+Synthetic books of a few sizes (1, 5, 20 and 50 MB by default) are written to temporary files and sampled the
+way an upload is, reading the file a chunk at a time. For each the time taken, the blocks and characters kept,
+the docset files written and the process's peak resident memory are reported. The peak should stay flat as the
+books grow. The script also checks the sample stays within MAX_CHARS, reaches the end of the book and that its
+result key matches the text written out.
+"""
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from django.conf import settings
+if not settings.configured:
+    settings.configure(TEXT_PATH=tempfile.mkdtemp(prefix='corpus'), PROJECT_CONF_XML='<project-configuration/>',
+                       PROJECT_THEME_SIZE=42)
+
+from django.core.files.uploadedfile import UploadedFile
+from tib import cache
+from tib import corpus
+
+WORDS = ('the', 'of', 'and', 'in', 'queen', 'rabbit', 'garden', 'tea', 'party', 'caterpillar', 'mushroom', 'court',
+         'trial', 'tarts', 'croquet', 'flamingo', 'hedgehog', 'duchess', 'cook', 'pepper', 'baby', 'pig', 'cheshire',
+         'cat', 'grin', 'hatter', 'hare', 'dormouse', 'treacle', 'well', 'turtle', 'gryphon', 'lobster', 'quadrille')
+
+def write_book(path, size, seed=1):
+    """
+    Write a book of roughly size bytes: chapters of paragraphs, with a chapter number in every paragraph so the
+    sample's spread can be seen.
+    """
+    rand = random.Random(seed)
+    written = 0
+    chapter = 0
+    with open(path, 'wb') as f:
+        while written < size:
+            chapter += 1
+            paras = ['CHAPTER {0}'.format(chapter)]
+            for i in xrange(rand.randint(20, 60)):
+                words = [rand.choice(WORDS) for j in xrange(rand.randint(40, 200))]
+                paras.append('Chapter {0}: {1}.'.format(chapter, ' '.join(words).capitalize()))
+            text = '\r\n\r\n'.join(paras) + '\r\n\r\n'
+            f.write(text)
+            written += len(text)
+    return chapter
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def main(args):
+    sizes = [float(a) for a in args] or [1, 5, 20, 50]
+    conf = corpus.get_config()
+    conf['MAX_UPLOAD_BYTES'] = int(max(sizes) * 2 * 1024 * 1024)
+    work = tempfile.mkdtemp(prefix='books')
+    try:
+        print 'Peak memory before sampling: {0:.1f} MB'.format(peak_rss())
+        print '{0:>8} {1:>10} {2:>14} {3:>10} {4:>6} {5:>10} {6:>14}'.format(
+            'MB', 'time (s)', 'blocks kept', 'chars kept', 'files', 'chapters', 'peak RSS (MB)')
+        for size in sizes:
+            path = os.path.join(work, 'book.txt')
+            chapters = write_book(path, int(size * 1024 * 1024))
+            with open(path, 'rb') as f:
+                upload = UploadedFile(f, 'book.txt', 'text/plain', os.path.getsize(path))
+                start = time.time()
+                sample = corpus.sample_upload(upload, conf)
+                elapsed = time.time() - start
+
+            text = '\n\n'.join(open(p, 'rb').read() for p in sample.parts)
+            assert sample.kept_chars <= conf['MAX_CHARS'], 'The sample is over MAX_CHARS'
+            assert cache.result_key(text) == sample.key, 'The key does not match the text written'
+            last = text.rsplit('Chapter ', 1)[1].split(':')[0]
+            assert int(last) > chapters * 0.95, 'The sample stops at chapter {0} of {1}'.format(last, chapters)
+            print '{0:>8} {1:>10.2f} {2:>14} {3:>10} {4:>6} {5:>10} {6:>14.1f}'.format(
+                size, elapsed, '{0}/{1}'.format(sample.kept_blocks, sample.blocks), sample.kept_chars,
+                len(sample.parts), '{0}/{1}'.format(last, chapters), peak_rss())
+            print '         ' + sample.describe()
+            sample.discard()
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+        shutil.rmtree(settings.TEXT_PATH, ignore_errors=True)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
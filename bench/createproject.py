@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+Benchmark creating Leximancer projects against a stand-in for Leximancer that answers every request after a delay.
+
+Usage: python bench/createproject.py [latency in ms] [workers]
+
+utils.create_lex_project is run with its REST client swapped for a stand-in that keeps a fake server's folders,
+projects and docsets in memory and sleeps for the latency (50 ms by default) on every request it answers. Projects
+are created from a file in the data folder, from uploaded text and from three files, with cold folder caches (the
+first project a worker creates) and warm ones, one call after another (LEX_CREATE_WORKERS of 1) and with workers
+at once (4 by default). Reports the requests each creation made, its time and the time of each of its steps.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from django.conf import settings
+if not settings.configured:
+    settings.configure(LEX_URL='http://lex.invalid/lex3/c/start/app', LEX_AUTH=('bench', 'bench'),
+                       TOP_PROJECT_FOLDER='User Projects', TOP_DATA_FOLDER='Server Data0', DATA_FOLDER='tibText',
+                       PROJECT_CONF_XML='<project-configuration/>', LEX_FOLDER_CACHE_TTL=300)
+
+from tib import utils
+
+class StandIn(object):
+    """
+    The parts of lexrestclient create_lex_project uses, answering from memory after latency seconds.
+    """
+    def __init__(self, latency):
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.Instance = Instance
+        self.LexObject = self
+        self.rest = self
+        self.project = self
+        self.ProjectStatus = self
+
+    def request(self):
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.latency)
+
+    def from_url(self, url, auth=None):
+        self.request()
+        if url == settings.LEX_URL:
+            return Instance()
+        if url.endswith('/status'):
+            return Status(url, self)
+        if url in FOLDERS:
+            return FOLDERS[url]
+        return Resource(url)
+
+    def rest_invoke(self, url, method='GET', auth=None, headers=None, body=None):
+        self.request()
+        return Resource(url, status=200), ''
+
+class Resource(object):
+    def __init__(self, href, name=None, status=None, **links):
+        self.href = href
+        self.name = name
+        self.status = status
+        self.__dict__.update(links)
+
+PROJECTS = 'http://lex.invalid/lex3/c/projects/'
+DATA = 'http://lex.invalid/lex3/c/data/'
+
+class Instance(Resource):
+    def __init__(self):
+        Resource.__init__(self, settings.LEX_URL, project_folder=[Resource(PROJECTS + 'samples'), Resource(PROJECTS + 'user')],
+                          data_folder=[Resource(DATA + 'samples'), Resource(DATA + 'server')])
+
+class Folder(Resource):
+    def create_project(self, name, auth=None):
+        LEX.request()
+        href = '{0}/{1}/'.format(self.href, name)
+        return Resource(href, name, docset=[Docset(href + 'docset')], project_status=[Status(href + 'status', LEX)])
+
+class Docset(Resource):
+    def create_file(self, doc, df, auth=None, mimetype=None):
+        LEX.request()
+
+class Status(Resource):
+    def __init__(self, href, lex):
+        Resource.__init__(self, href, stage={'name': 'PREPROCESS', 'state': 'next'})
+        self.message = None
+        self.lex = lex
+
+    def set_updatable_attrs(self, stage, state):
+        pass
+
+    def syncronize(self, auth=None):
+        self.lex.request()
+
+FOLDERS = {
+    PROJECTS + 'samples': Folder(PROJECTS + 'samples', 'Samples', project_folder=[]),
+    PROJECTS + 'user': Folder(PROJECTS + 'user', 'User Projects', project_folder=[Resource(PROJECTS + 'user/bench')]),
+    PROJECTS + 'user/bench': Folder(PROJECTS + 'user/bench', 'bench'),
+    DATA + 'samples': Folder(DATA + 'samples', 'Samples', data_folder=[]),
+    DATA + 'server': Folder(DATA + 'server', 'Server Data0', data_folder=[Folder(DATA + 'server/tib', 'tibText')]),
+}
+LEX = None
+
+class Steps(logging.Handler):
+    """
+    Keeps the step timings create_lex_project logs.
+    """
+    def emit(self, record):
+        self.last = record.getMessage().split(': ', 1)[1]
+
+def main(latency, workers):
+    global LEX
+    LEX = utils.lex = StandIn(latency)
+    steps = Steps()
+    logger = logging.getLogger('tib')
+    logger.addHandler(steps)
+    logger.setLevel(logging.INFO)
+    server = utils.get_servers()[0]
+
+    cases = [
+        ('file', 'doc.txt', None),
+        ('upload', 'doc.txt', 'Some text.'),
+        ('3 files', ['doc.part1', 'doc.part2', 'doc.part3'], None),
+    ]
+    print '{0:>8} {1:>6} {2:>8} {3:>9} {4:>10}  {5}'.format('docs', 'caches', 'workers', 'requests', 'time (ms)', 'steps')
+    for label, doc, text in cases:
+        for caches in ('cold', 'warm'):
+            for count in (1, workers):
+                settings.LEX_CREATE_WORKERS = count
+                if caches == 'cold':
+                    server.project_folder_cache.invalidate()
+                    server.data_folder_cache.invalidate()
+                LEX.requests = 0
+                start = time.time()
+                utils.create_lex_project('bench', doc, server=server, text=text)
+                elapsed = time.time() - start
+                print '{0:>8} {1:>6} {2:>8} {3:>9} {4:>10.0f}  {5}'.format(label, caches, count, LEX.requests,
+                                                                           elapsed * 1000, steps.last)
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.05, int(sys.argv[2]) if len(sys.argv) > 2 else 4)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Benchmark working out the wheels' graphs on the server.
+
+Usage: python bench/graph.py [concept counts...]
+
+Markers are generated with bench/markers.py's synthetic markers files (50 to 1,000 concepts by default) and
+parsed with utils.get_concepts. For each count the graphs are built with NumPy, if it is installed, and in pure
+Python, checked to be the same, and timed. Also reports how many bytes the graphs add to the compact status
+response, raw and gzipped.
+"""
+import gc
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from django.conf import settings
+if not settings.configured:
+    settings.configure()
+
+from django.utils.text import compress_string
+from tib import graph
+from tib import payload
+from tib import serialize
+from tib import utils
+import markers as markers_bench
+
+def best_of(fn, arg, repeat=5):
+    best = None
+    for i in xrange(repeat):
+        gc.collect()
+        start = time.time()
+        fn(arg)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def response(markers):
+    return serialize.dumps({"message": 'Here come the visualisations...', 'completed': True, 'progress': 100,
+                            'markers': payload.compact_markers(markers)}, True)
+
+def main(counts):
+    numpy = graph.numpy
+    if numpy is None:
+        print 'NumPy is not installed, only pure Python is measured'
+
+    print '{0:>8} {1:>12} {2:>12} {3:>12} {4:>12}'.format('concepts', 'numpy (ms)', 'python (ms)', '+bytes', '+gzipped')
+    for count in counts:
+        concepts, themes, iprom, num_blocks = utils.get_concepts(markers_bench.make_markers(count))
+        markers = {'concepts': concepts, 'themes': themes, 'iprom': iprom, 'numBlocks': num_blocks}
+
+        graph.numpy = None
+        expected = graph.build(markers)
+        python_time = best_of(graph.build, markers)
+        graph.numpy = numpy
+        numpy_time = None
+        if numpy is not None:
+            assert graph.build(markers) == expected, 'NumPy and pure Python built different graphs'
+            numpy_time = best_of(graph.build, markers)
+
+        before = response(markers)
+        markers['graph'] = expected
+        after = response(markers)
+        print '{0:>8} {1:>12} {2:>12.1f} {3:>12} {4:>12}'.format(
+            count, '-' if numpy_time is None else '{0:.1f}'.format(numpy_time * 1000), python_time * 1000,
+            len(after) - len(before), len(compress_string(after)) - len(compress_string(before)))
+
+if __name__ == '__main__':
+    main([int(c) for c in sys.argv[1:]] or [50, 100, 250, 500, 1000])
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Benchmark tib.html2text on large Wikipedia style pages and check its output hasn't changed.
+
+Usage: python bench/html2text.py [--record] [page.html ...]
+
+With no files, synthetic pages shaped like Wikipedia articles (navigation, infobox, sections, lists,
+references) are generated at a few sizes. Each page is converted with the plain text extraction the site
+uses, with the Markdown conversion unwrapped and at 78 columns, as the command line does. The MD5 of every
+output is compared against bench/html2text.golden (pass --record to rewrite it), so an optimisation that
+changes the text is caught.
+"""
+import gc
+import hashlib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tib import html2text
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'html2text.golden')
+
+WORDS = ('the', 'of', 'and', 'in', 'queen', 'rabbit', 'garden', 'tea', 'party', 'caterpillar', 'mushroom', 'court',
+         'trial', 'tarts', 'croquet', 'flamingo', 'hedgehog', 'duchess', 'cook', 'pepper', 'baby', 'pig', 'cheshire',
+         'cat', 'grin', 'hatter', 'hare', 'dormouse', 'treacle', 'well', 'turtle', 'gryphon', 'lobster', 'quadrille',
+         'published', '1865', 'novel', 'author', 'victorian', 'literature', 'nonsense', 'logic', 'mathematics')
+
+def sentence(rand):
+    words = [rand.choice(WORDS) for i in xrange(rand.randint(6, 24))]
+    for i in xrange(len(words)):
+        roll = rand.random()
+        if roll < 0.08:
+            words[i] = '<a href="/wiki/{0}" title="{0}">{0}</a>'.format(words[i].capitalize())
+        elif roll < 0.10:
+            words[i] = '<b>{0}</b>'.format(words[i])
+        elif roll < 0.12:
+            words[i] = '<i>{0}</i>'.format(words[i])
+        elif roll < 0.13:
+            words[i] = words[i] + '&#160;&ndash;'
+        elif roll < 0.14:
+            words[i] = words[i] + '<sup id="cite_ref-{0}" class="reference"><a href="#cite_note-{0}">[{0}]</a></sup>'.format(rand.randint(1, 99))
+    return ' '.join(words).capitalize() + '.'
+
+def make_page(size, seed=1):
+    """
+    Build a Wikipedia style article of roughly size bytes.
+    """
+    rand = random.Random(seed)
+    parts = ['<!DOCTYPE html><html lang="en"><head><title>Alice - Wikipedia</title>',
+             '<style>.mw-body { margin: 0 } .infobox { float: right }</style>',
+             '<script>var wgPageName = "Alice"; if (a < b && c > d) { go(); }</script></head><body>',
+             '<div id="mw-navigation"><ul><li><a href="/wiki/Main_Page">Main page</a></li>'
+             '<li><a href="/wiki/Portal:Contents">Contents</a></li></ul></div>',
+             '<div id="content" class="mw-body"><h1 id="firstHeading">Alice</h1><div id="mw-content-text">',
+             '<table class="infobox"><tr><th>Author</th><td>Lewis Carroll</td></tr>'
+             '<tr><th>Published</th><td>26 November 1865</td></tr></table>']
+    length = sum(len(p) for p in parts)
+    section = 0
+    while length < size:
+        chunk = []
+        roll = rand.random()
+        if roll < 0.1:
+            section += 1
+            chunk.append('<h2><span class="mw-headline" id="s{0}">Section {0}</span></h2>'.format(section))
+        elif roll < 0.2:
+            chunk.append('<ul>')
+            for i in xrange(rand.randint(2, 8)):
+                chunk.append('<li>{0}</li>'.format(sentence(rand)))
+            chunk.append('</ul>')
+        elif roll < 0.25:
+            chunk.append('<blockquote><p>{0}</p></blockquote>'.format(sentence(rand)))
+        else:
+            chunk.append('<p>{0}</p>\n'.format(' '.join(sentence(rand) for i in xrange(rand.randint(2, 10)))))
+        text = ''.join(chunk)
+        parts.append(text)
+        length += len(text)
+    parts.append('<h2>References</h2><ol class="references">')
+    for i in xrange(1, 100):
+        parts.append('<li id="cite_note-{0}"><a href="#cite_ref-{0}">^</a> <cite>Carroll, Lewis ({0}). &quot;Notes&quot;.</cite></li>'.format(i))
+    parts.append('</ol></div></div><div id="footer"><p>Text is available under the Creative Commons licence.</p></div>'
+                 '</body></html>')
+    return ''.join(parts).decode('utf-8')
+
+def convert(html, mode):
+    if mode == 'plain':
+        return html2text.html2plain(html)
+    html2text.BODY_WIDTH = mode
+    return html2text.html2text(html)
+
+def best_of(fn, repeat):
+    best = None
+    for i in xrange(repeat):
+        gc.collect()
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def load_golden():
+    golden = {}
+    if os.path.exists(GOLDEN):
+        for line in open(GOLDEN):
+            name, digest = line.split()
+            golden[name] = digest
+    return golden
+
+def main(args):
+    record = '--record' in args
+    files = [a for a in args if a != '--record']
+    if files:
+        pages = [(os.path.basename(f), open(f, 'rb').read().decode('utf-8', 'ignore')) for f in files]
+    else:
+        pages = [('synthetic-{0}k'.format(size / 1000), make_page(size)) for size in (100000, 500000, 2000000)]
+
+    golden = load_golden()
+    failed = False
+    print '{0:>20} {1:>10} {2:>6} {3:>10} {4:>10} {5}'.format('page', 'html bytes', 'mode', 'time (ms)', 'text chars', 'output')
+    for name, html in pages:
+        for mode in (0, 78, 'plain'):
+            key = '{0}@{1}'.format(name, mode)
+            text = convert(html, mode)
+            digest = hashlib.md5(text.encode('utf-8')).hexdigest()
+            if record:
+                golden[key] = digest
+                check = 'recorded'
+            elif key not in golden:
+                check = 'no golden'
+            elif golden[key] == digest:
+                check = 'ok'
+            else:
+                check = 'CHANGED'
+                failed = True
+            elapsed = best_of(lambda: convert(html, mode), 3)
+            print '{0:>20} {1:>10} {2:>6} {3:>10.1f} {4:>10} {5}'.format(name, len(html), mode, elapsed * 1000, len(text), check)
+
+    if record:
+        out = open(GOLDEN, 'w')
+        for key in sorted(golden):
+            out.write('{0} {1}\n'.format(key, golden[key]))
+        out.close()
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+Benchmark utils.get_concepts against the old tree based markers parser.
+
+Usage: python bench/markers.py [concept counts...]
+
+Synthetic markers files are generated for each concept count (100 to 10,000 by default). Both parsers are
+checked to give identical JSON before they are timed. Peak memory is measured by running each parser in a
+fresh interpreter.
+"""
+import gc
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from django.conf import settings
+if not settings.configured:
+    settings.configure()
+
+from lxml import etree
+from tib import utils
+
+def get_concepts_tree(markers_xml):
+    """
+    The markers parser as it was before it streamed, kept for comparison.
+    """
+    num_blocks = None
+    entities = {}
+    themes = {}
+    prominence = []
+    markers = etree.fromstring(markers_xml)
+
+    for marker in markers:
+        if marker.tag == 'markers':
+            num_blocks = marker.attrib['cbcount']
+            for entity in marker:
+                e = {
+                    'id': int(entity.attrib['id']),
+                    'weight': float(entity.attrib['ctv']),
+                    'frequency': int(entity.attrib['freq']),
+                    'mstEdges': [],
+                    'value': entity.attrib['value'],
+                    'kind': entity.attrib['kind'],
+                    'x': float(entity.attrib['x']),
+                    'y': float(entity.attrib['y'])
+                }
+                if 'tid' in entity.attrib.keys():
+                    e['themeId'] = entity.attrib['tid']
+                entities[int(entity.attrib['id'])] = e
+                for rels in entity:
+                    related = []
+                    for rel in rels:
+                        related.append({
+                            'id': rel.attrib['id'],
+                            'strength': rel.attrib['str'],
+                            'count': rel.attrib['ct'],
+                            'prom': rel.attrib['pr']
+                        })
+                    entities[int(entity.attrib['id'])]['related'] = related
+        if marker.tag == 'themes':
+            for theme in marker:
+                themes[int(theme.attrib['index'])] = {'id': int(theme.attrib['index']), 'name': theme.attrib['name'], 'hue': theme.attrib['hue'], "connectivity": theme.attrib['connectiv']}
+        if marker.tag == 'mst':
+            for node in marker:
+                for edge in node[0]:
+                    entities[int(node.attrib['id'])]['mstEdges'].append({'to': int(edge.attrib['id'])})
+        if marker.tag == 'prominence':
+            for node in marker[0]:
+                if node.tag == 'edge':
+                    prominence.append({'from': int(node.attrib['from']), 'to': int(node.attrib['to']), 'weight': float(node.attrib['w'])})
+    return entities, themes, prominence, num_blocks
+
+def make_markers(num_concepts, num_related=20, num_themes=12, seed=42):
+    """
+    Build a markers XML document shaped like the ones Leximancer produces.
+    """
+    rand = random.Random(seed)
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<map>', '<markers cbcount="{0}">'.format(num_concepts * 7)]
+    for i in xrange(num_concepts):
+        parts.append('<entity id="{0}" ctv="{1:.4f}" freq="{2}" value="concept{0}" kind="word" x="{3:.5f}" y="{4:.5f}" tid="{5}"><rels>'.format(
+            i, rand.random() * 100, rand.randint(1, 500), rand.random(), rand.random(), i % num_themes))
+        for j in rand.sample(xrange(num_concepts), min(num_related, num_concepts)):
+            parts.append('<rel id="{0}" str="{1:.4f}" ct="{2}" pr="{3:.4f}"/>'.format(j, rand.random(), rand.randint(1, 50), rand.random() * 10))
+        parts.append('</rels></entity>')
+    parts.append('</markers><themes>')
+    for t in xrange(num_themes):
+        parts.append('<theme index="{0}" name="concept{0}" hue="{1}" connectiv="{2}"/>'.format(t, rand.randint(0, 360), rand.randint(1, 100)))
+    parts.append('</themes><mst>')
+    for i in xrange(1, num_concepts):
+        parts.append('<node id="{0}"><edges><edge id="{1}"/></edges><other><edge id="{1}"/></other></node>'.format(i, rand.randrange(i)))
+    parts.append('</mst><prominence><edges>')
+    for i in xrange(1, num_concepts):
+        parts.append('<edge from="{0}" to="{1}" w="{2:.4f}"/><note/>'.format(rand.randrange(i), i, rand.random()))
+    parts.append('</edges></prominence></map>')
+    return ''.join(parts)
+
+def best_of(fn, arg, repeat):
+    best = None
+    for i in xrange(repeat):
+        gc.collect()
+        start = time.time()
+        fn(arg)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+PARSERS = {
+    'tree': get_concepts_tree,
+    'stream': utils.get_concepts,
+}
+
+def peak_memory(parser, xml):
+    """
+    Run a parser over the markers XML in a new process and return how much its peak RSS grew by, in KB.
+    """
+    markers_file = tempfile.NamedTemporaryFile(suffix='.xml')
+    markers_file.write(xml)
+    markers_file.flush()
+    try:
+        return int(subprocess.check_output([sys.executable, __file__, '--memory', parser, markers_file.name]))
+    finally:
+        markers_file.close()
+
+def high_water_mark():
+    """
+    Peak RSS of this process in KB. Uses /proc where it can because ru_maxrss carries over from the parent.
+    """
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure_memory(parser, path):
+    xml = open(path, 'rb').read()
+    before = high_water_mark()
+    PARSERS[parser](xml)
+    print high_water_mark() - before
+
+def main(counts):
+    print '{0:>8} {1:>10} {2:>12} {3:>12} {4:>8} {5:>12} {6:>12}'.format(
+        'concepts', 'xml bytes', 'tree (ms)', 'stream (ms)', 'speedup', 'tree (KB)', 'stream (KB)')
+    for count in counts:
+        xml = make_markers(count)
+        expected = json.dumps(get_concepts_tree(xml), sort_keys=True)
+        actual = json.dumps(utils.get_concepts(xml), sort_keys=True)
+        assert expected == actual, 'Output differs for {0} concepts'.format(count)
+        repeat = 5 if count <= 1000 else 2
+        old = best_of(get_concepts_tree, xml, repeat)
+        new = best_of(utils.get_concepts, xml, repeat)
+        old_mem = peak_memory('tree', xml)
+        new_mem = peak_memory('stream', xml)
+        print '{0:>8} {1:>10} {2:>12.1f} {3:>12.1f} {4:>7.2f}x {5:>12} {6:>12}'.format(
+            count, len(xml), old * 1000, new * 1000, old / new, old_mem, new_mem)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--memory']:
+        measure_memory(sys.argv[2], sys.argv[3])
+        sys.exit()
+    main([int(c) for c in sys.argv[1:]] or [100, 1000, 5000, 10000])
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Compare the size and encode time of the usual and compact marker payloads.
+
+Usage: python bench/payload.py [concept counts...]
+
+Markers are generated with bench/markers.py's synthetic markers files (50 to 1,000 concepts by default) and
+parsed with utils.get_concepts. For each count the completed status response is encoded both ways and the raw,
+gzipped and (if the brotli module is installed) brotli compressed sizes are reported with the time taken to
+encode and compress. The compact payload is decoded back and checked against the usual one.
+"""
+import gc
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from django.conf import settings
+if not settings.configured:
+    settings.configure()
+
+from django.utils.text import compress_string
+from tib import payload
+from tib import utils
+import markers as markers_bench
+
+def usual(markers):
+    return json.dumps({"message": 'Here come the visualisations...', 'completed': True, 'progress': 100,
+                       'markers': markers})
+
+def compact(markers):
+    return json.dumps({"message": 'Here come the visualisations...', 'completed': True, 'progress': 100,
+                       'markers': payload.compact_markers(markers)}, separators=(',', ':'))
+
+def decode(compact):
+    """
+    Python version of tib.vis.decodeMarkers, with every value as a string so both encodings compare equal.
+    """
+    c = compact['concepts']
+    concepts = {}
+    for i, id in enumerate(c['id']):
+        related = c['related'][i]
+        concepts[str(id)] = {
+            'id': id, 'value': c['value'][i], 'kind': compact['kinds'][c['kind'][i]], 'weight': c['weight'][i],
+            'frequency': c['frequency'][i], 'x': c['x'][i], 'y': c['y'][i],
+            'mstEdges': [{'to': to} for to in c['mstEdges'][i]],
+            'related': [dict(zip(payload.RELATED_FIELDS, [str(v) for v in related[j:j + 4]]))
+                        for j in xrange(0, len(related), 4)]}
+        if c['themeId'][i] is not None:
+            concepts[str(id)]['themeId'] = str(c['themeId'][i])
+    t = compact['themes']
+    themes = dict((str(id), {'id': id, 'name': t['name'][i], 'hue': str(t['hue'][i]),
+                             'connectivity': str(t['connectivity'][i])}) for i, id in enumerate(t['id']))
+    p = compact['iprom']
+    iprom = [{'from': f, 'to': to, 'weight': w} for f, to, w in zip(p['from'], p['to'], p['weight'])]
+    return {'concepts': concepts, 'themes': themes, 'iprom': iprom, 'numBlocks': str(compact['numBlocks'])}
+
+def as_strings(markers):
+    """
+    The usual payload as the browser sees it, with related numbers normalised the way decode leaves them.
+    """
+    markers = json.loads(json.dumps(markers))
+    for concept in markers['concepts'].values():
+        concept['related'] = [dict((k, str(payload.number(v))) for k, v in rel.items()) for rel in concept['related']]
+    return markers
+
+def best_of(fn, arg, repeat=5):
+    best = None
+    for i in xrange(repeat):
+        gc.collect()
+        start = time.time()
+        fn(arg)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main(counts):
+    codings = [('gzip', compress_string)]
+    if payload.brotli is not None:
+        codings.append(('br', lambda s: payload.brotli.compress(s, quality=payload.BROTLI_QUALITY)))
+    else:
+        print 'brotli is not installed, only gzip is measured'
+
+    print '{0:>8} {1:>8} {2:>10} {3:>6} {4:>10} {5:>12}'.format('concepts', 'format', 'coding', '', 'bytes',
+                                                             'encode (ms)')
+    for count in counts:
+        concepts, themes, iprom, num_blocks = utils.get_concepts(markers_bench.make_markers(count))
+        markers = {'concepts': concepts, 'themes': themes, 'iprom': iprom, 'numBlocks': num_blocks}
+        decoded = decode(json.loads(compact(markers))['markers'])
+        assert decoded == as_strings(markers), 'The compact payload lost data for {0} concepts'.format(count)
+
+        for name, encode in (('usual', usual), ('compact', compact)):
+            body = encode(markers)
+            base = len(usual(markers))
+            print '{0:>8} {1:>8} {2:>10} {3:>5.0%} {4:>10} {5:>12.1f}'.format(
+                count, name, 'none', float(len(body)) / base, len(body), best_of(encode, markers) * 1000)
+            for coding, compress in codings:
+                size = len(compress(body))
+                elapsed = best_of(lambda m: compress(encode(m)), markers)
+                print '{0:>8} {1:>8} {2:>10} {3:>5.0%} {4:>10} {5:>12.1f}'.format(
+                    count, name, coding, float(size) / base, size, elapsed * 1000)
+
+if __name__ == '__main__':
+    main([int(c) for c in sys.argv[1:]] or [50, 100, 500, 1000])
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Microbenchmark the JSON encoders tib.serialize can use on marker payloads.
+
+Usage: python bench/serialize.py [concept counts...]
+
+Markers are generated with bench/markers.py's synthetic markers files (100 to 1,000 concepts by default) and
+parsed with utils.get_concepts. For every encoder installed the completed status response is encoded in the
+usual and compact encodings, in one go with dumps and in chunks with iterencode, and each result is checked to
+decode to the same data. The largest chunk iterencode produced shows how much it holds at once.
+"""
+import gc
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from django.conf import settings
+if not settings.configured:
+    settings.configure()
+
+from tib import payload
+from tib import serialize
+from tib import utils
+import markers as markers_bench
+
+def best_of(fn, repeat=5):
+    best = None
+    for i in xrange(repeat):
+        gc.collect()
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main(counts):
+    encoders = []
+    for name in ('ujson', 'simplejson', 'json'):
+        try:
+            encoders.append((name, serialize.load_encoder(name)))
+        except ImportError as err:
+            print '{0} skipped: {1}'.format(name, err)
+
+    print '{0:>8} {1:>8} {2:>11} {3:>11} {4:>11} {5:>11} {6:>12}'.format(
+        'concepts', 'format', 'encoder', 'bytes', 'dumps (ms)', 'iter (ms)', 'max chunk')
+    for count in counts:
+        concepts, themes, iprom, num_blocks = utils.get_concepts(markers_bench.make_markers(count))
+        markers = {'concepts': concepts, 'themes': themes, 'iprom': iprom, 'numBlocks': num_blocks}
+        for format, compact in (('usual', False), ('compact', True)):
+            response = {"message": 'Here come the visualisations...', 'completed': True, 'progress': 100,
+                        'markers': payload.encode_markers(markers, compact)}
+            expected = json.loads(json.dumps(response))
+            for name, encode in encoders:
+                serialize._encoder = encode
+                body = serialize.dumps(response, compact)
+                chunks = list(serialize.iterencode(response, compact))
+                assert json.loads(body) == expected, '{0} dumps output differs'.format(name)
+                assert json.loads(''.join(chunks)) == expected, '{0} iterencode output differs'.format(name)
+                dumps_time = best_of(lambda: serialize.dumps(response, compact))
+                iter_time = best_of(lambda: [c for c in serialize.iterencode(response, compact)])
+                print '{0:>8} {1:>8} {2:>11} {3:>11} {4:>11.1f} {5:>11.1f} {6:>12}'.format(
+                    count, format, name, len(body), dumps_time * 1000, iter_time * 1000, max(len(c) for c in chunks))
+    serialize._encoder = None
+
+if __name__ == '__main__':
+    main([int(c) for c in sys.argv[1:]] or [100, 500, 1000])
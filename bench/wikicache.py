@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Exercise the Wikipedia page cache against a local stand-in for Wikipedia.
+
+Usage: python bench/wikicache.py [page size in bytes]
+
+A local HTTP server plays Wikipedia, serving a synthetic article with an ETag and Last-Modified and answering
+conditional requests with 304. The script times a cold fetch, a fresh cache hit, a revalidation, a fetch after
+the page changes, and checks that the cache stays under its size limit. It counts the requests the server saw
+and checks each step made the requests it should have.
+"""
+import BaseHTTPServer
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from django.conf import settings
+if not settings.configured:
+    cache_dir = tempfile.mkdtemp(prefix='wikicache')
+    settings.configure(WIKI_CACHE={'PATH': cache_dir, 'MAX_BYTES': 10 * 1024 * 1024, 'MAX_AGE': 60})
+
+from tib import wikipedia
+
+class StandIn(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves /wiki/<title> as an article whose text changes when version is bumped.
+    """
+    version = 1
+    size = 500000
+    requests = []
+
+    def do_GET(self):
+        etag = '"{0}-{1}"'.format(self.path, self.version)
+        StandIn.requests.append((self.path, self.headers.get('If-None-Match')))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        para = '<p>Version {0} of {1}, the rabbit hurried down the hole after the queen.</p>'.format(self.version, self.path)
+        body = ('<html><body><div id="mw-navigation">Main page</div><div id="mw-content-text">{0}</div>'
+                '<div id="footer">Footer</div></body></html>').format(para * (self.size / len(para)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', 'Sat, 17 Oct 2026 10:00:00 GMT')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def timed(url):
+    before = len(StandIn.requests)
+    start = time.time()
+    text = wikipedia.fetch_text(url)
+    return text, (time.time() - start) * 1000, StandIn.requests[before:]
+
+def main(args):
+    if args:
+        StandIn.size = int(args[0])
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StandIn)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base = 'http://127.0.0.1:{0}/wiki/'.format(server.server_port)
+    page_cache = wikipedia.get_page_cache()
+
+    try:
+        print '{0:>12} {1:>10} {2:>9} {3}'.format('step', 'time (ms)', 'requests', 'text')
+
+        text, elapsed, requests = timed(base + 'Alice')
+        assert len(requests) == 1 and requests[0][1] is None
+        print '{0:>12} {1:>10.1f} {2:>9} {3}'.format('cold', elapsed, len(requests), text[:20])
+
+        text, elapsed, requests = timed(base + 'Alice#Plot')
+        assert not requests, 'A fresh entry should not be revalidated'
+        print '{0:>12} {1:>10.1f} {2:>9} {3}'.format('fresh hit', elapsed, len(requests), text[:20])
+
+        page_cache.max_age = 0
+        text, elapsed, requests = timed(base + 'Alice')
+        assert len(requests) == 1 and requests[0][1] is not None, 'A stale entry should be revalidated'
+        assert text.startswith('Version 1')
+        print '{0:>12} {1:>10.1f} {2:>9} {3}'.format('revalidated', elapsed, len(requests), text[:20])
+
+        StandIn.version = 2
+        text, elapsed, requests = timed(base + 'Alice')
+        assert len(requests) == 1 and text.startswith('Version 2'), 'A changed page should be fetched again'
+        print '{0:>12} {1:>10.1f} {2:>9} {3}'.format('changed', elapsed, len(requests), text[:20])
+
+        page_cache.max_age = 60
+        page_cache.max_bytes = StandIn.size * 3
+        for i in xrange(10):
+            wikipedia.fetch_text(base + 'Page{0}'.format(i))
+        used = sum(os.path.getsize(os.path.join(page_cache.path, name)) for name in os.listdir(page_cache.path))
+        assert used <= page_cache.max_bytes, 'The cache is over its size limit'
+        print '{0} entries, {1} bytes cached with a limit of {2}'.format(len(os.listdir(page_cache.path)), used,
+                                                                         page_cache.max_bytes)
+    finally:
+        server.shutdown()
+        shutil.rmtree(page_cache.path, ignore_errors=True)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+Benchmark converting whole Wikipedia pages to text against extracting the article first.
+
+Usage: python bench/wikipedia.py [page.html ...]
+
+With no files, synthetic pages with Wikipedia's layout (navigation, infobox, table of contents, sections,
+navboxes, reference lists, footer) are generated at a few sizes. Saved pages can be passed instead. For each
+page the bytes html2text has to parse, the time taken and the length of the resulting text are reported.
+"""
+import gc
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tib import html2text
+from tib import wikipedia
+
+WORDS = ('the', 'of', 'and', 'in', 'queen', 'rabbit', 'garden', 'tea', 'party', 'caterpillar', 'mushroom', 'court',
+         'trial', 'tarts', 'croquet', 'flamingo', 'hedgehog', 'duchess', 'cook', 'pepper', 'baby', 'pig', 'cheshire',
+         'cat', 'grin', 'hatter', 'hare', 'dormouse', 'treacle', 'well', 'turtle', 'gryphon', 'lobster', 'quadrille')
+
+def sentence(rand):
+    words = []
+    for i in xrange(rand.randint(6, 24)):
+        word = rand.choice(WORDS)
+        roll = rand.random()
+        if roll < 0.08:
+            word = '<a href="/wiki/{0}" title="{0}">{0}</a>'.format(word.capitalize())
+        elif roll < 0.1:
+            word += '<sup id="cite_ref-{0}" class="reference"><a href="#cite_note-{0}">[{0}]</a></sup>'.format(rand.randint(1, 300))
+        words.append(word)
+    return ' '.join(words).capitalize() + '.'
+
+def navbox(rand):
+    links = ' &#183; '.join('<a href="/wiki/{0}">{0}</a>'.format(rand.choice(WORDS).capitalize()) for i in xrange(60))
+    return ('<div role="navigation" class="navbox"><table class="nowraplinks hlist navbox-inner"><tr><th class="navbox-title">'
+            'Works</th></tr><tr><td class="navbox-list"><div><ul><li>{0}</li></ul></div></td></tr></table></div>').format(links)
+
+def make_page(size, seed=1):
+    """
+    Build a Wikipedia style page of roughly size bytes, about a third of which is article text.
+    """
+    rand = random.Random(seed)
+    head = ['<!DOCTYPE html><html lang="en"><head><meta charset="UTF-8"><title>Alice - Wikipedia</title>',
+            '<style>', '.mw-body { margin: 0 } ' * 400, '</style>',
+            '<script>', 'var wgPageName = "Alice"; ' * 400, '</script></head><body><div id="content" class="mw-body">',
+            '<h1 id="firstHeading">Alice</h1><div id="mw-content-text" class="mw-body-content"><div class="mw-parser-output">',
+            '<div class="shortdescription nomobile">1865 novel</div>',
+            '<table class="infobox vcard">', ''.join('<tr><th>Field {0}</th><td>{1}</td></tr>'.format(i, sentence(rand))
+                                                   for i in xrange(30)), '</table>',
+            '<div id="toc" class="toc"><ul>', ''.join('<li><a href="#s{0}">{0} Section</a></li>'.format(i) for i in xrange(20)),
+            '</ul></div>']
+    body = []
+    length = 0
+    section = 0
+    while length < size / 3:
+        section += 1
+        chunk = ['<div class="mw-heading mw-heading2"><h2 id="s{0}">Section {0}</h2><span class="mw-editsection">'
+                 '[<a href="/w/index.php?action=edit&amp;section={0}">edit</a>]</span></div>'.format(section)]
+        for i in xrange(rand.randint(2, 6)):
+            chunk.append('<p>{0}</p>\n'.format(' '.join(sentence(rand) for j in xrange(rand.randint(2, 8)))))
+        if rand.random() < 0.3:
+            chunk.append('<figure typeof="mw:File/Thumb"><img src="x.jpg"><figcaption>{0}</figcaption></figure>'.format(sentence(rand)))
+        text = ''.join(chunk)
+        body.append(text)
+        length += len(text)
+    tail = ['<div class="mw-heading mw-heading2"><h2 id="References">References</h2></div><div class="reflist"><ol class="references">']
+    length = sum(len(p) for p in head) + length
+    note = 0
+    while length < size * 0.7:
+        note += 1
+        text = '<li id="cite_note-{0}"><a href="#cite_ref-{0}">^</a> <cite>{1}</cite></li>'.format(note, sentence(rand))
+        tail.append(text)
+        length += len(text)
+    tail.append('</ol></div>')
+    while length < size * 0.85:
+        text = navbox(rand)
+        tail.append(text)
+        length += len(text)
+    tail.append('</div></div><div class="printfooter">Retrieved from</div></div><div id="mw-navigation"><ul>')
+    while length < size:
+        text = '<li><a href="/wiki/Portal:{0}">{0}</a></li>'.format(rand.choice(WORDS))
+        tail.append(text)
+        length += len(text)
+    tail.append('</ul></div><div id="footer"><p>Text is available under the Creative Commons licence.</p></div></body></html>')
+    return ''.join(head + body + tail)
+
+def whole_page(content):
+    html = content.decode('utf-8', 'ignore')
+    return len(html), html2text.html2plain(html)
+
+def article_only(content):
+    html = wikipedia.extract_article(content)
+    return len(html), html2text.html2plain(html)
+
+def best_of(fn, arg, repeat):
+    best = None
+    for i in xrange(repeat):
+        gc.collect()
+        start = time.time()
+        fn(arg)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main(args):
+    if args:
+        pages = [(os.path.basename(f), open(f, 'rb').read()) for f in args]
+    else:
+        pages = [('synthetic-{0}k'.format(size / 1000), make_page(size)) for size in (200000, 1000000, 3000000)]
+
+    print '{0:>20} {1:>12} {2:>12} {3:>10} {4:>12} {5:>12} {6:>10}'.format(
+        'page', 'html chars', 'article', 'page (ms)', 'text chars', 'article (ms)', 'text chars')
+    for name, content in pages:
+        whole_bytes, whole_text = whole_page(content)
+        article_bytes, article_text = article_only(content)
+        whole = best_of(whole_page, content, 3)
+        article = best_of(article_only, content, 3)
+        print '{0:>20} {1:>12} {2:>12} {3:>10.1f} {4:>12} {5:>12.1f} {6:>10}'.format(
+            name, whole_bytes, article_bytes, whole * 1000, len(whole_text), article * 1000, len(article_text))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,163 @@
+"""
+Batches: many texts or Wikipedia URLs submitted in one request.
+
+Each item is checked and queued as a job of its own, so the job workers run the batch's projects within
+MAX_RUNNING and the submitting client's MAX_PER_CLIENT like any others. Texts are queued while the batch is
+submitted. URLs are only checked: the batch is recorded straight away and the job workers fetch the articles and
+queue them (see jobs.fetch_step), so a big batch doesn't hold the request open for its downloads. The batch keeps
+the id each item was given, which is all the status and markers calls need to report on the whole batch at once.
+"""
+import logging
+from django.conf import settings
+from tib import cache
+from tib import jobs
+from tib import wikipedia
+
+logger = logging.getLogger('tib')
+
+DEFAULTS = {
+    # Most texts and URLs in one batch
+    'MAX_ITEMS': 100,
+}
+
+class BatchError(Exception):
+    """
+    Exception thrown when a batch can't be accepted.
+
+    Attributes:
+        msg -- explanation of the error.
+    """
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return repr(self.msg)
+
+def get_config():
+    """
+    Get the batch settings, settings.BATCH overrides DEFAULTS.
+    """
+    conf = dict(DEFAULTS)
+    conf.update(getattr(settings, 'BATCH', {}))
+    return conf
+
+def item_text(item):
+    """
+    Get the text for one batch item, a dict with a "text".
+
+    Returns a tuple of the text and None, or None and the reason it can't be used.
+    """
+    if not isinstance(item, dict) or not isinstance(item.get('text'), basestring):
+        return None, 'Each item must be an object with a "text" or a "url".'
+    text = item['text']
+    if not jobs.text_length_ok(text):
+        return None, 'The text must be between {0} and {1} characters long.'.format(jobs.MIN_TEXT_LENGTH,
+                                                                                jobs.MAX_TEXT_LENGTH)
+    return text, None
+
+def submit_item(item, client):
+    """
+    Check and queue one batch item with a text.
+
+    Returns a dict with the id to follow the item by, a job id or the result key of a cached visualisation, or the
+    error it was turned away with.
+    """
+    try:
+        text, error = item_text(item)
+        if error is not None:
+            return {'error': error}
+        key = cache.result_key(text)
+        if cache.get_result(key) is not None:
+            return {'id': key}
+        return {'id': jobs.submit(key, text, client)}
+    except jobs.QueueFull as err:
+        return {'error': err.msg, 'retryAfter': err.retry_after}
+    except Exception as err:
+        logger.exception(err)
+        return {'error': 'The item could not be queued.'}
+
+def submit(items, client=None, conf=None):
+    """
+    Submit a batch of items from the passed client IP. Texts are queued now, the articles of valid Wikipedia URLs
+    are left to the job workers and their items are {"url": <the article's URL>} until they have been fetched.
+
+    Returns a tuple of the batch id and a dict for each item, see submit_item. Raises BatchError if the batch is
+    empty or too big.
+    """
+    conf = conf or get_config()
+    if not isinstance(items, list) or not items:
+        raise BatchError('A batch needs a list of items.')
+    if len(items) > conf['MAX_ITEMS']:
+        raise BatchError('A batch can have at most {0} items.'.format(conf['MAX_ITEMS']))
+    results = []
+    fetches = []
+    for item in items:
+        if (isinstance(item, dict) and not isinstance(item.get('text'), basestring) and
+                isinstance(item.get('url'), basestring)):
+            try:
+                url = wikipedia.article_url(item['url'])
+            except wikipedia.NotAnArticle as err:
+                results.append({'error': err.msg})
+            else:
+                fetches.append((len(results), url))
+                results.append({'url': url})
+        else:
+            results.append(submit_item(item, client))
+    return jobs.get_store().add_batch(results, client, fetches), results
+
+def item_status(item, job):
+    """
+    Build the status of one batch item from its job (None for a cached result or a missing job).
+    """
+    if 'error' in item:
+        return {'state': jobs.FAILED, 'progress': 0, 'message': item['error']}
+    if 'id' not in item:
+        return {'state': jobs.QUEUED, 'progress': 0, 'message': 'Fetching the article...'}
+    if cache.is_result_key(item['id']):
+        return {'id': item['id'], 'state': jobs.DONE, 'progress': 100, 'message': None}
+    if job is None:
+        return {'id': item['id'], 'state': jobs.FAILED, 'progress': 0, 'message': "Couldn't find job."}
+    return {'id': item['id'], 'state': job['state'], 'progress': 100 if job['state'] == jobs.DONE else job['progress'],
+            'message': job['message']}
+
+def status(id):
+    """
+    Get the status of every item in the batch with the passed id, read in one query.
+
+    Returns a dict with the counts of items in each state, the overall progress and the items, or None if there
+    is no such batch.
+    """
+    items = jobs.get_store().get_batch(id)
+    if items is None:
+        return None
+    found = jobs.get_store().get_many(item['id'] for item in items if 'id' in item and not cache.is_result_key(item['id']))
+    statuses = [item_status(item, found.get(item.get('id'))) for item in items]
+    counts = dict((state, 0) for state in (jobs.QUEUED, jobs.RUNNING, jobs.DONE, jobs.FAILED))
+    for item in statuses:
+        counts[item['state']] += 1
+    return {'id': id, 'counts': counts, 'completed': counts[jobs.QUEUED] + counts[jobs.RUNNING] == 0,
+            'progress': sum(item['progress'] for item in statuses) / len(statuses), 'items': statuses}
+
+def markers(id):
+    """
+    Get the markers of every finished item in the batch with the passed id.
+
+    Returns a generator of (status, markers) tuples in the order the items were submitted, with markers None for
+    items that haven't finished or have expired, or None if there is no such batch. Markers are read from the
+    result cache one item at a time.
+    """
+    items = jobs.get_store().get_batch(id)
+    if items is None:
+        return None
+    found = jobs.get_store().get_many(item['id'] for item in items if 'id' in item and not cache.is_result_key(item['id']))
+
+    def generate():
+        for item in items:
+            job = found.get(item.get('id'))
+            item_markers = None
+            if 'id' in item and cache.is_result_key(item['id']):
+                item_markers = cache.get_result(item['id'])
+            elif job is not None and job['state'] == jobs.DONE:
+                item_markers = cache.get_result(job['key'])
+            yield item_status(item, job), item_markers
+    return generate()
@@ -0,0 +1,114 @@
+import hashlib
+import re
+import time
+from django.conf import settings
+from django.core.cache import get_cache
+
+# Name of the alias in settings.CACHES that stores finished visualisations.
+# Falls back to the default cache if the alias isn't configured.
+RESULT_CACHE_ALIAS = 'results'
+
+# Result keys are SHA-1 hex digests
+KEY_RE = re.compile(r'^[0-9a-f]{40}$')
+
+_cache = None
+
+def get_result_cache():
+    """
+    Get the cache that finished marker payloads are kept in.
+
+    The backend, TTL (TIMEOUT) and size limit (MAX_ENTRIES) come from the RESULT_CACHE_ALIAS entry of
+    settings.CACHES so any Django cache backend (locmem, filebased, memcached...) can be plugged in.
+    """
+    global _cache
+    if _cache is None:
+        caches = getattr(settings, 'CACHES', {})
+        _cache = get_cache(RESULT_CACHE_ALIAS if RESULT_CACHE_ALIAS in caches else 'default')
+    return _cache
+
+def normalise_text(text):
+    """
+    Normalise text so that submissions which only differ by whitespace produce the same key.
+
+    Returns a UTF-8 encoded byte string.
+    """
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'ignore')
+    return u' '.join(text.split()).encode('utf-8')
+
+class ResultKey(object):
+    """
+    Build a result key a piece of text at a time, for text too big to hold in memory.
+
+    The key is the same as result_key gives for the pieces joined with whitespace.
+    """
+    def __init__(self):
+        self.digest = hashlib.sha1()
+        self.empty = True
+
+    def update(self, text):
+        """
+        Add the next piece of text.
+        """
+        normalised = normalise_text(text)
+        if not normalised:
+            return
+        if not self.empty:
+            self.digest.update(' ')
+        self.digest.update(normalised)
+        self.empty = False
+
+    def hexdigest(self):
+        """
+        Get the key for the text added so far.
+        """
+        digest = self.digest.copy()
+        digest.update('\0{0}\0{1}'.format(settings.PROJECT_CONF_XML, settings.PROJECT_THEME_SIZE))
+        return digest.hexdigest()
+
+def result_key(text):
+    """
+    Get the content address for the passed text.
+
+    The key covers the normalised text and the Leximancer settings that shape the output, so changing
+    PROJECT_CONF_XML or PROJECT_THEME_SIZE doesn't serve stale visualisations.
+    """
+    key = ResultKey()
+    key.update(text)
+    return key.hexdigest()
+
+def is_result_key(id):
+    """
+    Return true if the passed run id is a result key rather than a job id.
+    """
+    return KEY_RE.match(id) is not None
+
+def project_name(key):
+    """
+    Build a unique Leximancer project name for the text with the passed key.
+    """
+    return '{0}{1:x}'.format(key, int(time.time() * 1000))
+
+def get_result(key):
+    """
+    Get the cached markers for the passed result key, or None if there isn't one.
+    """
+    return get_result_cache().get('result:{0}'.format(key))
+
+def set_result(key, markers):
+    """
+    Store the markers for the passed result key.
+    """
+    get_result_cache().set('result:{0}'.format(key), markers)
+
+def get_compact(key):
+    """
+    Get the JSON of the compact encoding of the markers for the passed result key, or None if it isn't cached.
+    """
+    return get_result_cache().get('compact:{0}'.format(key))
+
+def set_compact(key, body):
+    """
+    Store the JSON of the compact encoding of the markers for the passed result key.
+    """
+    get_result_cache().set('compact:{0}'.format(key), body)
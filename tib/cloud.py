@@ -0,0 +1,395 @@
+"""
+Concept Cloud layout on the server.
+
+The Concept Cloud is laid out by d3.layout.cloud in the browser, placing words one at a time along a spiral and
+checking each spot against a bitmap of the words already placed. That is slow on low-end devices and redone on
+every view. layout runs the same search once, when a job finishes, and the positions are kept with the markers so
+cloud.js only has to draw them. They are for the cloud's default settings, picking another font, shape, orientation
+or scaling from the menus (or Refresh) lays the cloud out in the browser as before.
+
+There are no fonts to measure here, so a word's bitmap is a few boxes, one per run of letters of the same height,
+sized from an average character width (FONT_WIDTH). The board is a grid of GRID pixel cells. With NumPy it is
+kept as a summed-area table, so a whole stretch of the spiral is checked for a word in one vectorised step;
+without it the board is a bitmask per row of cells, checked spot by spot. Both place the words in the same spots.
+"""
+import logging
+import math
+import random
+from django.conf import settings
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger('tib')
+
+DEFAULTS = {
+    # Lay the cloud out when jobs finish
+    'ENABLED': True,
+    # Size of the cloud in pixels, as registered for ConceptCloud in result.html
+    'WIDTH': 1000,
+    'HEIGHT': 700,
+    # cloud.js's default font and the average width of its bold characters in ems
+    'FONT': 'Trebuchet MS',
+    'FONT_WIDTH': 0.6,
+    # 'archimedean' or 'rectangular'
+    'SPIRAL': 'archimedean',
+    # Word angles as cloud.js's ORIENTATIONS: [number of angles, start angle, end angle]
+    'ORIENTATION': [0, 0, 0],
+}
+
+# Pixels per board cell, and pixels kept clear around each word
+GRID = 2
+PADDING = 1
+
+# Heights of letters above and below the baseline, in ems
+ASCENT = 0.75
+X_HEIGHT = 0.55
+BASELINE = 0.02
+DESCENT = 0.22
+# Lower case letters that reach ASCENT or DESCENT
+TALL = 'bdfhijklt'
+DESCENDING = 'gjpqy'
+
+# cloud.js's TEXT_SCALE, for working out the font sizes the same way
+FONT_SIZE_MIN = 8
+FONT_SIZE_MAX = 160
+FONT_SIZE_FLOOR = 50
+EXP_MIN = 0.8
+EXP_MAX = 2.0
+MEAN_FACTOR_THRESH = 0.6
+RANGE_FACTOR_THRESH = 0.1
+RANGE_LOWER_THRESH = 100
+RANGE_UPPER_THRESH = 330
+
+# Spiral steps checked at once with NumPy at first, most words fit near their start. Each later stretch of the
+# spiral is four times longer than the one before.
+FIRST_STRETCH = 256
+
+def get_config():
+    """
+    Get the cloud layout settings, settings.CLOUD_LAYOUT overrides DEFAULTS.
+    """
+    conf = dict(DEFAULTS)
+    conf.update(getattr(settings, 'CLOUD_LAYOUT', {}))
+    return conf
+
+def scale_exponent(sizes):
+    """
+    Pick the exponent for the font size scale the way cloud.js's Automatic scaling does: contract or expand the
+    word sizes when their spread looks likely to give a bloated or anaemic cloud.
+    """
+    low, high = min(sizes), max(sizes)
+    size_range = high - low
+    total = sum(sizes)
+    mean = float(total) / len(sizes)
+    mean_factor = float(sum(1 for size in sizes if size < mean)) / len(sizes)
+    range_factor = float(size_range) / total if total else 0
+    if ((mean_factor <= MEAN_FACTOR_THRESH and size_range > RANGE_LOWER_THRESH) or
+            size_range > RANGE_UPPER_THRESH or
+            (size_range < RANGE_LOWER_THRESH and range_factor < RANGE_FACTOR_THRESH)):
+        exponent = float(RANGE_UPPER_THRESH) / size_range if size_range else EXP_MAX
+        return max(EXP_MIN, min(EXP_MAX, exponent))
+    return 1
+
+def text_width(text, font_size, conf):
+    """
+    Estimate the width in pixels of text at the passed font size.
+    """
+    return len(text) * font_size * conf['FONT_WIDTH']
+
+def font_sizes(words, conf):
+    """
+    Work out the font size of each word from its weight, as cloud.js does: a power scale from FONT_SIZE_MIN to
+    FONT_SIZE_MAX, with the top of the range brought down 10 pixels at a time (to no lower than FONT_SIZE_FLOOR)
+    while any word is too wide for the cloud.
+
+    words -- list of (text, weight) tuples.
+
+    Returns a list of font sizes in pixels.
+    """
+    sizes = [int(weight) for text, weight in words]
+    low, high = min(sizes), max(sizes)
+    exponent = scale_exponent(sizes)
+    low_power, high_power = low ** exponent, high ** exponent
+
+    def scale(size, top):
+        if high_power == low_power:
+            return FONT_SIZE_MIN
+        return FONT_SIZE_MIN + (size ** exponent - low_power) / (high_power - low_power) * (top - FONT_SIZE_MIN)
+
+    horizontal = conf['ORIENTATION'][1] == conf['ORIENTATION'][2] == 0
+    limit = 0.95 * (conf['WIDTH'] if horizontal else min(conf['WIDTH'], conf['HEIGHT']))
+    top = FONT_SIZE_MAX
+    for (text, weight), size in zip(words, sizes):
+        if top <= FONT_SIZE_FLOOR:
+            break
+        while text_width(text, scale(size, top), conf) > limit and top > FONT_SIZE_FLOOR:
+            top -= 10
+    return [int(scale(size, top)) for size in sizes]
+
+def word_sprite(text, font_size, rotate, conf):
+    """
+    Get the board cells a word's letters cover around the cell it is drawn at (the middle of its baseline), with
+    PADDING pixels all round. Runs of letters of the same height share a box, so small words can tuck in above
+    short letters and below ones without descenders as they do in the browser's bitmaps. A turned word is one box
+    around all of it.
+
+    Returns a list of boxes, each a tuple of the first and last but one column and row, from the word's cell.
+    """
+    char_width = conf['FONT_WIDTH'] * font_size
+    left = -len(text) * char_width / 2.0
+    if rotate:
+        corners = [(left, -ASCENT * font_size), (-left, -ASCENT * font_size),
+                   (left, DESCENT * font_size), (-left, DESCENT * font_size)]
+        sin, cos = math.sin(math.radians(rotate)), math.cos(math.radians(rotate))
+        corners = [(x * cos - y * sin, x * sin + y * cos) for x, y in corners]
+        runs = [(min(x for x, y in corners), max(x for x, y in corners),
+                 min(y for x, y in corners), max(y for x, y in corners))]
+    else:
+        runs = []
+        last = None
+        for i, char in enumerate(text):
+            if char.isspace():
+                continue
+            top = -(ASCENT if char.isupper() or char.isdigit() or char in TALL else X_HEIGHT) * font_size
+            bottom = (DESCENT if char in DESCENDING else BASELINE) * font_size
+            x = left + i * char_width
+            if last == i - 1 and runs[-1][2:] == (top, bottom):
+                runs[-1] = (runs[-1][0], x + char_width, top, bottom)
+            else:
+                runs.append((x, x + char_width, top, bottom))
+            last = i
+    return [(int(math.floor((l - PADDING) / GRID)), int(math.ceil((r + PADDING) / GRID)),
+             int(math.floor((t - PADDING) / GRID)), int(math.ceil((b + PADDING) / GRID))) for l, r, t, b in runs]
+
+def sprite_bounds(sprite):
+    """
+    Get the box around all of a sprite's boxes.
+    """
+    return (min(box[0] for box in sprite), max(box[1] for box in sprite),
+            min(box[2] for box in sprite), max(box[3] for box in sprite))
+
+def spiral_steps(width, height, kind):
+    """
+    Get the steps of d3.layout.cloud's archimedean or rectangular spiral, in board cells, out to where it leaves
+    the board. Steps that stay in the same cell are dropped.
+
+    Returns a list of (dx, dy) offsets from the spiral's start.
+    """
+    ratio = float(width) / height
+    offsets = []
+    if kind == 'rectangular':
+        step_y = 4
+        step_x = step_y * ratio
+        x = y = 0
+        t = 0
+        # Past a corner beyond the board every later step is off it
+        while abs(x) <= width or abs(y) <= height:
+            offsets.append((x, y))
+            t += 1
+            # Triangular numbers, T_n = n * (n + 1) / 2, mark the corners
+            turn = int(math.sqrt(1 + 4 * t) - 1) & 3
+            if turn == 0:
+                x += step_x
+            elif turn == 1:
+                y += step_y
+            elif turn == 2:
+                x -= step_x
+            else:
+                y -= step_y
+    else:
+        # Steps more than this far round are off the board wherever the spiral starts
+        limit = math.sqrt((width / ratio) ** 2 + height ** 2)
+        t = 0
+        while t * 0.1 <= limit:
+            s = t * 0.1
+            offsets.append((ratio * s * math.cos(s), s * math.sin(s)))
+            t += 1
+    steps = []
+    for x, y in offsets:
+        step = (int(x) // GRID, int(y) // GRID)
+        if not steps or steps[-1] != step:
+            steps.append(step)
+    return steps
+
+class NumpyBoard(object):
+    """
+    The cells of the board taken up so far, as a summed-area table: sums[i, j] is the number of taken cells above
+    row i and left of column j, so the cells under a box are counted with four lookups wherever it is.
+    """
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+        self.sums = numpy.zeros((rows + 1, columns + 1), dtype=numpy.int32)
+
+    def first_free(self, xs, ys, sprite):
+        """
+        Find the first of the passed cells (arrays of columns and rows) where the sprite is on the board and clear
+        of the words placed so far.
+
+        Returns the index of the cell, or None.
+        """
+        left, right, top, bottom = sprite_bounds(sprite)
+        fits = (xs >= -left) & (ys >= -top) & (xs <= self.columns - right) & (ys <= self.rows - bottom)
+        candidates = numpy.flatnonzero(fits)
+        if not len(candidates):
+            return None
+        sums = self.sums
+        # Biggest box first, each box only checked at the cells where the ones before it were clear
+        for left, right, top, bottom in sorted(sprite, key=lambda box: (box[0] - box[1]) * (box[3] - box[2])):
+            x, y = xs[candidates], ys[candidates]
+            x0, x1, y0, y1 = x + left, x + right, y + top, y + bottom
+            candidates = candidates[sums[y1, x1] - sums[y0, x1] - sums[y1, x0] + sums[y0, x0] == 0]
+            if not len(candidates):
+                return None
+        return int(candidates[0])
+
+    def take(self, x, y, sprite):
+        """
+        Mark the cells under the sprite at x, y as taken.
+        """
+        for left, right, top, bottom in sprite:
+            x0, x1, y0, y1 = x + left, x + right, y + top, y + bottom
+            # Every sum below and right of the box's top left cell grows by the part of the box above and left of
+            # it. Boxes of a word can share cells, those are counted twice, which doesn't matter as only zero counts.
+            rows = numpy.minimum(numpy.arange(1, self.rows - y0 + 1, dtype=numpy.int32), y1 - y0)
+            columns = numpy.minimum(numpy.arange(1, self.columns - x0 + 1, dtype=numpy.int32), x1 - x0)
+            self.sums[y0 + 1:, x0 + 1:] += rows[:, None] * columns
+
+class BitmaskBoard(object):
+    """
+    The cells of the board taken up so far, as an int per row with a bit set for each taken cell.
+    """
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = [0] * rows
+
+    def first_free(self, xs, ys, sprite):
+        """
+        Find the first of the passed cells (lists of columns and rows) where the sprite is on the board and clear
+        of the words placed so far.
+
+        Returns the index of the cell, or None.
+        """
+        left, right, top, bottom = sprite_bounds(sprite)
+        columns, rows = self.columns, self.rows
+        masks = [(((1 << (box[1] - box[0])) - 1), box[0], box[2], box[3]) for box in sprite]
+        for i in xrange(len(xs)):
+            x, y = xs[i], ys[i]
+            if x < -left or y < -top or x > columns - right or y > len(rows) - bottom:
+                continue
+            for mask, shift, top_row, bottom_row in masks:
+                mask <<= x + shift
+                if any(rows[row] & mask for row in xrange(y + top_row, y + bottom_row)):
+                    break
+            else:
+                return i
+        return None
+
+    def take(self, x, y, sprite):
+        """
+        Mark the cells under the sprite at x, y as taken.
+        """
+        for left, right, top, bottom in sprite:
+            mask = ((1 << (right - left)) - 1) << (x + left)
+            for row in xrange(y + top, y + bottom):
+                self.rows[row] |= mask
+
+def layout(concepts, conf=None, seed=None):
+    """
+    Lay out the concepts as the Concept Cloud. Words are placed biggest first, each starting from a random spot
+    near the middle and moving out along the spiral until it is clear of the words before it. Words that don't
+    fit anywhere are left out, as in the browser.
+
+    concepts -- the concepts dict from utils.get_concepts.
+    conf -- layout settings, get_config() by default.
+    seed -- seed for the start spots and angles, so a result is always laid out the same way.
+
+    Returns a dict of the settings used and the placed words, with the position (in pixels from the middle of
+    the cloud), angle and font size of each in columns.
+    """
+    if conf is None:
+        conf = get_config()
+    width, height = conf['WIDTH'], conf['HEIGHT']
+    count, start_angle, end_angle = conf['ORIENTATION']
+    rand = random.Random(seed)
+
+    ids = sorted(concepts, key=int)
+    sizes = font_sizes([(concepts[id]['value'], concepts[id]['weight']) for id in ids], conf)
+    # Biggest first, as in the browser
+    order = sorted(range(len(ids)), key=lambda i: -sizes[i])
+
+    steps = spiral_steps(width, height, conf['SPIRAL'])
+    if numpy is not None:
+        board = NumpyBoard(width // GRID, height // GRID)
+        step_xs = numpy.array([dx for dx, dy in steps], dtype=numpy.int32)
+        step_ys = numpy.array([dy for dx, dy in steps], dtype=numpy.int32)
+    else:
+        board = BitmaskBoard(width // GRID, height // GRID)
+        step_xs = [dx for dx, dy in steps]
+        step_ys = [dy for dx, dy in steps]
+
+    words = {'id': [], 'x': [], 'y': [], 'rotate': [], 'size': []}
+    for i in order:
+        concept = concepts[ids[i]]
+        start_x = ((int(width / 2.0 * (rand.random() + 0.5)) >> 1) + width // 4) // GRID
+        start_y = ((int(height / 2.0 * (rand.random() + 0.5)) >> 1) + height // 4) // GRID
+        index = int(rand.random() * count)
+        rotate = start_angle + (end_angle - start_angle) * index / (count - 1) if count > 1 else start_angle
+        # The spiral runs one way or the other
+        direction = 1 if rand.random() < 0.5 else -1
+        sprite = word_sprite(concept['value'], sizes[i], rotate, conf)
+        if not sprite:
+            continue
+
+        spot = None
+        if numpy is not None:
+            begin, stretch = 0, FIRST_STRETCH
+            while spot is None and begin < len(steps):
+                end = min(begin + stretch, len(steps))
+                found = board.first_free(start_x + direction * step_xs[begin:end],
+                                         start_y + direction * step_ys[begin:end], sprite)
+                if found is not None:
+                    spot = begin + found
+                begin, stretch = end, stretch * 4
+        else:
+            spot = board.first_free([start_x + direction * dx for dx in step_xs],
+                                    [start_y + direction * dy for dy in step_ys], sprite)
+        if spot is None:
+            continue
+        x, y = start_x + direction * int(step_xs[spot]), start_y + direction * int(step_ys[spot])
+        board.take(x, y, sprite)
+        words['id'].append(concept['id'])
+        words['x'].append(x * GRID - width // 2)
+        words['y'].append(y * GRID - height // 2)
+        words['rotate'].append(rotate)
+        words['size'].append(sizes[i])
+
+    return {
+        'width': width,
+        'height': height,
+        'font': conf['FONT'],
+        'spiral': conf['SPIRAL'],
+        'orientation': list(conf['ORIENTATION']),
+        'words': words,
+    }
+
+def add_layout(key, markers):
+    """
+    Lay out the cloud for the markers of the passed result key and keep it in markers['cloud'], unless it is
+    already there or turned off. A failed layout is logged rather than raised, the browser can still lay the
+    cloud out itself.
+
+    Returns true if a layout was added.
+    """
+    conf = get_config()
+    if not conf['ENABLED'] or 'cloud' in markers or not markers['concepts']:
+        return False
+    try:
+        markers['cloud'] = layout(markers['concepts'], conf, key)
+    except Exception as err:
+        logger.warning('Could not lay out the cloud of {0}: {1}'.format(key, err))
+        return False
+    return True
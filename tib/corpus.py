@@ -0,0 +1,200 @@
+"""
+Large documents (whole books) uploaded as files.
+
+A book is far more text than one Leximancer run can take, so the upload is read from disk a chunk at a time,
+cut into blocks at paragraph breaks and an evenly spaced sample of the blocks, from the first page to the last,
+is written out as several docset files. Only one chunk and one block are held in memory whatever the size of
+the upload.
+"""
+import codecs
+import os
+import re
+import tempfile
+from django.conf import settings
+from tib import cache
+
+DEFAULTS = {
+    # Largest file accepted, in bytes
+    'MAX_UPLOAD_BYTES': 50 * 1024 * 1024,
+    # Most characters of the file given to Leximancer. Longer files are sampled down to this.
+    'MAX_CHARS': 500000,
+    # Characters in each docset file the sample is split over
+    'PART_CHARS': 100000,
+    # Blocks end at the first paragraph break after this many characters, or at a space if there isn't one
+    # within four times as many
+    'BLOCK_CHARS': 2000,
+}
+
+# A paragraph break, a blank line that may hold stray whitespace
+r_paragraph = re.compile(r'\n[ \t\r\f\v]*\n')
+
+class UploadError(Exception):
+    """
+    Exception thrown when an uploaded file can't be used.
+
+    Attributes:
+        msg -- explanation of the error.
+    """
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return repr(self.msg)
+
+def get_config():
+    """
+    Get the large document settings, settings.LARGE_TEXT overrides DEFAULTS.
+    """
+    conf = dict(DEFAULTS)
+    conf.update(getattr(settings, 'LARGE_TEXT', {}))
+    return conf
+
+def read_blocks(chunks, block_chars):
+    """
+    Cut the UTF-8 text in the passed iterable of byte strings into blocks of about block_chars characters.
+
+    Returns a generator of unicode blocks.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')('ignore')
+    max_chars = block_chars * 4
+    pending = u''
+    for chunk in chunks:
+        pending += decoder.decode(chunk)
+        start = 0
+        while len(pending) - start >= block_chars:
+            match = r_paragraph.search(pending, start + block_chars, start + max_chars)
+            if match is not None:
+                end = match.end()
+            elif len(pending) - start < max_chars:
+                # Wait for more text, the paragraph may end in the next chunk
+                break
+            else:
+                end = pending.rfind(u' ', start + block_chars, start + max_chars) + 1 or start + max_chars
+            yield pending[start:end]
+            start = end
+        pending = pending[start:]
+    pending += decoder.decode('', True)
+    if pending:
+        yield pending
+
+class Sample(object):
+    """
+    The blocks of a large document that were kept, written to temporary files in TEXT_PATH until they are saved
+    as docset files for a job.
+
+    Attributes:
+        key -- result key of the sampled text.
+        blocks, chars -- blocks and characters in the whole document.
+        kept_blocks, kept_chars -- blocks and characters kept.
+        parts -- paths of the files the sample is written to.
+    """
+    def __init__(self):
+        self.key = None
+        self.blocks = self.chars = 0
+        self.kept_blocks = self.kept_chars = 0
+        self.parts = []
+
+    def describe(self):
+        """
+        Describe how the document was sampled.
+        """
+        if self.kept_blocks == self.blocks:
+            how = 'We used all {0:,} characters of your text'.format(self.chars)
+        else:
+            how = ('Your text has {0:,} characters, too many to analyse in one go, so we used {1:,} of its {2:,} '
+                   'passages ({3:.0%} of the text) spread evenly from start to finish').format(
+                self.chars, self.kept_blocks, self.blocks, float(self.kept_chars) / self.chars)
+        return '{0}, split into {1} document{2}.'.format(how, len(self.parts), '' if len(self.parts) == 1 else 's')
+
+    def save(self, name):
+        """
+        Give the sample's files the document names for the project with the passed name.
+
+        Returns the document names.
+        """
+        docs = []
+        for i, path in enumerate(self.parts):
+            doc = '{0}-{1}.txt'.format(name, i + 1)
+            os.rename(path, os.path.join(settings.TEXT_PATH, doc))
+            docs.append(doc)
+        self.parts = []
+        return docs
+
+    def discard(self):
+        """
+        Remove the sample's files.
+        """
+        for path in self.parts:
+            if os.path.exists(path):
+                os.remove(path)
+        self.parts = []
+
+def sample_blocks(blocks, total_chars, max_chars, sample):
+    """
+    Keep an evenly spaced selection of the passed blocks, about max_chars characters of a document with total_chars
+    characters, counting the blocks seen and kept in sample.
+
+    Each block earns credit in proportion to its length and is kept once enough has built up, so the kept blocks
+    are spread through the whole document in order.
+
+    Returns a generator of the kept blocks.
+    """
+    ratio = min(1.0, float(max_chars) / total_chars) if total_chars else 1.0
+    credit = 0.0
+    for block in blocks:
+        sample.blocks += 1
+        sample.chars += len(block)
+        credit += len(block) * ratio
+        if credit >= len(block) and sample.kept_chars + len(block) <= max_chars:
+            credit -= len(block)
+            sample.kept_blocks += 1
+            sample.kept_chars += len(block)
+            yield block
+
+def sample_upload(upload, conf=None):
+    """
+    Sample the passed uploaded file, a Django UploadedFile, reading it a chunk at a time.
+
+    The file's size in bytes stands in for its length in characters when working out the share of blocks to keep,
+    as it can't be known without reading the file twice.
+
+    Returns a Sample with its text written to temporary files in TEXT_PATH. Raises UploadError if the file is too
+    big.
+    """
+    conf = conf or get_config()
+    if upload.size > conf['MAX_UPLOAD_BYTES']:
+        raise UploadError(u'{0} is {1} bytes, the most accepted is {2}.'.format(upload.name, upload.size,
+                                                                              conf['MAX_UPLOAD_BYTES']))
+    if not os.path.exists(settings.TEXT_PATH):
+        os.makedirs(settings.TEXT_PATH)
+    sample = Sample()
+    key = cache.ResultKey()
+    part = None
+    part_chars = 0
+    try:
+        for block in sample_blocks(read_blocks(upload.chunks(), conf['BLOCK_CHARS']), upload.size,
+                                   conf['MAX_CHARS'], sample):
+            block = block.strip()
+            if not block:
+                continue
+            key.update(block)
+            if part is None or part_chars >= conf['PART_CHARS']:
+                if part is not None:
+                    part.close()
+                fd, path = tempfile.mkstemp(prefix='.sample', suffix='.part', dir=settings.TEXT_PATH)
+                sample.parts.append(path)
+                part = os.fdopen(fd, 'wb')
+                part_chars = 0
+            elif part_chars:
+                part.write('\n\n')
+            part.write(block.encode('ascii', 'ignore'))
+            part_chars += len(block)
+    except:
+        if part is not None:
+            part.close()
+        sample.discard()
+        raise
+    if part is not None:
+        part.close()
+    sample.key = key.hexdigest()
+    return sample
@@ -0,0 +1,216 @@
+"""
+Graph data for the Correlation Wheel and the Story Wheel, worked out once when a job finishes.
+
+The wheels used to rebuild their graphs in the browser from the concepts' related lists and the inverse
+prominence edges every time one was drawn. build does it on the server and the result is kept with the markers,
+so it is cached with them and sent once:
+
+order -- concept ids in the order the Correlation Wheel goes round, by theme and then weight.
+themes -- each theme's concepts, heaviest first, for the wheel's theme arcs.
+links -- the LINKS strongest (by prominence) related concept links the wheel draws, strongest first.
+related -- each concept's TOP_RELATED most prominent related concepts.
+story -- the inverse prominence tree the Story Wheel draws, as nested nodes.
+
+Edges are sorted with NumPy when it is installed and in Python otherwise, with the same results.
+"""
+import logging
+from django.conf import settings
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger('tib')
+
+DEFAULTS = {
+    # Work the graphs out when jobs finish
+    'ENABLED': True,
+    # Links the Correlation Wheel draws
+    'LINKS': 200,
+    # Related concepts kept for each concept
+    'TOP_RELATED': 10,
+}
+
+def get_config():
+    """
+    Get the wheel graph settings, settings.WHEEL_GRAPHS overrides DEFAULTS.
+    """
+    conf = dict(DEFAULTS)
+    conf.update(getattr(settings, 'WHEEL_GRAPHS', {}))
+    return conf
+
+def theme_id(concept):
+    """
+    Get a concept's theme id as a number, or None if it isn't in a theme.
+    """
+    tid = concept.get('themeId')
+    return None if tid is None else int(tid)
+
+def wheel_order(concepts):
+    """
+    Order the concepts as the Correlation Wheel places them: by theme, heaviest first within a theme, with
+    concepts outside any theme last.
+
+    Returns a list of concept ids.
+    """
+    def key(concept):
+        tid = theme_id(concept)
+        return (tid is None, tid, -concept['weight'], concept['id'])
+    return [concept['id'] for concept in sorted(concepts.itervalues(), key=key)]
+
+def theme_groups(concepts, order):
+    """
+    Group the concepts in wheel order by theme.
+
+    Returns a dict of the theme ids, in order, and the ids of each theme's concepts.
+    """
+    groups = {'id': [], 'concepts': []}
+    for id in order:
+        tid = theme_id(concepts[id])
+        if tid is None:
+            continue
+        if not groups['id'] or groups['id'][-1] != tid:
+            groups['id'].append(tid)
+            groups['concepts'].append([])
+        groups['concepts'][-1].append(id)
+    return groups
+
+def related_edges(concepts):
+    """
+    List every related concept link, concept by concept in id order, leaving out links to concepts that aren't in
+    the markers.
+
+    Returns a dict of columns: source, target, prom, strength and count.
+    """
+    edges = {'source': [], 'target': [], 'prom': [], 'strength': [], 'count': []}
+    for id in sorted(concepts):
+        for rel in concepts[id].get('related', ()):
+            target = int(rel['id'])
+            if target not in concepts:
+                continue
+            edges['source'].append(id)
+            edges['target'].append(target)
+            edges['prom'].append(float(rel['prom']))
+            edges['strength'].append(float(rel['strength']))
+            edges['count'].append(int(rel['count']))
+    return edges
+
+def strongest_first(edges):
+    """
+    Get the positions of the edges sorted by prominence, strongest first. Equally prominent edges keep their order.
+    """
+    if numpy is not None:
+        return numpy.argsort(-numpy.array(edges['prom'], dtype=float), kind='mergesort').tolist()
+    prom = edges['prom']
+    return sorted(xrange(len(prom)), key=lambda i: -prom[i])
+
+def top_links(edges, count):
+    """
+    Get the count most prominent edges, strongest first.
+
+    Returns a dict of columns as related_edges gives.
+    """
+    keep = strongest_first(edges)[:count]
+    return dict((column, [values[i] for i in keep]) for column, values in edges.iteritems())
+
+def top_related(concepts, edges, count):
+    """
+    Get each concept's count most prominent related concepts.
+
+    Returns a dict of the concept ids, in id order, and the ids of each one's top related concepts, most prominent
+    first.
+    """
+    top = dict((id, []) for id in concepts)
+    if numpy is not None and edges['source']:
+        source = numpy.array(edges['source'])
+        target = numpy.array(edges['target'])
+        # lexsort is stable and sorts by its last key first: by source, then strongest first
+        ordered = numpy.lexsort((-numpy.array(edges['prom'], dtype=float), source))
+        source, target = source[ordered], target[ordered]
+        # Each edge's position within its source's run
+        starts = numpy.flatnonzero(numpy.r_[True, source[1:] != source[:-1]])
+        lengths = numpy.diff(numpy.r_[starts, len(source)])
+        rank = numpy.arange(len(source)) - numpy.repeat(starts, lengths)
+        keep = rank < count
+        for id, rel in zip(source[keep].tolist(), target[keep].tolist()):
+            top[id].append(rel)
+    else:
+        for i in strongest_first(edges):
+            rels = top[edges['source'][i]]
+            if len(rels) < count:
+                rels.append(edges['target'][i])
+    ids = sorted(top)
+    return {'id': ids, 'top': [top[id] for id in ids]}
+
+def story_tree(concepts, iprom):
+    """
+    Build the inverse prominence tree from its edges. Each node has the concept's name, the weight of the edge
+    into it and its children in edge order. The root is the first concept that no edge goes to.
+
+    Returns the root node, or None if there are no edges.
+    """
+    children = {}
+    weights = {}
+    for edge in iprom:
+        children.setdefault(edge['from'], []).append(edge['to'])
+        weights[edge['to']] = edge['weight']
+    roots = [edge['from'] for edge in iprom if edge['from'] not in weights]
+    if not roots:
+        return None
+
+    def node(id):
+        concept = concepts.get(id)
+        return {'name': concept['value'] if concept else None, 'children': []}
+    root = node(roots[0])
+    # Iterative, trees can be deeper than the recursion limit. Edges back into the tree are ignored.
+    seen = set([roots[0]])
+    stack = [(roots[0], root)]
+    while stack:
+        id, tree = stack.pop()
+        for child in children.get(id, ()):
+            if child in seen:
+                continue
+            seen.add(child)
+            subtree = node(child)
+            subtree['weight'] = weights[child]
+            tree['children'].append(subtree)
+            stack.append((child, subtree))
+    return root
+
+def build(markers, conf=None):
+    """
+    Work out the wheels' graph data for the markers.
+
+    Returns a dict, as described at the top of the module.
+    """
+    if conf is None:
+        conf = get_config()
+    concepts = markers['concepts']
+    order = wheel_order(concepts)
+    edges = related_edges(concepts)
+    return {
+        'order': order,
+        'themes': theme_groups(concepts, order),
+        'links': top_links(edges, conf['LINKS']),
+        'related': top_related(concepts, edges, conf['TOP_RELATED']),
+        'story': story_tree(concepts, markers['iprom']),
+    }
+
+def add_graph(key, markers):
+    """
+    Work out the wheels' graph data for the markers of the passed result key and keep it in markers['graph'],
+    unless it is already there or turned off. Failures are logged rather than raised, the browser can still
+    build the graphs itself.
+
+    Returns true if the graph data was added.
+    """
+    conf = get_config()
+    if not conf['ENABLED'] or 'graph' in markers:
+        return False
+    try:
+        markers['graph'] = build(markers, conf)
+    except Exception as err:
+        logger.warning('Could not build the wheel graphs of {0}: {1}'.format(key, err))
+        return False
+    return True
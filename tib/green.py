@@ -0,0 +1,66 @@
+"""
+Keep blocking calls off the gevent hub.
+
+gunicorn runs the site with gevent workers (config/gunicorn.conf), where every request is a greenlet on one hub.
+sqlite3 waits for locks and the disk inside C, where gevent can't switch to another greenlet, so a store call
+waiting on BEGIN IMMEDIATE would stall every request the worker has open. Stores wrapped with threaded() run their
+calls on a small pool of real threads instead and the calling greenlet waits cooperatively. Each pool thread keeps
+its own sqlite3 connection, so connections are opened once per thread rather than once per request greenlet.
+
+Outside gevent (the job workers, manage.py, the tests) everything is called directly.
+"""
+import os
+
+try:
+    import gevent.monkey
+    import gevent.threadpool
+except ImportError:
+    gevent = None
+
+# Threads (and so sqlite3 connections) per web worker process for store calls
+THREADS = 4
+
+_pool = None
+_pool_pid = None
+
+def patched():
+    """
+    Return true if gevent has monkey patched threading in this process, as it has in gunicorn's gevent workers.
+    """
+    return gevent is not None and gevent.monkey.is_module_patched('threading')
+
+def _get_pool():
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = gevent.threadpool.ThreadPool(THREADS)
+        _pool_pid = os.getpid()
+    return _pool
+
+def call(fn, *args, **kwargs):
+    """
+    Call fn(*args, **kwargs) on the thread pool if gevent is patched in, otherwise call it directly.
+    """
+    if not patched():
+        return fn(*args, **kwargs)
+    return _get_pool().apply(fn, args, kwargs)
+
+class ThreadedProxy(object):
+    """
+    Wrap an object so its methods are run with call(). Other attributes are read from the object as they are.
+    """
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+        def method(*args, **kwargs):
+            return call(attr, *args, **kwargs)
+        return method
+
+def threaded(target):
+    """
+    Wrap target in a ThreadedProxy if gevent is patched in, otherwise return it as it is.
+    """
+    return ThreadedProxy(target) if patched() else target
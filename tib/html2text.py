@@ -33,7 +33,7 @@ except:
     import urllib
 import optparse, re, sys, codecs, types
 
-try: from textwrap import wrap
+try: from textwrap import wrap, TextWrapper
 except: pass
 
 # Use Unicode characters instead of their ascii psuedo-replacements
@@ -90,7 +90,7 @@ def charref(name):
     else:
         c = int(name)
     
-    if not UNICODE_SNOB and c in unifiable_n.keys():
+    if not UNICODE_SNOB and c in unifiable_n:
         return unifiable_n[c]
     else:
         try:
@@ -99,7 +99,7 @@ def charref(name):
             return chr(c)
 
 def entityref(c):
-    if not UNICODE_SNOB and c in unifiable.keys():
+    if not UNICODE_SNOB and c in unifiable:
         return unifiable[c]
     else:
         try: name2cp(c)
@@ -116,6 +116,8 @@ def replaceEntities(s):
         return charref(s[1:])
     else: return entityref(s)
 
+r_whitespace = re.compile(r"\s+")
+
 r_unescape = re.compile(r"&(#?[xX]?(?:[0-9a-fA-F]+|\w{1,8}));")
 def unescape(s):
     return r_unescape.sub(replaceEntities, s)
@@ -129,36 +131,54 @@ def onlywhite(line):
             return c is ' '
     return line
 
+# Whitespace that textwrap expands or replaces, so a line containing it can't skip wrap()
+r_wrap_whitespace = re.compile(r"[\t\n\x0b\x0c\r]")
+
+_wrapper = None
+
+def get_wrapper():
+    """Get a TextWrapper for BODY_WIDTH, reused across paragraphs and calls."""
+    global _wrapper
+    if _wrapper is None or _wrapper.width != BODY_WIDTH:
+        _wrapper = TextWrapper(BODY_WIDTH)
+    return _wrapper
+
 def optwrap(text):
     """Wrap all paragraphs in the provided text."""
     if not BODY_WIDTH:
         return text
     
     assert wrap, "Requires Python 2.3."
-    result = ''
+    wrapper = get_wrapper()
+    result = []
     newlines = 0
     for para in text.split("\n"):
         if len(para) > 0:
             if para[0] != ' ' and para[0] != '-' and para[0] != '*':
-                for line in wrap(para, BODY_WIDTH):
-                    result += line + "\n"
-                result += "\n"
+                # A paragraph that already fits comes back from wrap() as is, less trailing spaces
+                short = para.rstrip(' ')
+                if len(para) <= BODY_WIDTH and short == para.rstrip() and not r_wrap_whitespace.search(para):
+                    result.append(short + "\n")
+                else:
+                    for line in wrapper.wrap(para):
+                        result.append(line + "\n")
+                result.append("\n")
                 newlines = 2
             else:
                 if not onlywhite(para):
-                    result += para + "\n"
+                    result.append(para + "\n")
                     newlines = 1
         else:
             if newlines < 2:
-                result += "\n"
+                result.append("\n")
                 newlines += 1
-    return result
+    return ''.join(result)
 
 def hn(tag):
     if tag[0] == 'h' and len(tag) == 2:
         try:
             n = int(tag[1])
-            if n in range(1, 10): return n
+            if 1 <= n <= 9: return n
         except ValueError: return 0
 
 def dumb_property_dict(style):
@@ -429,16 +449,17 @@ class _html2text(HTMLParser.HTMLParser):
                 if self.tag_stack:
                     parent_style = self.tag_stack[-1][2]
 
-        if hn(tag):
+        n = hn(tag)
+        if n:
             self.p()
             if start:
                 self.inheader = True
-                self.o(hn(tag)*"#" + ' ')
+                self.o(n*"#" + ' ')
             else:
                 self.inheader = False
                 return # prevent redundant emphasis marks on headers
 
-        if tag in ['p', 'div']:
+        if tag in ('p', 'div'):
             if options.google_doc:
                 if start and google_has_height(tag_style):
                     self.p()
@@ -454,7 +475,7 @@ class _html2text(HTMLParser.HTMLParser):
             self.o("* * *")
             self.p()
 
-        if tag in ["head", "style", 'script']: 
+        if tag in ('head', 'style', 'script'): 
             if start: self.quiet += 1
             else: self.quiet -= 1
 
@@ -462,7 +483,7 @@ class _html2text(HTMLParser.HTMLParser):
             if start: self.style += 1
             else: self.style -= 1
 
-        if tag in ["body"]:
+        if tag == "body":
             self.quiet = 0 # sites like 9rules.com never close <head>
         
         if tag == "blockquote":
@@ -475,7 +496,7 @@ class _html2text(HTMLParser.HTMLParser):
         
 #        if tag in ['em', 'i', 'u']: self.o("_")
 #        if tag in ['strong', 'b']: self.o("**")
-        if tag in ['del', 'strike']:
+        if tag in ('del', 'strike'):
             if start:                                                           
                 self.o("<"+tag+">")
             else:
@@ -550,7 +571,7 @@ class _html2text(HTMLParser.HTMLParser):
         if tag == 'dd' and start: self.o('    ')
         if tag == 'dd' and not start: self.pbr()
         
-        if tag in ["ol", "ul"]:
+        if tag in ('ol', 'ul'):
             # Google Docs create sub lists as top level lists
             if (not self.list) and (not self.lastWasList):
                 self.p()
@@ -583,7 +604,7 @@ class _html2text(HTMLParser.HTMLParser):
                     self.o(str(li['num'])+". ")
                 self.start = 1
         
-        if tag in ["table", "tr"] and start: self.p()
+        if tag in ('table', 'tr') and start: self.p()
         if tag == 'td': self.pbr()
         
         if tag == "pre":
@@ -616,7 +637,7 @@ class _html2text(HTMLParser.HTMLParser):
                     self.drop_white_space = 0
             
             if puredata and not self.pre:
-                data = re.sub('\s+', ' ', data)
+                data = r_whitespace.sub(' ', data)
                 if data and data[0] == ' ':
                     self.space = 1
                     data = data[1:]
@@ -687,6 +708,70 @@ class _html2text(HTMLParser.HTMLParser):
     
     def unknown_decl(self, data): pass
 
+# Tags that end the current paragraph in plain text output
+PLAIN_BLOCK_TAGS = frozenset(['p', 'div', 'br', 'hr', 'blockquote', 'pre', 'ol', 'ul', 'li', 'dl', 'dt', 'dd',
+                              'table', 'tr', 'td', 'th', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'h7', 'h8', 'h9'])
+
+# Tags whose content is never text
+PLAIN_QUIET_TAGS = frozenset(['head', 'style', 'script'])
+
+class _html2plain(HTMLParser.HTMLParser):
+    """
+    Fast text only conversion. Keeps the text content and paragraph breaks and nothing else, so there's no link,
+    emphasis or list bookkeeping, no Markdown punctuation and no wrapping.
+    """
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.paras = []
+        self.para = []
+        self.quiet = 0
+
+    def feed(self, data):
+        data = data.replace("</' + 'script>", "</ignore>")
+        HTMLParser.HTMLParser.feed(self, data)
+
+    def close(self):
+        HTMLParser.HTMLParser.close(self)
+        self.end_para()
+        if not self.paras:
+            return u''
+        return u'\n\n'.join(self.paras) + u'\n'
+
+    def end_para(self):
+        if self.para:
+            text = u' '.join(u''.join(self.para).split())
+            if text:
+                self.paras.append(text)
+            self.para = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in PLAIN_BLOCK_TAGS: self.end_para()
+        elif tag in PLAIN_QUIET_TAGS: self.quiet += 1
+        elif tag == 'body': self.quiet = 0 # sites like 9rules.com never close <head>
+
+    def handle_endtag(self, tag):
+        if tag in PLAIN_BLOCK_TAGS: self.end_para()
+        elif tag in PLAIN_QUIET_TAGS and self.quiet: self.quiet -= 1
+
+    def handle_data(self, data):
+        if not self.quiet: self.para.append(data)
+
+    def handle_charref(self, c):
+        if not self.quiet: self.para.append(charref(c))
+
+    def handle_entityref(self, c):
+        if not self.quiet: self.para.append(entityref(c))
+
+    def unknown_decl(self, data): pass
+
+def html2plain(html):
+    """
+    Convert HTML to plain text: the text content with a blank line between paragraphs.
+    """
+    h = _html2plain()
+    h.feed(html)
+    return h.close()
+
 def wrapwrite(text):
     text = text.encode('utf-8')
     try: #Python3
@@ -0,0 +1,291 @@
+"""
+Shared, keep-alive HTTP connections for Leximancer and outbound fetches.
+
+Each gunicorn worker gets one HttpPool. It hands out httplib2.Http objects (which keep their connections
+open and remember credentials once the server has challenged for them) so requests don't pay for a new TCP
+connection and an extra authentication round trip every time.
+
+httplib2 reads every response whole, so fetches that stream their responses (see tib.wikipedia) keep their
+connections in a ConnectionPool instead.
+"""
+import httplib
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import urllib
+import urlparse
+import Queue
+from django.conf import settings
+import httplib2
+
+logger = logging.getLogger('tib')
+
+# Methods that are safe to send again after a failure
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+# Statuses worth retrying on, the server is overloaded or restarting
+RETRY_STATUSES = (502, 503, 504)
+
+# Methods whose params rest_invoke sends in the query string itself
+QUERY_METHODS = ('GET', 'HEAD', 'DELETE')
+
+DEFAULTS = {
+    'SIZE': 8,
+    'TIMEOUT': 30,
+    'RETRIES': 2,
+    'BACKOFF': 0.5,
+}
+
+class PoolTimeout(StandardError):
+    """
+    Exception thrown when no connection becomes free in time.
+
+    Attributes:
+        msg -- explanation of the error.
+    """
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return repr(self.msg)
+
+class HttpPool(object):
+    """
+    A thread safe pool of httplib2.Http objects.
+
+    size -- most Http objects (and so connections per host) handed out at once.
+    timeout -- socket timeout in seconds, also how long to wait for a free connection.
+    retries -- how many times to retry a failed idempotent request.
+    backoff -- seconds to wait before the first retry, doubled for each one after.
+    """
+    def __init__(self, size=8, timeout=30, retries=2, backoff=0.5):
+        self.size = size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._idle = Queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'reused': 0, 'opened': 0, 'retries': 0, 'errors': 0}
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                http = httplib2.Http(timeout=self.timeout)
+                http.credential_sets = set()
+                return http
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except Queue.Empty:
+            raise PoolTimeout('No HTTP connection became free within {0}s.'.format(self.timeout))
+
+    def _checkin(self, http):
+        self._idle.put(http)
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        """
+        Get the request counters. 'reused' counts requests sent on an already open connection, 'opened'
+        counts the ones that needed a new connection.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats['size'] = self.size
+        stats['created'] = self._created
+        return stats
+
+    def request(self, url, method='GET', body=None, headers=None, auth=None):
+        """
+        Make a request using a pooled connection.
+
+        auth is a (user, password) tuple. Returns the httplib2 (response, content) tuple.
+        """
+        scheme, authority = urlparse.urlsplit(url)[:2]
+        conn_key = '{0}:{1}'.format(scheme, authority)
+        http = self._checkout()
+        try:
+            if auth is not None and auth not in http.credential_sets:
+                http.add_credentials(*auth)
+                http.credential_sets.add(auth)
+            attempt = 0
+            while True:
+                conn = http.connections.get(conn_key)
+                reused = conn is not None and conn.sock is not None
+                try:
+                    resp, content = http.request(url, method, body=body, headers=headers)
+                except (socket.error, httplib.HTTPException, httplib2.HttpLib2Error):
+                    self._count('errors')
+                    if attempt >= self.retries or method not in IDEMPOTENT_METHODS:
+                        raise
+                else:
+                    self._count('requests')
+                    self._count('reused' if reused else 'opened')
+                    if resp.status not in RETRY_STATUSES or attempt >= self.retries or method not in IDEMPOTENT_METHODS:
+                        return resp, content
+                self._count('retries')
+                time.sleep(self.backoff * (2 ** attempt))
+                attempt += 1
+        finally:
+            self._checkin(http)
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """
+    Get the HTTP pool for this process, configured from settings.HTTP_POOL.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        # Don't share sockets with a parent we were forked from
+        if _pool is None or _pool_pid != os.getpid():
+            conf = dict(DEFAULTS)
+            conf.update(getattr(settings, 'HTTP_POOL', {}))
+            _pool = HttpPool(conf['SIZE'], conf['TIMEOUT'], conf['RETRIES'], conf['BACKOFF'])
+            _pool_pid = os.getpid()
+        return _pool
+
+class ConnectionPool(object):
+    """
+    A thread safe pool of idle keep-alive httplib connections, for requests that read their responses as they
+    arrive. A connection only goes back in the pool once its response has been read to the end.
+
+    size -- most idle connections kept for each host.
+    """
+    def __init__(self, size=8):
+        self.size = size
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._stats = {'reused': 0, 'opened': 0, 'kept': 0, 'closed': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        """
+        Get the connection counters. 'reused' counts idle connections handed out again and 'opened' new ones,
+        'kept' the connections given back that went into the pool and 'closed' those that couldn't.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = sum(len(idle) for idle in self._idle.itervalues())
+        stats['size'] = self.size
+        return stats
+
+    def get(self, scheme, host, timeout, reuse=True):
+        """
+        Get a connection to host, an idle one if there is one and reuse is true.
+
+        Returns a tuple of the connection and true if it is an idle one, which the server may have closed since.
+        """
+        conn = None
+        if reuse:
+            with self._lock:
+                idle = self._idle.get((scheme, host))
+                conn = idle.pop() if idle else None
+        if conn is not None:
+            self._count('reused')
+            conn.timeout = timeout
+            conn.sock.settimeout(timeout)
+            return conn, True
+        self._count('opened')
+        connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        conn = connection_class(host, timeout=timeout)
+        conn.pool_key = (scheme, host)
+        return conn, False
+
+    def put(self, conn, resp):
+        """
+        Give back a connection from get and its last response. It is kept if the response has been read to the end
+        and neither side asked to close the connection, and closed otherwise.
+        """
+        if resp.isclosed() and not resp.will_close and conn.sock is not None:
+            with self._lock:
+                idle = self._idle.setdefault(conn.pool_key, [])
+                if len(idle) < self.size:
+                    idle.append(conn)
+                    self._stats['kept'] += 1
+                    return
+        self._count('closed')
+        resp.close()
+        conn.close()
+
+    def clear(self):
+        """
+        Close every idle connection.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.itervalues():
+            for conn in conns:
+                conn.close()
+
+_connections = None
+_connections_pid = None
+
+def get_connection_pool():
+    """
+    Get the streaming connection pool for this process, holding up to HTTP_POOL['SIZE'] connections per host.
+    """
+    global _connections, _connections_pid
+    with _pool_lock:
+        if _connections is None or _connections_pid != os.getpid():
+            conf = dict(DEFAULTS)
+            conf.update(getattr(settings, 'HTTP_POOL', {}))
+            _connections = ConnectionPool(conf['SIZE'])
+            _connections_pid = os.getpid()
+        return _connections
+
+# lexrestclient's own rest_invoke, found by install_lexrestclient
+_lexrestclient_invoke = None
+
+def rest_invoke(url, method='GET', params=None, body=None, headers=None, auth=None):
+    """
+    Drop in replacement for lexrestclient's rest_invoke that goes through the pool.
+
+    params of GET, HEAD and DELETE requests are sent in the query string. Other requests with params are handed to
+    lexrestclient's own rest_invoke, which decides where their params go.
+    """
+    if params:
+        if method not in QUERY_METHODS and _lexrestclient_invoke is not None:
+            return _lexrestclient_invoke(url, method=method, params=params, body=body, headers=headers, auth=auth)
+        url = '{0}{1}{2}'.format(url, '&' if '?' in url else '?', urllib.urlencode(params))
+    return get_pool().request(url, method, body=body, headers=headers, auth=auth)
+
+def install_lexrestclient():
+    """
+    Route lexrestclient's requests through the pool by replacing rest_invoke in every loaded lexrestclient
+    module, keeping the original for the requests rest_invoke leaves to it.
+    """
+    global _lexrestclient_invoke
+    for name, module in sys.modules.items():
+        if module is not None and name.split('.')[0] == 'lexrestclient' and hasattr(module, 'rest_invoke'):
+            if module.rest_invoke is not rest_invoke:
+                _lexrestclient_invoke = _lexrestclient_invoke or module.rest_invoke
+                module.rest_invoke = rest_invoke
+
+def log_stats():
+    """
+    Log the counters of this process's pools, to see how often connections are reused.
+    """
+    stats = get_pool().stats()
+    logger.info('HTTP pool: {0} requests, {1} on open connections, {2} on new ones, {3} retries, '
+                '{4} errors, {5} of {6} connections made.'.format(stats['requests'], stats['reused'], stats['opened'],
+                                                                  stats['retries'], stats['errors'], stats['created'],
+                                                                  stats['size']))
+    stats = get_connection_pool().stats()
+    logger.info('Streaming connection pool: {0} reused, {1} opened, {2} kept after use, {3} closed, '
+                '{4} idle.'.format(stats['reused'], stats['opened'], stats['kept'], stats['closed'], stats['idle']))
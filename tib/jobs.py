@@ -0,0 +1,760 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from django.conf import settings
+from tib import cache
+from tib import cloud
+from tib import graph
+from tib import green
+from tib import httppool
+from tib import inflight
+from tib import payload
+from tib import snapshots
+from tib import utils
+from tib import wikipedia
+
+logger = logging.getLogger('tib')
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+ACTIVE_STATES = (QUEUED, RUNNING)
+
+# Range of text lengths, in characters, that Leximancer is given
+MIN_TEXT_LENGTH = 5000
+MAX_TEXT_LENGTH = 105000
+
+DEFAULTS = {
+    # SQLite database holding the queue, shared by the web and worker processes
+    'PATH': '/var/tib/jobs.db',
+    # Number of worker processes started by the lexworkers command
+    'WORKERS': 4,
+    # Steps each worker process runs at once, each on its own thread. A step is nearly all waiting on Leximancer,
+    # so one process can keep several projects going.
+    'CONCURRENCY': 1,
+    # Most projects running on the Leximancer servers at once
+    'MAX_RUNNING': 8,
+    # Most projects running at once for one client IP, their other jobs wait in the queue
+    'MAX_PER_CLIENT': 2,
+    # Most jobs waiting to start. Submissions past this are turned away with a 503 and told to come back
+    # in RETRY_AFTER seconds.
+    'MAX_QUEUED': 200,
+    'RETRY_AFTER': 60,
+    # Seconds between status checks of a running project, by the stage it is in. The early stages are quick
+    # so are checked often, LEARN and CLUSTER take minutes on big texts so there is no point asking as much.
+    # POLL_INTERVAL covers stages not listed and the first check after the project is created.
+    'POLL_INTERVAL': 5,
+    'POLL_INTERVALS': {
+        'PREPROCESS': 2,
+        'TEXTSTATS': 2,
+        'REMOVE_LOW_FREQ': 2,
+        'INDEX': 3,
+        'FINDSEEDS': 3,
+        'LEARN': 10,
+        'CLASSIFY': 5,
+        'CLUSTER': 10,
+    },
+    # Attempts at a step before the job is failed, and the seconds before the first retry (doubled each time)
+    'MAX_ATTEMPTS': 3,
+    'RETRY_BACKOFF': 10,
+    # Seconds a worker owns a job for. If it dies the job is picked up again after this.
+    'LEASE': 300,
+    # Seconds finished jobs are kept for status to report on
+    'KEEP_FINISHED': 60 * 60 * 24,
+    # Seconds before a file in TEXT_PATH no job is using is swept away
+    'TEXT_MAX_AGE': 60 * 60 * 24,
+    # Seconds between logging how often each worker's HTTP connections are reused
+    'STATS_INTERVAL': 60 * 10,
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    key TEXT NOT NULL,
+    doc TEXT NOT NULL,
+    state TEXT NOT NULL,
+    stage TEXT,
+    progress INTEGER NOT NULL DEFAULT 0,
+    message TEXT,
+    project_url TEXT,
+    server TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    next_run REAL NOT NULL,
+    locked_until REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, state);
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs (state, next_run);
+CREATE TABLE IF NOT EXISTS batches (
+    id TEXT PRIMARY KEY,
+    items TEXT NOT NULL,
+    client TEXT,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fetches (
+    batch TEXT NOT NULL,
+    item INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    client TEXT,
+    created REAL NOT NULL,
+    locked_until REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (batch, item)
+);
+CREATE TABLE IF NOT EXISTS backfills (
+    key TEXT PRIMARY KEY,
+    created REAL NOT NULL
+);
+"""
+
+# Columns added since the jobs table was first created, added to existing databases on start up
+ADDED_COLUMNS = (
+    ('server', 'TEXT'),
+    ('client', 'TEXT'),
+    ('text', 'TEXT'),
+    ('uploaded', 'INTEGER NOT NULL DEFAULT 0'),
+)
+
+# Every column but the submitted text, which only the step that creates the project needs
+COLUMNS = ('id, key, doc, state, stage, progress, message, project_url, server, client, uploaded, attempts, created, '
+           'updated, next_run, locked_until')
+
+# Indexes on added columns, created once the columns exist
+ADDED_INDEXES = """
+CREATE INDEX IF NOT EXISTS jobs_client ON jobs (client, state);
+"""
+
+class QueueFull(Exception):
+    """
+    Exception thrown when a job can't be queued because the queue is full.
+
+    Attributes:
+        msg -- explanation of the error.
+        retry_after -- seconds the client should wait before trying again.
+    """
+    def __init__(self, msg, retry_after):
+        self.msg = msg
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return repr(self.msg)
+
+def text_length_ok(text):
+    """
+    Return true if the passed text is within the range of lengths Leximancer is given.
+    """
+    return MIN_TEXT_LENGTH <= len(text) <= MAX_TEXT_LENGTH
+
+def get_config():
+    """
+    Get the job settings, settings.JOBS overrides DEFAULTS.
+    """
+    conf = dict(DEFAULTS)
+    conf.update(getattr(settings, 'JOBS', {}))
+    return conf
+
+class JobStore(object):
+    """
+    Persistent job queue kept in a SQLite database.
+
+    The web processes only add jobs and read them back. Worker processes claim due jobs, drive them through
+    the Leximancer project lifecycle and write the progress back.
+    """
+    def __init__(self, path, max_running=8, lease=300, max_per_client=None, max_queued=None, retry_after=60):
+        self.path = path
+        self.max_running = max_running
+        self.lease = lease
+        self.max_per_client = max_per_client
+        self.max_queued = max_queued
+        self.retry_after = retry_after
+        self._local = threading.local()
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        conn = self._connection()
+        conn.executescript(SCHEMA)
+        columns = set(row['name'] for row in conn.execute('PRAGMA table_info(jobs)'))
+        for name, type in ADDED_COLUMNS:
+            if name not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN {0} {1}'.format(name, type))
+        conn.executescript(ADDED_INDEXES)
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _transaction(self, fn, *args):
+        # BEGIN IMMEDIATE takes the write lock up front so read-then-write can't race other processes
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = fn(conn, *args)
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return result
+
+    def join(self, key):
+        """
+        Join the queued or running job for the text with the passed result key.
+
+        Returns its id, or None if there isn't one.
+        """
+        row = self._connection().execute('SELECT id FROM jobs WHERE key = ? AND state IN (?, ?)',
+                                         (key,) + ACTIVE_STATES).fetchone()
+        return row['id'] if row else None
+
+    def add(self, key, doc, client=None, text=None):
+        """
+        Queue a job for the document with the passed result key, submitted from the passed client IP. The text is
+        kept with the job if it is passed, otherwise doc is a file in TEXT_PATH. doc can also be several
+        files separated by spaces, the parts of a large document.
+
+        Returns a tuple of the job id and whether a new job was created. If an identical job is already
+        queued or running its id is returned instead, so identical submissions share one Leximancer project.
+        Raises QueueFull if max_queued jobs are already waiting.
+        """
+        def add(conn):
+            row = conn.execute('SELECT id FROM jobs WHERE key = ? AND state IN (?, ?)', (key,) + ACTIVE_STATES).fetchone()
+            if row:
+                return row['id'], False
+            if self.max_queued is not None:
+                queued = conn.execute('SELECT COUNT(*) FROM jobs WHERE state = ?', (QUEUED,)).fetchone()[0]
+                if queued >= self.max_queued:
+                    raise QueueFull('The queue is full ({0} jobs waiting).'.format(queued), self.retry_after)
+            id = uuid.uuid4().hex
+            now = time.time()
+            conn.execute('INSERT INTO jobs (id, key, doc, state, client, text, created, updated, next_run) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (id, key, doc, QUEUED, client, text, now, now, now))
+            return id, True
+        return self._transaction(add)
+
+    def get(self, id):
+        """
+        Get the job with the passed id as a dict, or None.
+        """
+        row = self._connection().execute('SELECT {0} FROM jobs WHERE id = ?'.format(COLUMNS), (id,)).fetchone()
+        return dict(row) if row else None
+
+    def get_many(self, ids):
+        """
+        Get the jobs with the passed ids as a dict of id to job dict. Ids that aren't found are left out.
+        """
+        jobs = {}
+        ids = list(ids)
+        # SQLite allows 999 parameters a statement
+        for i in xrange(0, len(ids), 900):
+            chunk = ids[i:i + 900]
+            for row in self._connection().execute('SELECT {0} FROM jobs WHERE id IN ({1})'.format(
+                    COLUMNS, ', '.join('?' * len(chunk))), chunk):
+                jobs[row['id']] = dict(row)
+        return jobs
+
+    def add_batch(self, items, client=None, fetches=()):
+        """
+        Record a batch of submissions from the passed client IP. items is a list of dicts, each with the id of the
+        job (or result key) for one submission, or the error it was turned away with. fetches is a list of
+        (index, url) tuples for the items whose Wikipedia articles the workers are to fetch and queue, see
+        claim_fetch.
+
+        Returns the batch id.
+        """
+        def add(conn):
+            id = uuid.uuid4().hex
+            now = time.time()
+            conn.execute('INSERT INTO batches (id, items, client, created) VALUES (?, ?, ?, ?)',
+                         (id, json.dumps(items), client, now))
+            conn.executemany('INSERT INTO fetches (batch, item, url, client, created) VALUES (?, ?, ?, ?, ?)',
+                             [(id, index, url, client, now) for index, url in fetches])
+            return id
+        return self._transaction(add)
+
+    def get_batch(self, id):
+        """
+        Get the list of items in the batch with the passed id, or None.
+        """
+        row = self._connection().execute('SELECT items FROM batches WHERE id = ?', (id,)).fetchone()
+        return json.loads(row['items']) if row else None
+
+    def claim_fetch(self):
+        """
+        Take the lease on the oldest batch item waiting to have its article fetched, or return None if there isn't
+        one. The item is handed out again if finish_fetch isn't called before the lease runs out.
+        """
+        def claim(conn):
+            now = time.time()
+            row = conn.execute('SELECT batch, item, url, client FROM fetches WHERE locked_until < ? ORDER BY created '
+                               'LIMIT 1', (now,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE fetches SET locked_until = ? WHERE batch = ? AND item = ?',
+                         (now + self.lease, row['batch'], row['item']))
+            return dict(row)
+        return self._transaction(claim)
+
+    def finish_fetch(self, batch, index, item):
+        """
+        Record what became of a fetched batch item, a dict like those add_batch takes.
+        """
+        def finish(conn):
+            row = conn.execute('SELECT items FROM batches WHERE id = ?', (batch,)).fetchone()
+            if row is not None:
+                items = json.loads(row['items'])
+                items[index] = item
+                conn.execute('UPDATE batches SET items = ? WHERE id = ?', (json.dumps(items), batch))
+            conn.execute('DELETE FROM fetches WHERE batch = ? AND item = ?', (batch, index))
+        self._transaction(finish)
+
+    def add_backfill(self, key):
+        """
+        Ask for the cached result with the passed key to be brought up to date, once however often it is asked.
+        """
+        self._connection().execute('INSERT OR IGNORE INTO backfills (key, created) VALUES (?, ?)', (key, time.time()))
+
+    def take_backfill(self):
+        """
+        Take the oldest result key waiting to be brought up to date, or return None if there isn't one.
+        """
+        def take(conn):
+            row = conn.execute('SELECT key FROM backfills ORDER BY created LIMIT 1').fetchone()
+            if row is None:
+                return None
+            conn.execute('DELETE FROM backfills WHERE key = ?', (row['key'],))
+            return row['key']
+        return self._transaction(take)
+
+    def get_text(self, id):
+        """
+        Get the text submitted with the job with the passed id, or None if it wasn't kept with the job.
+        """
+        row = self._connection().execute('SELECT text FROM jobs WHERE id = ?', (id,)).fetchone()
+        return row['text'] if row else None
+
+    def active_docs(self):
+        """
+        Get the set of documents queued or running jobs are using.
+        """
+        docs = set()
+        for row in self._connection().execute('SELECT doc FROM jobs WHERE state IN (?, ?)', ACTIVE_STATES):
+            docs.update(row['doc'].split())
+        return docs
+
+    def queue_position(self, job):
+        """
+        Get the passed queued job's place in the queue, 1 being next. Jobs whose projects are being created (a
+        worker holds their lease) have left the queue, so aren't counted and such a job is at 0.
+        """
+        return self._connection().execute('SELECT COUNT(*) FROM jobs WHERE state = ? AND created <= ? AND '
+                                          'locked_until < ?', (QUEUED, job['created'], time.time())).fetchone()[0]
+
+    def claim(self):
+        """
+        Take the lease on the next job that needs work, or return None if nothing is due.
+
+        Running projects that are due a status check come first. Queued jobs are started first in first out
+        while fewer than max_running projects are running in total, skipping clients that already have
+        max_per_client projects running. They are assigned the least loaded healthy Leximancer
+        server (see utils.choose_server) which the job sticks to from then on.
+        """
+        def claim(conn):
+            now = time.time()
+            row = conn.execute('SELECT {0} FROM jobs WHERE state = ? AND next_run <= ? AND locked_until < ? '
+                               'ORDER BY next_run LIMIT 1'.format(COLUMNS), (RUNNING, now, now)).fetchone()
+            if row is not None:
+                conn.execute('UPDATE jobs SET locked_until = ? WHERE id = ?', (now + self.lease, row['id']))
+                return dict(row)
+
+            # Projects running, or being created, on each server
+            active = dict(conn.execute('SELECT server, COUNT(*) FROM jobs WHERE state = ? OR (state = ? AND locked_until >= ?) '
+                                       'GROUP BY server', (RUNNING, QUEUED, now)).fetchall())
+            if sum(active.values()) >= self.max_running:
+                return None
+            if self.max_per_client is None:
+                row = conn.execute('SELECT {0} FROM jobs WHERE state = ? AND next_run <= ? AND locked_until < ? '
+                                   'ORDER BY created LIMIT 1'.format(COLUMNS), (QUEUED, now, now)).fetchone()
+            else:
+                row = conn.execute('SELECT {0} FROM jobs AS j WHERE state = ? AND next_run <= ? AND locked_until < ? AND '
+                                   '(client IS NULL OR (SELECT COUNT(*) FROM jobs AS a WHERE a.client = j.client AND '
+                                   '(a.state = ? OR (a.state = ? AND a.locked_until >= ?))) < ?) '
+                                   'ORDER BY created LIMIT 1'.format(COLUMNS),
+                                   (QUEUED, now, now, RUNNING, QUEUED, now, self.max_per_client)).fetchone()
+            if row is None:
+                return None
+            server = utils.choose_server(active)
+            if server is None:
+                return None
+            conn.execute('UPDATE jobs SET locked_until = ?, server = ? WHERE id = ?', (now + self.lease, server.name, row['id']))
+            job = dict(row)
+            job['server'] = server.name
+            return job
+        return self._transaction(claim)
+
+    def set_project(self, id, project_url):
+        """
+        Note the Leximancer project a job's create step has made so far, keeping the lease.
+        """
+        self._connection().execute('UPDATE jobs SET project_url = ?, updated = ? WHERE id = ?',
+                                   (project_url, time.time(), id))
+
+    def update(self, id, **fields):
+        """
+        Update the passed fields of a job and give up its lease.
+        """
+        fields['updated'] = time.time()
+        fields['locked_until'] = 0
+        names = sorted(fields.keys())
+        self._connection().execute('UPDATE jobs SET {0} WHERE id = ?'.format(', '.join('{0} = ?'.format(n) for n in names)),
+                                   [fields[n] for n in names] + [id])
+
+    def purge(self, age):
+        """
+        Delete finished jobs that haven't changed in age seconds, and batches submitted more than age seconds ago.
+        Returns the number of jobs deleted.
+        """
+        conn = self._connection()
+        conn.execute('DELETE FROM batches WHERE created < ?', (time.time() - age,))
+        conn.execute('DELETE FROM fetches WHERE created < ?', (time.time() - age,))
+        return conn.execute('DELETE FROM jobs WHERE state IN (?, ?) AND updated < ?',
+                            (DONE, FAILED, time.time() - age)).rowcount
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """
+    Get the job store configured by settings.JOBS.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            conf = get_config()
+            # Under gevent the store's sqlite3 calls run on green's thread pool, see tib.green
+            _store = green.threaded(green.call(JobStore, conf['PATH'], conf['MAX_RUNNING'], conf['LEASE'],
+                                               conf['MAX_PER_CLIENT'], conf['MAX_QUEUED'], conf['RETRY_AFTER']))
+    return _store
+
+def submit(key, text, client=None):
+    """
+    Queue a Leximancer run for the text with the passed result key, from the passed client IP.
+
+    With settings.UPLOAD_TEXT the text is kept with the job until the worker uploads it to Leximancer, otherwise
+    it is written to a file in TEXT_PATH.
+
+    Returns the job id that clients poll the status view with. Raises QueueFull if the job can't be queued.
+    """
+    store = get_store()
+    id = store.join(key)
+    if id is not None:
+        return id
+    if getattr(settings, 'UPLOAD_TEXT', False):
+        id, created = store.add(key, '{0}.txt'.format(cache.project_name(key)), client, text)
+        return id
+    doc = utils.save_text(cache.project_name(key), text)
+    try:
+        id, created = store.add(key, doc, client)
+    except QueueFull:
+        utils.remove_text(doc)
+        raise
+    if not created:
+        # Lost a race with an identical submission, use its document
+        utils.remove_text(doc)
+    return id
+
+def submit_sample(sample, client=None):
+    """
+    Queue a Leximancer run for a large document sampled by corpus.sample_upload, from the passed client IP. The
+    sample's files become the project's docset files, uploaded by the worker with settings.UPLOAD_TEXT.
+
+    Returns the job id. Raises QueueFull if the job can't be queued.
+    """
+    store = get_store()
+    id = store.join(sample.key)
+    if id is not None:
+        sample.discard()
+        return id
+    docs = sample.save(cache.project_name(sample.key))
+    try:
+        id, created = store.add(sample.key, ' '.join(docs), client)
+    except QueueFull:
+        remove_docs(docs)
+        raise
+    if not created:
+        remove_docs(docs)
+    return id
+
+def remove_docs(docs):
+    """
+    Remove the passed documents from TEXT_PATH, if they are there.
+    """
+    for doc in docs:
+        utils.remove_text(doc)
+
+def poll_interval(conf, stage):
+    """
+    Seconds to wait before checking on a project in the passed stage again.
+    """
+    return conf['POLL_INTERVALS'].get(stage, conf['POLL_INTERVAL'])
+
+def run_step(store, job, conf):
+    """
+    Move a claimed job one step through its lifecycle: create and start the project, check on it, or collect
+    the markers and delete the project once it has finished.
+
+    Each running project is checked by exactly one worker at a time however many people are watching it, and
+    the latest stage and message are written to the store for the status views to read. The project is deleted
+    here as soon as its markers are cached, not by the pollers, so it goes however many submissions joined the
+    job and whether or not they are still watching.
+    """
+    docs = job['doc'].split()
+    if job['state'] == QUEUED:
+        if job['project_url']:
+            # An earlier attempt got as far as creating the project, it may be half set up so start again
+            logger.info('Deleting project {0} left by an earlier attempt at job {1}.'.format(job['project_url'], job['id']))
+            utils.delete_project(job['project_url'], keep_text=True)
+            store.set_project(job['id'], None)
+        # An identical job may have finished between the submission's cache check and it being queued, its
+        # markers do for this one too and no second project is created
+        if cache.get_result(job['key']) is not None:
+            remove_docs(docs)
+            store.update(job['id'], state=DONE, progress=100, message='Here come the visualisations...', text=None)
+            return
+        # The parts of a large document are named after the project with a -<part> suffix
+        name = os.path.splitext(docs[0])[0].split('-')[0]
+        text = store.get_text(job['id'])
+        if text is not None:
+            texts = [text]
+        elif getattr(settings, 'UPLOAD_TEXT', False):
+            # Sampled documents are written to TEXT_PATH however many parts they have, send them from there
+            texts = [utils.read_text(doc) for doc in docs]
+        else:
+            texts = None
+        project_url = utils.create_lex_project(name, docs, server=utils.get_server(job['server']), text=texts,
+                                               created=lambda project: store.set_project(job['id'], project.href)).href
+        # Whether the project's text went into TEXT_PATH is remembered, UPLOAD_TEXT may change before it is deleted
+        store.update(job['id'], state=RUNNING, project_url=project_url, uploaded=int(texts is not None), attempts=0,
+                     message='Leximancer project created', next_run=time.time() + poll_interval(conf, None))
+        return
+
+    stage, state, message, project_url = utils.get_project_status(job['project_url'])
+    if stage == 'MAP':
+        markers_url, markers_cookie = utils.update_map(project_url)
+        concepts, themes, prominence, num_blocks = utils.get_concepts(utils.get_markers(markers_url, markers_cookie))
+        markers = {"concepts": concepts, "themes": themes, "iprom": prominence, "numBlocks": num_blocks}
+        cloud.add_layout(job['key'], markers)
+        graph.add_graph(job['key'], markers)
+        compact = save_result(job['key'], markers)
+        snapshots.save(job['key'], markers, compact)
+        # We don't want tp keep projects around.
+        utils.delete_project(job['project_url'], keep_text=job['uploaded'])
+        remove_docs(docs)
+        store.update(job['id'], state=DONE, stage=stage, progress=100, message='Here come the visualisations...', text=None)
+    elif state == 'error':
+        utils.delete_project(job['project_url'], keep_text=job['uploaded'])
+        remove_docs(docs)
+        store.update(job['id'], state=FAILED, stage=stage, message=message, text=None)
+    else:
+        store.update(job['id'], stage=stage, progress=utils.STATUS_MAP.get(stage, 0), message=message, attempts=0,
+                     next_run=time.time() + poll_interval(conf, stage))
+
+def fetch_step(store, fetch):
+    """
+    Fetch the Wikipedia article for a batch item claimed from the store and queue a job for its text, then record
+    the job id in the batch, or the result key of a cached visualisation, or why the item was turned away.
+    """
+    url = fetch['url']
+    try:
+        # Concurrent fetches of the same article share one download
+        text, shared = inflight.flight.do('wiki:{0}'.format(url), wikipedia.fetch_text, url, MAX_TEXT_LENGTH)
+    except wikipedia.TextTooLong:
+        item = {'error': 'The article has more than {0} characters of text.'.format(MAX_TEXT_LENGTH)}
+    except wikipedia.FetchError as err:
+        item = {'error': err.msg}
+    else:
+        if not text_length_ok(text):
+            item = {'error': 'The text must be between {0} and {1} characters long.'.format(MIN_TEXT_LENGTH,
+                                                                                        MAX_TEXT_LENGTH)}
+        else:
+            key = cache.result_key(text)
+            try:
+                item = {'id': key if cache.get_result(key) is not None else submit(key, text, fetch['client'])}
+            except QueueFull as err:
+                item = {'error': err.msg, 'retryAfter': err.retry_after}
+    store.finish_fetch(fetch['batch'], fetch['item'], item)
+
+def save_result(key, markers):
+    """
+    Cache the markers for the passed result key along with the JSON of their compact encoding, so the status view
+    doesn't encode them again for every client that asks for it.
+
+    Returns the compact JSON.
+    """
+    compact = payload.compact_json(markers)
+    cache.set_result(key, markers)
+    cache.set_compact(key, compact)
+    return compact
+
+def request_backfill(key, markers):
+    """
+    Queue the cloud layout and the wheels' graphs for a result cached before they were worked out on the server,
+    if it is missing them. The job workers add them when they have nothing else to do.
+
+    Returns true if the result was queued.
+    """
+    missing = (('cloud' not in markers and cloud.get_config()['ENABLED']) or
+               ('graph' not in markers and graph.get_config()['ENABLED']))
+    if not missing:
+        return False
+    get_store().add_backfill(key)
+    return True
+
+def backfill(key):
+    """
+    Add the cloud layout and the wheels' graphs to the cached result with the passed key, if they are missing.
+    """
+    markers = cache.get_result(key)
+    if markers is None:
+        return
+    laid_out = cloud.add_layout(key, markers)
+    graphed = graph.add_graph(key, markers)
+    if laid_out or graphed:
+        save_result(key, markers)
+
+def fail_step(store, job, conf, err):
+    """
+    Record a failed step. The job is retried with backoff until it runs out of attempts.
+    """
+    attempts = job['attempts'] + 1
+    if attempts < conf['MAX_ATTEMPTS']:
+        logger.warning('Job {0} step failed (attempt {1}), retrying: {2}'.format(job['id'], attempts, err))
+        store.update(job['id'], attempts=attempts, next_run=time.time() + conf['RETRY_BACKOFF'] * 2 ** (attempts - 1))
+        return
+    logger.error('Job {0} failed: {1}'.format(job['id'], err))
+    # The step may have created a project since the job was claimed
+    job = store.get(job['id']) or job
+    store.update(job['id'], state=FAILED, attempts=attempts, message=str(err), text=None)
+    try:
+        if job['project_url']:
+            utils.delete_project(job['project_url'], keep_text=job['uploaded'])
+        remove_docs(job['doc'].split())
+    except StandardError as err:
+        logger.warning('Cleaning up job {0} failed: {1}'.format(job['id'], err))
+
+def sweep(store, conf, max_age=None):
+    """
+    Remove files in TEXT_PATH that no job is using and are older than max_age seconds (TEXT_MAX_AGE by default).
+
+    Returns a tuple of the number of files removed and the bytes reclaimed.
+    """
+    removed, reclaimed = utils.sweep_text(conf['TEXT_MAX_AGE'] if max_age is None else max_age, store.active_docs())
+    if removed:
+        logger.info('Removed {0} orphaned documents from {1}, reclaimed {2} bytes.'.format(removed, settings.TEXT_PATH,
+                                                                                         reclaimed))
+    return removed, reclaimed
+
+def run_claimed(store, job, conf):
+    """
+    Run the next step of a job claimed from the store, noting how its Leximancer server did.
+    """
+    server = utils.get_server(job['server'])
+    start = time.time()
+    try:
+        run_step(store, job, conf)
+    except Exception as err:
+        server.record_failure()
+        fail_step(store, job, conf, err)
+    else:
+        server.record_success(time.time() - start)
+
+def _run_slot(store, job, conf, slots):
+    try:
+        run_claimed(store, job, conf)
+    except Exception:
+        # fail_step itself failed, the job is picked up again when its lease runs out
+        logger.exception('Step of job {0} failed.'.format(job['id']))
+    finally:
+        slots.release()
+
+def _fetch_slot(store, fetch, slots):
+    try:
+        fetch_step(store, fetch)
+    except Exception:
+        logger.exception('Fetching {0} for batch {1} failed.'.format(fetch['url'], fetch['batch']))
+        try:
+            store.finish_fetch(fetch['batch'], fetch['item'], {'error': 'The item could not be queued.'})
+        except Exception:
+            # The item is fetched again when its lease runs out
+            logger.exception('Recording the failed fetch for batch {0} failed.'.format(fetch['batch']))
+    finally:
+        slots.release()
+
+def work(stop=None, idle_sleep=1, concurrency=None):
+    """
+    Worker loop: claim due jobs and run them a step at a time until stop (a threading/multiprocessing Event)
+    is set. When no job is due the articles of batch items are fetched and queued (see fetch_step).
+
+    Up to concurrency (JOBS['CONCURRENCY'] by default) steps run at once, each on its own thread. With one the
+    steps run in the loop itself.
+    """
+    store = get_store()
+    conf = get_config()
+    if concurrency is None:
+        concurrency = conf['CONCURRENCY']
+    slots = threading.BoundedSemaphore(concurrency)
+    running = []
+    last_purge = last_sweep = 0
+    last_stats = time.time()
+    while stop is None or not stop.is_set():
+        if time.time() - last_purge > 60:
+            store.purge(conf['KEEP_FINISHED'])
+            last_purge = time.time()
+        # Large documents go through files in TEXT_PATH even with UPLOAD_TEXT
+        if time.time() - last_sweep > 60 * 60:
+            sweep(store, conf)
+            last_sweep = time.time()
+        if time.time() - last_stats > conf['STATS_INTERVAL']:
+            httppool.log_stats()
+            last_stats = time.time()
+        # Wait for a free slot before claiming so no job is leased while nothing can run it
+        slots.acquire()
+        job = store.claim()
+        if job is not None:
+            step, args, name = _run_slot, (store, job, conf, slots), 'job-{0}'.format(job['id'])
+        else:
+            fetch = store.claim_fetch()
+            if fetch is None:
+                slots.release()
+                # Nothing is due, bring an old result up to date if one is waiting
+                key = store.take_backfill()
+                if key is None:
+                    time.sleep(idle_sleep)
+                else:
+                    try:
+                        backfill(key)
+                    except Exception:
+                        logger.exception('Bringing result {0} up to date failed.'.format(key))
+                continue
+            step, args, name = _fetch_slot, (store, fetch, slots), 'fetch-{0}-{1}'.format(fetch['batch'], fetch['item'])
+        if concurrency == 1:
+            step(*args)
+            continue
+        thread = threading.Thread(target=step, args=args, name=name)
+        thread.daemon = True
+        thread.start()
+        running = [t for t in running if t.is_alive()]
+        running.append(thread)
+    # Let the steps under way finish, their jobs would otherwise wait out their leases
+    for thread in running:
+        thread.join()
@@ -0,0 +1,50 @@
+import logging
+import multiprocessing
+import signal
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from tib import jobs
+
+logger = logging.getLogger('tib')
+
+def _work(stop, concurrency):
+    # Let the parent handle ctrl-c and shut us down through stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    jobs.work(stop, concurrency=concurrency)
+
+class Command(BaseCommand):
+    help = 'Run the pool of worker processes that drive queued Leximancer jobs.'
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=None,
+            help='Number of worker processes, defaults to JOBS["WORKERS"].'),
+        make_option('--concurrency', type='int', dest='concurrency', default=None,
+            help='Steps each worker process runs at once, defaults to JOBS["CONCURRENCY"].'),
+    )
+
+    def handle(self, *args, **options):
+        conf = jobs.get_config()
+        num_workers = options['workers'] or conf['WORKERS']
+        concurrency = options['concurrency'] or conf['CONCURRENCY']
+        stop = multiprocessing.Event()
+        workers = []
+        for i in range(num_workers):
+            worker = multiprocessing.Process(target=_work, args=(stop, concurrency), name='lexworker-{0}'.format(i))
+            worker.start()
+            workers.append(worker)
+        logger.info('Started {0} Leximancer job workers running {1} steps each.'.format(num_workers, concurrency))
+
+        def shutdown(signum, frame):
+            stop.set()
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        # Replace any worker that dies until we are told to stop
+        while not stop.is_set():
+            for i, worker in enumerate(workers):
+                if not worker.is_alive():
+                    logger.warning('Job worker {0} exited with {1}, restarting it.'.format(worker.name, worker.exitcode))
+                    workers[i] = multiprocessing.Process(target=_work, args=(stop, concurrency), name=worker.name)
+                    workers[i].start()
+            stop.wait(1)
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,16 @@
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from tib import jobs
+
+class Command(BaseCommand):
+    help = 'Remove documents in TEXT_PATH that no job is using and report the space reclaimed.'
+    option_list = BaseCommand.option_list + (
+        make_option('--age', type='int', dest='age', default=None,
+            help='Only remove documents older than this many seconds, defaults to JOBS["TEXT_MAX_AGE"].'),
+    )
+
+    def handle(self, *args, **options):
+        removed, reclaimed = jobs.sweep(jobs.get_store(), jobs.get_config(), options['age'])
+        self.stdout.write('Removed {0} orphaned documents from {1}, reclaimed {2:.1f} KB.\n'.format(
+            removed, settings.TEXT_PATH, reclaimed / 1024.0))
@@ -0,0 +1 @@
+# tib keeps no models of its own, Django 1.4 needs this module to find the app (and its tests)
@@ -0,0 +1,207 @@
+"""
+Encodings for the marker payloads the status views send.
+
+By default the markers go out as utils.get_concepts builds them: a dict of concept dicts, each repeating every
+field name, with related concepts' numbers as strings. Clients that ask for the compact encoding, with
+?format=compact or an Accept header naming COMPACT_TYPE, get the same data as columns: one array per field,
+numbers as numbers, and related concepts and edges as flat arrays. vis.js turns it back into the usual shape.
+
+Big responses are compressed with brotli, when the brotli module is installed and the client accepts it, or gzip.
+"""
+import zlib
+from django.utils.text import compress_string
+from tib import cache
+from tib import serialize
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPACT_FORMAT = 'compact'
+COMPACT_TYPE = 'application/vnd.tib.markers.compact+json'
+
+# Values in each related concept entry of the compact encoding
+RELATED_FIELDS = ('id', 'strength', 'count', 'prom')
+
+# Responses smaller than this many bytes aren't worth compressing
+MIN_COMPRESS_SIZE = 1024
+BROTLI_QUALITY = 5
+
+def number(value):
+    """
+    Convert a number held as a string to an int, or a float if it has a fraction. None stays None.
+    """
+    if value is None or isinstance(value, (int, long, float)):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+def wants_compact(request):
+    """
+    Return true if the client asked for the compact encoding.
+    """
+    return (request.GET.get('format') == COMPACT_FORMAT or
+            COMPACT_TYPE in request.META.get('HTTP_ACCEPT', ''))
+
+def compact_markers(markers):
+    """
+    Encode markers, as stored in the result cache, in columns.
+
+    Concepts and themes are ordered by id, the order browsers walk the usual encoding's objects in. Each concept's
+    related concepts are one flat array of id, strength, count, prom repeated, and its minimum spanning tree edges
+    an array of the ids they go to. Concept kinds are stored once in kinds and referred to by index. The cloud
+    layout and the wheels' graphs, if there are any, go out as they are.
+
+    Returns the compact markers as a dict.
+    """
+    concepts = [markers['concepts'][id] for id in sorted(markers['concepts'], key=int)]
+    themes = [markers['themes'][id] for id in sorted(markers['themes'], key=int)]
+    kinds = []
+    kind_index = {}
+    for concept in concepts:
+        if concept['kind'] not in kind_index:
+            kind_index[concept['kind']] = len(kinds)
+            kinds.append(concept['kind'])
+
+    related = []
+    for concept in concepts:
+        flat = []
+        append = flat.append
+        for rel in concept.get('related', ()):
+            append(int(rel['id']))
+            append(float(rel['strength']))
+            append(int(rel['count']))
+            append(float(rel['prom']))
+        related.append(flat)
+
+    iprom = markers['iprom']
+    compact = {
+        'format': COMPACT_FORMAT,
+        'numBlocks': number(markers['numBlocks']),
+        'kinds': kinds,
+        'concepts': {
+            'id': [c['id'] for c in concepts],
+            'value': [c['value'] for c in concepts],
+            'kind': [kind_index[c['kind']] for c in concepts],
+            'weight': [c['weight'] for c in concepts],
+            'frequency': [c['frequency'] for c in concepts],
+            'x': [c['x'] for c in concepts],
+            'y': [c['y'] for c in concepts],
+            'themeId': [number(c.get('themeId')) for c in concepts],
+            'mstEdges': [[edge['to'] for edge in c['mstEdges']] for c in concepts],
+            'related': related,
+        },
+        'themes': {
+            'id': [t['id'] for t in themes],
+            'name': [t['name'] for t in themes],
+            'hue': [number(t['hue']) for t in themes],
+            'connectivity': [number(t['connectivity']) for t in themes],
+        },
+        'iprom': {
+            'from': [edge['from'] for edge in iprom],
+            'to': [edge['to'] for edge in iprom],
+            'weight': [edge['weight'] for edge in iprom],
+        },
+    }
+    # The cloud layout and the wheels' graphs (see tib.cloud and tib.graph) are compact already
+    for name in ('cloud', 'graph'):
+        if name in markers:
+            compact[name] = markers[name]
+    return compact
+
+def encode_markers(markers, compact=False):
+    """
+    Get markers in the encoding the client asked for.
+    """
+    return compact_markers(markers) if compact else markers
+
+def compact_json(markers):
+    """
+    Get the JSON of the compact encoding of markers.
+    """
+    return serialize.dumps(compact_markers(markers), True)
+
+def cached_markers(key, markers, compact=False):
+    """
+    Get the markers cached for the passed result key in the encoding the client asked for, to go in a response
+    encoded with serialize.iterencode. The compact encoding is cached as JSON when the job finishes, so it is only
+    worked out here (and cached) for results from before then.
+    """
+    if not compact:
+        return markers
+    body = cache.get_compact(key)
+    if body is None:
+        body = compact_json(markers)
+        cache.set_compact(key, body)
+    return serialize.RawJSON(body)
+
+def accepts(request, encoding):
+    """
+    Return true if the client accepts responses with the passed content coding.
+    """
+    accepted = [part.split(';')[0].strip() for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(',')]
+    return encoding in accepted
+
+def accepted_encoding(request):
+    """
+    Pick the content coding for a response to the passed request: 'br', 'gzip' or None.
+    """
+    if brotli is not None and accepts(request, 'br'):
+        return 'br'
+    if accepts(request, 'gzip'):
+        return 'gzip'
+    return None
+
+def compress_chunks(chunks, encoding):
+    """
+    Compress a stream of byte strings with the passed content coding, 'br' or 'gzip'.
+
+    Returns a generator of compressed byte strings.
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        # brotlipy calls it compress, Google's brotli process
+        compress = getattr(compressor, 'process', None) or compressor.compress
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compress = compressor.compress
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        compressed = compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush() if encoding == 'gzip' else compressor.finish()
+
+def compress_response(request, response):
+    """
+    Compress the body of the passed response if it is big enough and the client accepts a coding we have.
+    Streamed responses are always compressed, as they go out.
+
+    Returns the response.
+    """
+    response['Vary'] = 'Accept, Accept-Encoding'
+    if response.has_header('Content-Encoding'):
+        return response
+    # Django 1.4 has no streaming response class, HttpResponse notes when its content is an iterator
+    if getattr(response, '_base_content_is_iter', False):
+        encoding = accepted_encoding(request)
+        if encoding is not None:
+            response.content = compress_chunks(response._container, encoding)
+            response['Content-Encoding'] = encoding
+        return response
+    if len(response.content) < MIN_COMPRESS_SIZE:
+        return response
+    encoding = accepted_encoding(request)
+    if encoding == 'br':
+        response.content = brotli.compress(response.content, quality=BROTLI_QUALITY)
+    elif encoding == 'gzip':
+        response.content = compress_string(response.content)
+    else:
+        return response
+    response['Content-Encoding'] = encoding
+    response['Content-Length'] = str(len(response.content))
+    return response
@@ -168,9 +168,26 @@ tib.vis.ConceptCloud = function ConceptCloud (config, data) {
             }
         }
 
+        // Positions laid out on the server for the default settings (see tib/cloud.py), in d3.layout.cloud's shape
+        var serverLayout = null;
+        if (data.markers.cloud) {
+            var placed = data.markers.cloud.words;
+            serverLayout = {settings: data.markers.cloud, words: []};
+            for (var i = 0; i < placed.id.length; i++) {
+                serverLayout.words.push({
+                    text: wordNamesForId[placed.id[i]],
+                    size: placed.size[i],
+                    x: placed.x[i],
+                    y: placed.y[i],
+                    rotate: placed.rotate[i]
+                });
+            }
+        }
+
         return  {
             cluster: cluster,
             mst: mst,
+            serverLayout: serverLayout,
             sizeDomain: [minSize, maxSize],
             themes: data.markers.themes,
             words: words,
@@ -386,6 +403,15 @@ tib.vis.ConceptCloud = function ConceptCloud (config, data) {
         }
     };
     
+    // True if the server laid the cloud out with the current settings
+    var usesServerLayout = function () {
+        var settings = self.serverLayout && self.serverLayout.settings;
+        return settings != null && settings.width == self.width && settings.height == self.height &&
+            settings.font == self.font && settings.spiral == self.mode.toLowerCase() &&
+            String(settings.orientation) == String(self.orientation) && self.scaleType == 'Automatic' &&
+            self.bold && !self.italic;
+    };
+
     // Start the D3 drawing process
     var generate = function () {
         
@@ -393,6 +419,12 @@ tib.vis.ConceptCloud = function ConceptCloud (config, data) {
             self.selector.remove();
         }
         self.selector = d3.select('#' + self.drawTarget).append("svg");
+
+        // The first drawing uses the server's layout if it has one, Refresh and the menus lay the cloud out afresh
+        if (!self.drawn && usesServerLayout()) {
+            drawWords(self.serverLayout.words);
+            return;
+        }
         
         switch (self.scaleType) {
             case 'Automatic':
@@ -25,8 +25,11 @@ tib.vis.CorrelationWheel = function CorrelationWheel(config, data) {
     
     var colour = d3.scale.category10();
 
-    // Build the inverse prominence tree
+    // Build the nodes and their links, from the graph the server worked out if it sent one (see tib/graph.py)
     var initData = function(data) {
+        if (data.markers.graph) {
+            return initGraph(data.markers.concepts, data.markers.graph);
+        }
         var wordNamesForId = {};
         var nodeList = [];
 
@@ -70,6 +73,51 @@ tib.vis.CorrelationWheel = function CorrelationWheel(config, data) {
             }
         };
     };
+    // Build the nodes in wheel order, with the links and theme groupings already worked out
+    var initGraph = function(concepts, graph) {
+        var nodeList = [];
+        var nodesByKey = {};
+        for (var i = 0; i < graph.order.length; i++) {
+            var w = concepts[graph.order[i]];
+            var node = {
+                name: w.value,
+                key: w.id,
+                themeId: parseInt(w.themeId, 10),
+                weight: parseFloat(w.weight),
+                rank: i
+            };
+            nodeList.push(node);
+            nodesByKey[node.key] = node;
+        }
+
+        var links = [];
+        for (var i = 0; i < graph.links.source.length && i < self.numLinks; i++) {
+            links.push({
+                source: nodesByKey[graph.links.source[i]],
+                target: nodesByKey[graph.links.target[i]],
+                prom: graph.links.prom[i],
+                strength: graph.links.strength[i],
+                count: graph.links.count[i]
+            });
+        }
+
+        var topRelated = {};
+        for (var i = 0; i < graph.related.id.length; i++) {
+            topRelated[graph.related.id[i]] = graph.related.top[i];
+        }
+
+        return {
+            nodes: {
+                children: nodeList,
+                name: 'dummy-name',
+                key: 'dummy-key'
+            },
+            nodesByKey: nodesByKey,
+            links: links,
+            themeGroups: graph.themes.concepts,
+            topRelated: topRelated
+        };
+    };
     $.extend(this, initData(data));
 
     /**
@@ -148,12 +196,19 @@ tib.vis.CorrelationWheel = function CorrelationWheel(config, data) {
             var sortedNodes = [];
             var arcs = [];
 
-            nodes.forEach(function (node) {
-                if (sortedNodes[node.themeId] === undefined) {
-                    sortedNodes[node.themeId] = [];
-                }
-                sortedNodes[node.themeId].push(node.x);
-            });
+            if (self.themeGroups) {
+                sortedNodes = $.map(self.themeGroups, function (keys) {
+                    return [$.map(keys, function (key) { return self.nodesByKey[key].x; })];
+                });
+            }
+            else {
+                nodes.forEach(function (node) {
+                    if (sortedNodes[node.themeId] === undefined) {
+                        sortedNodes[node.themeId] = [];
+                    }
+                    sortedNodes[node.themeId].push(node.x);
+                });
+            }
 
             for (var i in sortedNodes) {
                 var max = sortedNodes[i][0],
@@ -177,7 +232,9 @@ tib.vis.CorrelationWheel = function CorrelationWheel(config, data) {
 
         var cluster = d3.layout.cluster()
             .size([360, ry - 120])
-            .sort(function(a, b) { return (a.themeId * 1000 + a.weight * -1) - (b.themeId * 1000 + b.weight * -1); });
+            .sort(self.links ?
+                function(a, b) { return a.rank - b.rank; } :
+                function(a, b) { return (a.themeId * 1000 + a.weight * -1) - (b.themeId * 1000 + b.weight * -1); });
 
         // Connect lines
         var line = d3.svg.line.radial()
@@ -198,7 +255,7 @@ tib.vis.CorrelationWheel = function CorrelationWheel(config, data) {
             .attr("transform", "translate(" + rx + "," + ry + ")");
 
         var nodes = cluster.nodes(self.nodes);
-        var links = calcLinks(self.nodes['children']);
+        var links = self.links || calcLinks(self.nodes['children']);
         var splines = calcSplines(links);
 
         var path = container.selectAll("path.link")
@@ -271,6 +328,14 @@ tib.vis.CorrelationWheel = function CorrelationWheel(config, data) {
                 var el = d3.select('#node-'+d.target.key).select('text');
                 hoverText(el, colour(el.data()[0].themeId));
             });
+
+        // Also pick out the most related concepts whose links didn't make the cut
+        if (self.topRelated) {
+            $.each(self.topRelated[key] || [], function (i, relatedKey) {
+                var el = d3.select('#node-' + relatedKey).select('text');
+                hoverText(el, colour(self.nodesByKey[relatedKey].themeId));
+            });
+        }
             
         hoverText(d3.select(text), 'black');
     };
@@ -290,6 +355,12 @@ tib.vis.CorrelationWheel = function CorrelationWheel(config, data) {
             .each(function (d) {
                 unhoverText(d3.select('#node-'+d.target.key).select('text'));
             });
+
+        if (self.topRelated) {
+            $.each(self.topRelated[key] || [], function (i, relatedKey) {
+                unhoverText(d3.select('#node-' + relatedKey).select('text'));
+            });
+        }
             
         unhoverText(d3.select(text));
     };
@@ -10,8 +10,13 @@ tib.vis.StoryWheel = function StoryWheel(config, data) {
     var self = this;
     $.extend(this, config);
 
-    // Build the inverse prominence tree
+    // Build the inverse prominence tree, unless the server sent it ready built (see tib/graph.py)
     var initData = function(data) {
+        if (data.markers.graph && data.markers.graph.story) {
+            return {
+                tree: data.markers.graph.story
+            };
+        }
         var wordNamesForId = {};
         var invProm = {};
 
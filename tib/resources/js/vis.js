@@ -3,6 +3,61 @@
  */
 var tib = {vis:{}};
 
+/**
+ * Turn markers sent in the compact encoding (?format=compact, see tib/payload.py) back into the usual shape:
+ * concepts and themes keyed by id, related concepts and edges as lists of objects.
+ * @param {Object} compact
+ */
+tib.vis.decodeMarkers = function (compact) {
+    var c = compact.concepts,
+        t = compact.themes,
+        concepts = {},
+        themes = {},
+        iprom = [];
+
+    for (var i = 0; i < c.id.length; i++) {
+        var concept = {
+            id: c.id[i],
+            value: c.value[i],
+            kind: compact.kinds[c.kind[i]],
+            weight: c.weight[i],
+            frequency: c.frequency[i],
+            x: c.x[i],
+            y: c.y[i],
+            mstEdges: [],
+            related: []
+        };
+        // Theme ids are strings in the usual encoding, keep them so as "0" is still truthy
+        if (c.themeId[i] !== null) {
+            concept.themeId = String(c.themeId[i]);
+        }
+        for (var j = 0; j < c.mstEdges[i].length; j++) {
+            concept.mstEdges.push({to: c.mstEdges[i][j]});
+        }
+        var related = c.related[i];
+        for (var k = 0; k < related.length; k += 4) {
+            concept.related.push({id: related[k], strength: related[k + 1], count: related[k + 2], prom: related[k + 3]});
+        }
+        concepts[concept.id] = concept;
+    }
+    for (var i = 0; i < t.id.length; i++) {
+        themes[t.id[i]] = {id: t.id[i], name: t.name[i], hue: t.hue[i], connectivity: t.connectivity[i]};
+    }
+    for (var i = 0; i < compact.iprom.from.length; i++) {
+        iprom.push({from: compact.iprom.from[i], to: compact.iprom.to[i], weight: compact.iprom.weight[i]});
+    }
+    var markers = {concepts: concepts, themes: themes, iprom: iprom, numBlocks: compact.numBlocks};
+    // The cloud layout and the wheels' graphs (see tib/cloud.py and tib/graph.py) are sent the same way in both
+    // encodings
+    if (compact.cloud) {
+        markers.cloud = compact.cloud;
+    }
+    if (compact.graph) {
+        markers.graph = compact.graph;
+    }
+    return markers;
+};
+
 /**
  * Singleton for managing visualisations.
  */
@@ -97,6 +152,9 @@ tib.vis.Manager = function () {
          * @param {Object} aData
          */
         setData: function (aData) {
+            if (aData.markers && aData.markers.format === 'compact') {
+                aData.markers = tib.vis.decodeMarkers(aData.markers);
+            }
             data = aData;
         },
         
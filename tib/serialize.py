@@ -0,0 +1,154 @@
+"""
+JSON encoding for the dynamic views.
+
+Most of the time spent answering a finished status request goes on encoding the markers. dumps uses ujson when it
+is installed and the standard library's json otherwise. settings.JSON_ENCODER picks one by name instead, which
+can also be simplejson (with its C speedups), though on Python 2.7 it is no faster than json. iterencode streams
+big payloads out in chunks, encoding the parts of the outer structure one at a time and long arrays below them a
+slice at a time, so the whole response is never built as one string. Parts that are JSON already, like the
+cached compact markers, can be passed to iterencode as RawJSON.
+"""
+import json
+from django.conf import settings
+
+# Encoders tried in order when settings.JSON_ENCODER is 'auto'
+ENCODERS = ('ujson', 'json')
+
+# Containers this deep or deeper are encoded in one go by iterencode, those above it piece by piece. With 3 a
+# status response's markers are streamed a concept at a time.
+STREAM_DEPTH = 3
+# Bytes iterencode collects before yielding them
+CHUNK_SIZE = 64 * 1024
+# Items of a longer array at or below STREAM_DEPTH encoded at a time, so the compact markers' columns are streamed
+# in pieces too
+SLICE_ITEMS = 1000
+
+def load_encoder(name):
+    """
+    Get a dumps(obj, compact) function for the named encoder. compact drops the spaces after separators.
+
+    Raises ImportError if the encoder isn't installed.
+    """
+    if name == 'ujson':
+        import ujson
+        # ujson never writes spaces after separators
+        return lambda obj, compact=False: ujson.dumps(obj, ensure_ascii=True, escape_forward_slashes=False)
+    if name == 'simplejson':
+        import simplejson
+        if not simplejson._import_c_make_encoder():
+            raise ImportError('simplejson is installed without its C speedups')
+        module = simplejson
+    elif name == 'json':
+        module = json
+    else:
+        raise ImportError('Unknown JSON encoder {0}'.format(name))
+    return lambda obj, compact=False: module.dumps(obj, separators=(',', ':') if compact else None)
+
+_encoder = None
+
+def get_encoder():
+    """
+    Get the dumps function for the encoder settings.JSON_ENCODER names, the first of ENCODERS that is installed
+    by default. Falls back to json if the named encoder isn't installed.
+    """
+    global _encoder
+    if _encoder is None:
+        name = getattr(settings, 'JSON_ENCODER', 'auto')
+        for candidate in (ENCODERS if name == 'auto' else (name,)):
+            try:
+                _encoder = load_encoder(candidate)
+                break
+            except ImportError:
+                continue
+        else:
+            _encoder = load_encoder('json')
+    return _encoder
+
+def dumps(obj, compact=False):
+    """
+    Encode obj as JSON, without spaces after separators if compact is true.
+    """
+    return get_encoder()(obj, compact)
+
+class RawJSON(str):
+    """
+    A string of JSON that iterencode sends as it is rather than encoding it again. dumps doesn't know about it.
+    """
+
+def key_string(key):
+    """
+    Convert a dict key to the string JSON encoders use for it.
+    """
+    if isinstance(key, basestring):
+        return key
+    if key is True:
+        return 'true'
+    if key is False:
+        return 'false'
+    if key is None:
+        return 'null'
+    if isinstance(key, float):
+        return repr(key)
+    return str(key)
+
+def _pieces(obj, depth, encode, compact):
+    # Yield the JSON for obj in pieces, encoding containers shallower than depth item by item and long arrays
+    # deeper than that SLICE_ITEMS items at a time
+    if isinstance(obj, RawJSON):
+        for start in xrange(0, len(obj), CHUNK_SIZE):
+            yield obj[start:start + CHUNK_SIZE]
+        return
+    item_separator = ',' if compact else ', '
+    if depth <= 0 and isinstance(obj, (list, tuple)) and len(obj) > SLICE_ITEMS:
+        yield '['
+        for start in xrange(0, len(obj), SLICE_ITEMS):
+            if start:
+                yield item_separator
+            # Strip the brackets from each slice's array
+            yield encode(obj[start:start + SLICE_ITEMS], compact)[1:-1]
+        yield ']'
+        return
+    if depth <= 0 or not isinstance(obj, (dict, list, tuple)):
+        yield encode(obj, compact)
+        return
+    if isinstance(obj, dict):
+        key_separator = ':' if compact else ': '
+        yield '{'
+        first = True
+        for key, value in obj.iteritems():
+            if first:
+                first = False
+                yield encode(key_string(key), compact) + key_separator
+            else:
+                yield item_separator + encode(key_string(key), compact) + key_separator
+            for piece in _pieces(value, depth - 1, encode, compact):
+                yield piece
+        yield '}'
+    else:
+        yield '['
+        for i, value in enumerate(obj):
+            if i:
+                yield item_separator
+            for piece in _pieces(value, depth - 1, encode, compact):
+                yield piece
+        yield ']'
+
+def iterencode(obj, compact=False, depth=STREAM_DEPTH, chunk_size=CHUNK_SIZE):
+    """
+    Encode obj as JSON a chunk of about chunk_size bytes at a time. The chunks join up to what dumps gives for
+    obj, less any difference in spacing between encoders.
+
+    Returns a generator of byte strings.
+    """
+    encode = get_encoder()
+    chunk = []
+    size = 0
+    for piece in _pieces(obj, depth, encode, compact):
+        chunk.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield ''.join(chunk)
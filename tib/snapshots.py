@@ -0,0 +1,354 @@
+"""
+Snapshots of finished visualisations, kept so they can be shared and revisited after the result cache has let
+them go.
+
+A snapshot is the completed status response with the markers in the compact encoding (see tib.payload),
+gzipped. It is written once when the job finishes and served as it is by the permalink views, which browsers,
+nginx and the CDN can cache as result keys address their content. Snapshots are kept in a directory or a SQLite
+database, within a size limit and for MAX_AGE seconds after they were last viewed.
+"""
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from django.conf import settings
+from django.utils.text import compress_string
+from tib import green
+from tib import payload
+from tib import serialize
+
+logger = logging.getLogger('tib')
+
+DEFAULTS = {
+    # 'file' keeps a file per snapshot in the PATH directory, 'db' keeps them in a SQLite database at PATH.
+    # A PATH of None turns snapshots off.
+    'BACKEND': 'file',
+    'PATH': '/var/tib/snapshots',
+    # Most bytes the snapshots may take up, the least recently viewed are removed past this
+    'MAX_BYTES': 500 * 1024 * 1024,
+    # Seconds a snapshot is kept after it was last viewed
+    'MAX_AGE': 60 * 60 * 24 * 90,
+    # Seconds browsers and caches may keep a snapshot for (Cache-Control max-age)
+    'CACHE_SECONDS': 60 * 60 * 24 * 7,
+    # Snapshots saved between eviction passes, which also catch the ones other processes have saved
+    'EVICT_EVERY': 100,
+}
+
+# Seconds between recording views of the same snapshot in the database
+TOUCH_INTERVAL = 60 * 60
+
+def snapshot_body(markers, compact=None):
+    """
+    Build the snapshot of the passed markers: the gzipped completed status response in the compact encoding.
+    compact is the JSON of the markers' compact encoding if it has been worked out already.
+    """
+    if compact is None:
+        compact = payload.compact_json(markers)
+    return compress_string(''.join(serialize.iterencode({"message": 'Here come the visualisations...',
+                                                         'completed': True, 'progress': 100,
+                                                         'markers': serialize.RawJSON(compact)}, True)))
+
+def decompress(body):
+    """
+    Get the JSON in a snapshot.
+    """
+    return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+class SnapshotStore(object):
+    """
+    Base class for the snapshot stores, which decides when they evict.
+
+    A store only looks over all its snapshots every evict_every saves, or sooner once the bytes this process has
+    saved since the last look take it past max_bytes.
+
+    path -- where the snapshots are kept.
+    max_bytes -- most bytes the snapshots may take up.
+    max_age -- seconds a snapshot is kept after it was last viewed.
+    evict_every -- most saves between evictions.
+    """
+    def __init__(self, path, max_bytes, max_age, evict_every=100):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.evict_every = evict_every
+        # Bytes in the store as of the last eviction plus those saved since, None until the first one
+        self._bytes = None
+        self._saves = 0
+        self._evict_lock = threading.Lock()
+
+    def _saved(self, size):
+        # Note a save that grew the store by size bytes, returns true if it is time to evict
+        with self._evict_lock:
+            self._saves += 1
+            if self._bytes is not None:
+                self._bytes += size
+            return self._bytes is None or self._bytes > self.max_bytes or self._saves >= self.evict_every
+
+    def _evicted(self, total):
+        # Note the bytes left after an eviction
+        with self._evict_lock:
+            self._bytes = total
+            self._saves = 0
+
+class FileSnapshotStore(SnapshotStore):
+    """
+    Snapshots kept as one file per result key in a directory.
+
+    A file's mtime is bumped every time it is read, so eviction removes the least recently viewed snapshots
+    first. Files are written to a temporary name and renamed into place, so any number of processes can share
+    the directory.
+    """
+    def __init__(self, path, max_bytes, max_age, evict_every=100):
+        SnapshotStore.__init__(self, path, max_bytes, max_age, evict_every)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.json.gz')
+
+    def exists(self, key):
+        """
+        Return true if there is a snapshot for key.
+        """
+        return os.path.exists(self._file(key))
+
+    def get(self, key):
+        """
+        Get the snapshot for key, or None if there isn't one.
+        """
+        name = self._file(key)
+        try:
+            with open(name, 'rb') as snapshot_file:
+                body = snapshot_file.read()
+            os.utime(name, None)
+        except (IOError, OSError):
+            return None
+        return body
+
+    def touch(self, key):
+        """
+        Note a view of the snapshot for key without reading it, as when a client revalidates its copy.
+
+        Returns true if there is a snapshot for key.
+        """
+        try:
+            os.utime(self._file(key), None)
+        except OSError:
+            return False
+        return True
+
+    def set(self, key, body):
+        """
+        Store the snapshot for key, then evict snapshots past max_age or max_bytes if it is time to.
+        """
+        name = self._file(key)
+        fd, temp_name = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as snapshot_file:
+                snapshot_file.write(body)
+            size = len(body)
+            try:
+                size -= os.path.getsize(name)
+            except OSError:
+                pass
+            os.rename(temp_name, name)
+        except (IOError, OSError):
+            logger.exception('Could not save the snapshot of {0}'.format(key))
+            try:
+                os.remove(temp_name)
+            except OSError:
+                pass
+            return
+        if self._saved(size):
+            self.evict()
+
+    def evict(self):
+        """
+        Remove snapshots not viewed in max_age seconds, then the least recently viewed until the store is back
+        under 90% of max_bytes.
+
+        Returns a tuple of the number of snapshots removed and the bytes they took up.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith('.json.gz'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+
+        removed = reclaimed = 0
+        cutoff = time.time() - self.max_age
+        over = total > self.max_bytes
+        # Oldest first, so the expired snapshots come before the rest
+        entries.sort()
+        for mtime, size, name in entries:
+            if mtime >= cutoff and (not over or total <= self.max_bytes * 0.9):
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                # Another process got to it first
+                pass
+            else:
+                removed += 1
+                reclaimed += size
+            total -= size
+        self._evicted(total)
+        return removed, reclaimed
+
+class DbSnapshotStore(SnapshotStore):
+    """
+    Snapshots kept in a SQLite database, for when the web and worker processes share a database file more easily
+    than a directory.
+    """
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS snapshots (
+        key TEXT PRIMARY KEY,
+        body BLOB NOT NULL,
+        size INTEGER NOT NULL,
+        viewed REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS snapshots_viewed ON snapshots (viewed);
+    """
+
+    def __init__(self, path, max_bytes, max_age, evict_every=100):
+        SnapshotStore.__init__(self, path, max_bytes, max_age, evict_every)
+        self._local = threading.local()
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self._connection().executescript(self.SCHEMA)
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def exists(self, key):
+        """
+        Return true if there is a snapshot for key.
+        """
+        return self._connection().execute('SELECT 1 FROM snapshots WHERE key = ?', (key,)).fetchone() is not None
+
+    def get(self, key):
+        """
+        Get the snapshot for key, or None if there isn't one.
+        """
+        conn = self._connection()
+        row = conn.execute('SELECT body, viewed FROM snapshots WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        # Views only matter to eviction, so don't write for every one
+        if now - row[1] > TOUCH_INTERVAL:
+            conn.execute('UPDATE snapshots SET viewed = ? WHERE key = ?', (now, key))
+        return str(row[0])
+
+    def touch(self, key):
+        """
+        Note a view of the snapshot for key without reading it, as when a client revalidates its copy.
+
+        Returns true if there is a snapshot for key.
+        """
+        now = time.time()
+        if self._connection().execute('UPDATE snapshots SET viewed = ? WHERE key = ? AND viewed < ?',
+                                      (now, key, now - TOUCH_INTERVAL)).rowcount:
+            return True
+        return self.exists(key)
+
+    def set(self, key, body):
+        """
+        Store the snapshot for key, then evict snapshots past max_age or max_bytes if it is time to.
+        """
+        self._connection().execute('INSERT OR REPLACE INTO snapshots (key, body, size, viewed) VALUES (?, ?, ?, ?)',
+                                   (key, sqlite3.Binary(body), len(body), time.time()))
+        if self._saved(len(body)):
+            self.evict()
+
+    def evict(self):
+        """
+        Remove snapshots not viewed in max_age seconds, then the least recently viewed until the store is back
+        under 90% of max_bytes.
+
+        Returns a tuple of the number of snapshots removed and the bytes they took up.
+        """
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            cutoff = time.time() - self.max_age
+            removed, reclaimed = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM snapshots WHERE viewed < ?',
+                                              (cutoff,)).fetchone()
+            conn.execute('DELETE FROM snapshots WHERE viewed < ?', (cutoff,))
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM snapshots').fetchone()[0]
+            if total > self.max_bytes:
+                keys = []
+                for key, size in conn.execute('SELECT key, size FROM snapshots ORDER BY viewed'):
+                    if total <= self.max_bytes * 0.9:
+                        break
+                    keys.append(key)
+                    total -= size
+                    removed += 1
+                    reclaimed += size
+                conn.executemany('DELETE FROM snapshots WHERE key = ?', [(key,) for key in keys])
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        self._evicted(total)
+        return removed, reclaimed
+
+BACKENDS = {
+    'file': FileSnapshotStore,
+    'db': DbSnapshotStore,
+}
+
+def get_config():
+    """
+    Get the snapshot settings, settings.SNAPSHOTS overrides DEFAULTS.
+    """
+    conf = dict(DEFAULTS)
+    conf.update(getattr(settings, 'SNAPSHOTS', {}))
+    return conf
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """
+    Get the snapshot store configured by settings.SNAPSHOTS, or None if snapshots are turned off.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            conf = get_config()
+            if not conf['PATH']:
+                return None
+            _store = green.threaded(green.call(BACKENDS[conf['BACKEND']], conf['PATH'], conf['MAX_BYTES'],
+                                               conf['MAX_AGE'], conf['EVICT_EVERY']))
+        return _store
+
+def save(key, markers, compact=None):
+    """
+    Save a snapshot of the markers for the passed result key, with compact the JSON of their compact encoding if
+    it has been worked out already. Failures are logged rather than raised, a job shouldn't fail because its
+    snapshot couldn't be kept.
+    """
+    store = get_store()
+    if store is None:
+        return
+    try:
+        store.set(key, snapshot_body(markers, compact))
+    except Exception as err:
+        logger.warning('Could not save the snapshot of {0}: {1}'.format(key, err))
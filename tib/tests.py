@@ -0,0 +1,709 @@
+"""
+Tests for the tib app, run with "manage.py test tib".
+
+The Wikipedia and Leximancer tests run against small local HTTP servers standing in for the real ones.
+"""
+import BaseHTTPServer
+import json
+import os
+import shutil
+import socket
+import SocketServer
+import tempfile
+import threading
+import time
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from tib import batch
+from tib import cache
+from tib import corpus
+from tib import httppool
+from tib import jobs
+from tib import payload
+from tib import serialize
+from tib import snapshots
+from tib import utils
+from tib import views
+from tib import wikipedia
+
+class StandIn(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Local HTTP/1.1 server answering every GET and POST with answer(handler), which returns a tuple of the status, a
+    dict of headers and the body. Counts the connections it gets and keeps the path, headers and body of each
+    request.
+    """
+    daemon_threads = True
+
+    def __init__(self, answer):
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                server.connections += 1
+                server.sockets.append(self.connection)
+
+            def do_GET(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                server.requests.append((self.path, dict(self.headers), self.rfile.read(length) if length else ''))
+                status, headers, body = answer(self)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                if headers.get('Transfer-Encoding') == 'chunked':
+                    self.end_headers()
+                    for start in xrange(0, len(body), 1000):
+                        piece = body[start:start + 1000]
+                        self.wfile.write('{0:x}\r\n{1}\r\n'.format(len(piece), piece))
+                    self.wfile.write('0\r\n\r\n')
+                else:
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+            do_POST = do_DELETE = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.connections = 0
+        self.sockets = []
+        self.requests = []
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{0}{1}'.format(self.server_address[1], path)
+
+    def stop(self):
+        """
+        Stop serving and hang up on the clients' keep-alive connections.
+        """
+        self.shutdown()
+        for sock in self.sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self.server_close()
+
+def article(paragraphs, see_also=0):
+    """
+    Build a Wikipedia like page with the passed number of paragraphs of prose and links in See also.
+    """
+    prose = ''.join('<p>Alice was beginning to get very tired of sitting by her sister on the bank.</p>'
+                    for i in xrange(paragraphs))
+    links = ''.join('<li><a href="/wiki/Rabbit_{0}">Rabbit hole number {0}</a></li>'.format(i) for i in xrange(see_also))
+    return ('<html><head><title>Alice</title></head><body><div id="content"><div id="bodyContent">'
+            '<div id="mw-content-text"><div class="mw-parser-output">{0}<h2>See also</h2><ul>{1}</ul></div></div>'
+            '</div></div><div id="footer">Footer</div></body></html>').format(prose, links)
+
+class FetchTextTest(SimpleTestCase):
+    def setUp(self):
+        self.overrides = override_settings(WIKI_CACHE={'PATH': None})
+        self.overrides.enable()
+        wikipedia._page_cache = None
+        httppool._connections = None
+
+    def tearDown(self):
+        httppool.get_connection_pool().clear()
+        self.overrides.disable()
+
+    def test_page_without_article(self):
+        body = '<html><body><p>{0}</p></body></html>'.format('No article here. ' * 50)
+        for headers in ({}, {'Transfer-Encoding': 'chunked'}):
+            server = StandIn(lambda handler: (200, dict(headers, **{'Content-Type': 'text/html'}), body))
+            text = wikipedia.fetch_text(server.url('/wiki/Nothing'))
+            self.assertIn('No article here.', text)
+            server.stop()
+
+    def test_connection_reused(self):
+        server = StandIn(lambda handler: (200, {'Content-Type': 'text/html'}, article(5)))
+        for i in xrange(3):
+            self.assertIn('Alice was beginning', wikipedia.fetch_text(server.url('/wiki/Alice')))
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual(server.connections, 1)
+        stats = httppool.get_connection_pool().stats()
+        self.assertEqual((stats['opened'], stats['reused'], stats['kept'], stats['idle']), (1, 2, 3, 1))
+        server.stop()
+
+    def test_trailing_sections_not_counted(self):
+        page = article(20, see_also=200)
+        kept = len(wikipedia.to_text(wikipedia.extract_article(page)))
+        server = StandIn(lambda handler: (200, {'Content-Type': 'text/html'}, page))
+        # See also has far more text than the limit allows, but it isn't kept
+        self.assertTrue(len(wikipedia.fetch_text(server.url('/wiki/Alice'), kept + 100)) <= kept + 100)
+        self.assertRaises(wikipedia.TextTooLong, wikipedia.fetch_text, server.url('/wiki/Alice'), kept // 2)
+        server.stop()
+
+class RestInvokeTest(SimpleTestCase):
+    """
+    Leximancer requests through the pool, against a stand-in.
+    """
+    def setUp(self):
+        self.overrides = override_settings(HTTP_POOL={'RETRIES': 0})
+        self.overrides.enable()
+        httppool._pool = None
+        self.server = StandIn(lambda handler: (200, {'Content-Type': 'text/plain'}, 'ok'))
+
+    def tearDown(self):
+        self.server.stop()
+        httppool._pool = None
+        self.overrides.disable()
+
+    def test_params_sent_like_lexrestclient(self):
+        self.assertIs(utils.lex.rest.rest_invoke, httppool.rest_invoke)
+        url = self.server.url('/lex3/c/projects/1/_/cluster/markersets/default/copy')
+        params = {'name': '@map1', 'themesize': 42}
+        for method in ('GET', 'POST', 'DELETE'):
+            httppool._lexrestclient_invoke(url, method=method, params=params, auth=('u', 'p'))
+            resp, content = httppool.rest_invoke(url, method=method, params=params, auth=('u', 'p'))
+            self.assertEqual(content, 'ok')
+            (their_path, their_headers, their_body), (path, headers, body) = self.server.requests[-2:]
+            self.assertEqual(sorted(path.split('?', 1)[-1].split('&')), sorted(their_path.split('?', 1)[-1].split('&')))
+            self.assertEqual(path.split('?')[0], their_path.split('?')[0])
+            self.assertEqual(sorted(body.split('&')), sorted(their_body.split('&')))
+            self.assertEqual(headers.get('content-type'), their_headers.get('content-type'))
+
+    def test_pool_counts_reuse(self):
+        for i in xrange(3):
+            httppool.rest_invoke(self.server.url('/lex3/c/start/app'), auth=('u', 'p'))
+        stats = httppool.get_pool().stats()
+        self.assertEqual((stats['requests'], stats['opened'], stats['reused']), (3, 1, 2))
+        self.assertEqual(self.server.connections, 1)
+
+class UploadTextTest(SimpleTestCase):
+    """
+    Uploads text to a stand-in for a project's docset, which asks for credentials like Leximancer does.
+    """
+    def setUp(self):
+        self.overrides = override_settings(HTTP_POOL={'RETRIES': 0})
+        self.overrides.enable()
+        httppool._pool = None
+        self.status = 201
+        self.server = StandIn(self.answer)
+        self.lex_server = utils.LexServer('stand-in', self.server.url('/lex3/c/start/app'), ('u', 'p'))
+        self.docset = Project(self.server.url('/lex3/c/projects/alice/docset'))
+
+    def tearDown(self):
+        self.server.stop()
+        httppool._pool = None
+        self.overrides.disable()
+
+    def answer(self, handler):
+        if 'Authorization' not in handler.headers:
+            return 401, {'WWW-Authenticate': 'Basic realm="Leximancer"'}, ''
+        return self.status, {}, ''
+
+    def test_upload(self):
+        utils.upload_text(self.docset, 'alice.txt', u'Alice was beginning to get very tired\u2026', self.lex_server)
+        path, headers, body = self.server.requests[-1]
+        self.assertEqual(path, '/lex3/c/projects/alice/docset/alice.txt')
+        self.assertEqual(headers['x-http-method-override'], 'PUT')
+        self.assertEqual(headers['content-type'], 'text/plain')
+        self.assertEqual(headers['authorization'], 'Basic dTpw')
+        self.assertEqual(body, 'Alice was beginning to get very tired')
+
+    def test_upload_refused(self):
+        self.status = 404
+        self.assertRaises(utils.ResourceError, utils.upload_text, self.docset, 'alice.txt', 'Alice', self.lex_server)
+
+class IterencodeTest(SimpleTestCase):
+    """
+    serialize.iterencode streams a status response with long compact columns in chunks near CHUNK_SIZE.
+    """
+    def setUp(self):
+        count = 20000
+        self.response = {
+            'status': 'COMPLETE',
+            'markers': {
+                'format': 1,
+                'concepts': {
+                    'id': range(count),
+                    'x': [i * 0.125 for i in xrange(count)],
+                    'related': [[i, 0.5, 2, 0.25] for i in xrange(count)],
+                },
+            },
+        }
+
+    def test_columns_chunked(self):
+        for compact in (True, False):
+            chunks = list(serialize.iterencode(self.response, compact))
+            self.assertEqual(json.loads(''.join(chunks)), self.response)
+            self.assertTrue(len(chunks) > 5)
+            # A chunk goes over CHUNK_SIZE by at most one slice of a column
+            self.assertTrue(max(len(chunk) for chunk in chunks[:-1]) < serialize.CHUNK_SIZE + 32 * 1024)
+
+    def test_short_columns_whole(self):
+        self.assertEqual(list(serialize._pieces([1, 2, 3], 0, serialize.get_encoder(), True)), ['[1,2,3]'])
+
+class PageCacheTest(SimpleTestCase):
+    """
+    Fetches through a page cache that revalidates every page with the stand-in each time.
+    """
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.overrides = override_settings(WIKI_CACHE={'PATH': self.path, 'MAX_AGE': 0})
+        self.overrides.enable()
+        wikipedia._page_cache = None
+        httppool._connections = None
+        self.version = 'v1'
+        self.server = StandIn(self.answer)
+
+    def tearDown(self):
+        self.server.stop()
+        httppool.get_connection_pool().clear()
+        wikipedia._page_cache = None
+        self.overrides.disable()
+        shutil.rmtree(self.path)
+
+    def answer(self, handler):
+        etag = '"{0}"'.format(self.version)
+        if handler.headers.get('If-None-Match') == etag:
+            return 304, {'ETag': etag}, ''
+        page = article(3).replace('Alice was', 'Alice ({0}) was'.format(self.version))
+        return 200, {'Content-Type': 'text/html', 'ETag': etag}, page
+
+    def test_not_modified_reuses_text(self):
+        url = self.server.url('/wiki/Alice')
+        first = wikipedia.fetch_text(url)
+        self.assertIn('Alice (v1) was', first)
+        self.assertEqual(wikipedia.fetch_text(url), first)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertNotIn('if-none-match', self.server.requests[0][1])
+        self.assertEqual(self.server.requests[1][1]['if-none-match'], '"v1"')
+
+    def test_changed_page_replaces_text(self):
+        url = self.server.url('/wiki/Alice')
+        wikipedia.fetch_text(url)
+        self.version = 'v2'
+        text = wikipedia.fetch_text(url)
+        self.assertIn('Alice (v2) was', text)
+        self.assertNotIn('v1', text)
+        # The new version is what's cached and revalidated from now on
+        self.assertEqual(wikipedia.fetch_text(url), text)
+        self.assertEqual(self.server.requests[2][1]['if-none-match'], '"v2"')
+
+    def test_evicts_without_scanning_every_write(self):
+        entry = {'url': None, 'etag': None, 'last_modified': None, 'fetched': 0, 'text': 'x' * 1000}
+        cache = wikipedia.PageCache(self.path, 100 * 1024, 0, evict_every=10)
+        scans = []
+        evict = cache.evict
+        cache.evict = lambda: scans.append(evict())
+        for i in xrange(30):
+            cache.set('page{0}'.format(i), entry)
+        # One scan to learn the size, then one every ten writes
+        self.assertEqual(scans, [(0, 0)] * 3)
+
+        # Writing past max_bytes scans straight away, and only then
+        cache.max_bytes = 35 * 1024
+        cache.evict_every = 1000
+        for i in xrange(30, 40):
+            cache.set('page{0}'.format(i), entry)
+        self.assertTrue(len(scans) > 3)
+        self.assertTrue(all(removed > 0 for removed, reclaimed in scans[3:]))
+        self.assertIsNotNone(cache.get('page39'))
+        self.assertIsNone(cache.get('page0'))
+
+class SnapshotStoreTest(SimpleTestCase):
+    """
+    Eviction in both snapshot stores.
+    """
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def check_evicts_without_scanning_every_save(self, store):
+        scans = []
+        evict = store.evict
+        store.evict = lambda: scans.append(evict())
+        body = 'x' * 1000
+        for i in xrange(30):
+            store.set('snapshot{0}'.format(i), body)
+        # One eviction to learn the size, then one every ten saves
+        self.assertEqual(scans, [(0, 0)] * 3)
+
+        # Saving past max_bytes evicts straight away, and only then
+        store.max_bytes = 35 * 1000
+        store.evict_every = 1000
+        for i in xrange(30, 40):
+            store.set('snapshot{0}'.format(i), body)
+        self.assertTrue(len(scans) > 3)
+        self.assertTrue(all(removed > 0 for removed, reclaimed in scans[3:]))
+        self.assertIsNotNone(store.get('snapshot39'))
+        self.assertIsNone(store.get('snapshot0'))
+
+    def test_file_store(self):
+        self.check_evicts_without_scanning_every_save(snapshots.FileSnapshotStore(self.path, 100 * 1000, 60, 10))
+
+    def test_db_store(self):
+        store = snapshots.DbSnapshotStore(os.path.join(self.path, 'snapshots.db'), 100 * 1000, 60, 10)
+        self.check_evicts_without_scanning_every_save(store)
+
+class ChooseServerTest(SimpleTestCase):
+    """
+    Schedules on three stand-in Leximancer servers: a fast one, a slow one and a broken one. Each job step is a
+    GET of its server, run through jobs.run_claimed so the server's health and latency are recorded as for a real
+    step.
+    """
+    def setUp(self):
+        self.fast = StandIn(lambda handler: (200, {}, 'ok'))
+        def slowly(handler):
+            time.sleep(0.05)
+            return 200, {}, 'ok'
+        self.slow = StandIn(slowly)
+        self.broken = StandIn(lambda handler: (500, {}, 'down'))
+        self.stand_ins = (self.fast, self.slow, self.broken)
+        servers = [{'NAME': name, 'URL': stand_in.url('/lex'), 'AUTH': ('u', 'p')}
+                   for name, stand_in in zip(('fast', 'slow', 'broken'), self.stand_ins)]
+        self.overrides = override_settings(LEX_SERVERS=servers, LEX_SERVER_MAX_FAILURES=3, LEX_SERVER_DRAIN_TIME=60,
+                                           HTTP_POOL={'RETRIES': 0})
+        self.overrides.enable()
+        utils._servers = None
+        httppool._pool = None
+        self.run_step = jobs.run_step
+        self.fail_step = jobs.fail_step
+        jobs.run_step = self.step
+        jobs.fail_step = lambda store, job, conf, err: None
+
+    def tearDown(self):
+        jobs.run_step = self.run_step
+        jobs.fail_step = self.fail_step
+        for stand_in in self.stand_ins:
+            stand_in.stop()
+        utils._servers = None
+        httppool._pool = None
+        self.overrides.disable()
+
+    def step(self, store, job, conf):
+        server = utils.get_server(job['server'])
+        resp, content = httppool.rest_invoke(server.url, auth=server.auth)
+        if resp.status != 200:
+            raise utils.ResourceError('{0} answered {1}'.format(server.name, resp.status))
+
+    def run_on(self, name, times=1):
+        for i in xrange(times):
+            jobs.run_claimed(None, {'id': i, 'server': name}, {})
+
+    def test_fewest_active_first(self):
+        self.assertEqual(utils.choose_server({'fast': 2, 'slow': 1}).name, 'broken')
+        self.assertEqual(utils.choose_server({'fast': 1, 'slow': 0, 'broken': 1}).name, 'slow')
+
+    def test_ties_broken_on_latency(self):
+        self.run_on('slow')
+        self.run_on('fast')
+        self.assertTrue(utils.get_server('slow').latency > utils.get_server('fast').latency)
+        self.assertEqual(utils.choose_server({'broken': 1}).name, 'fast')
+        # Fewer active projects still win over a lower latency
+        self.assertEqual(utils.choose_server({'fast': 1, 'broken': 1}).name, 'slow')
+
+    def test_failures_drain_server(self):
+        broken = utils.get_server('broken')
+        self.run_on('broken', 2)
+        self.assertEqual(broken.failures, 2)
+        self.assertTrue(broken.healthy())
+        self.run_on('broken')
+        self.assertEqual(len(self.broken.requests), 3)
+        self.assertFalse(broken.healthy())
+        self.assertEqual(broken.failures, 0)
+        self.assertEqual(utils.choose_server({'fast': 1, 'slow': 1}).name, 'fast')
+
+        # A success in between starts the count again
+        slow = utils.get_server('slow')
+        slow.record_failure()
+        slow.record_failure()
+        self.run_on('slow')
+        slow.record_failure()
+        self.assertTrue(slow.healthy())
+
+    def test_all_drained_or_full(self):
+        for server in utils.get_servers():
+            server.max_running = 1
+        self.run_on('broken', 3)
+        self.assertEqual(utils.choose_server({'fast': 1}).name, 'slow')
+        self.assertEqual(utils.choose_server({'fast': 1, 'slow': 1}), None)
+
+    def test_concurrent_failures_counted(self):
+        fast = utils.get_server('fast')
+        threads = [threading.Thread(target=fast.record_failure) for i in xrange(30)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Every failure was counted, draining the server after each three
+        self.assertEqual(fast.failures, 0)
+        self.assertFalse(fast.healthy())
+
+class Project(object):
+    def __init__(self, href):
+        self.href = href
+
+class StoreTestCase(SimpleTestCase):
+    """
+    Base class for tests that queue jobs, in a job store and TEXT_PATH of their own. Subclasses add settings of
+    their own in extra_settings.
+    """
+    extra_settings = {}
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.text_path = os.path.join(self.path, 'text')
+        self.overrides = override_settings(TEXT_PATH=self.text_path, JOBS={'PATH': os.path.join(self.path, 'jobs.db')},
+                                           SNAPSHOTS={'PATH': None}, **self.extra_settings)
+        self.overrides.enable()
+        jobs._store = None
+        utils._servers = None
+
+    def tearDown(self):
+        jobs._store = None
+        utils._servers = None
+        self.overrides.disable()
+        shutil.rmtree(self.path)
+
+class CreateProjectTest(StoreTestCase):
+    """
+    Runs the step that creates a job's project with utils.create_lex_project swapped for one that notes what it was
+    asked to create.
+    """
+    extra_settings = {'UPLOAD_TEXT': True}
+
+    def setUp(self):
+        StoreTestCase.setUp(self)
+        self.created = []
+        self.create_lex_project = utils.create_lex_project
+        utils.create_lex_project = self.create
+
+    def tearDown(self):
+        utils.create_lex_project = self.create_lex_project
+        StoreTestCase.tearDown(self)
+
+    def create(self, name, doc, server=None, text=None, created=None):
+        self.created.append((name, doc, text))
+        project = Project('http://lex.invalid/projects/{0}/'.format(name))
+        if created is not None:
+            created(project)
+        return project
+
+    def run_next_step(self):
+        store = jobs.get_store()
+        job = store.claim()
+        jobs.run_step(store, job, jobs.get_config())
+        return store.get(job['id'])
+
+    def test_one_part_sample_uploaded(self):
+        book = '\n\n'.join('Chapter {0}. It was a bright cold day in April, and the clocks were striking thirteen.'.format(i)
+                            for i in xrange(100))
+        sample = corpus.sample_upload(SimpleUploadedFile('book.txt', book))
+        self.assertEqual(len(sample.parts), 1)
+        id = jobs.submit_sample(sample)
+        job = self.run_next_step()
+        self.assertEqual(job['state'], jobs.RUNNING)
+        self.assertEqual(job['uploaded'], 1)
+        name, doc, text = self.created[0]
+        self.assertEqual(doc, job['doc'].split())
+        self.assertEqual(len(text), 1)
+        self.assertIn('Chapter 99. It was a bright cold day', text[0])
+
+    def test_submitted_text_uploaded(self):
+        text = 'It was a bright cold day in April, and the clocks were striking thirteen. ' * 100
+        id = jobs.submit(cache.result_key(text), text)
+        job = self.run_next_step()
+        self.assertEqual(job['uploaded'], 1)
+        self.assertEqual(self.created[0][2], [text])
+        # Nothing was written to TEXT_PATH
+        self.assertFalse(os.path.exists(self.text_path))
+
+class BatchTest(StoreTestCase):
+    """
+    Submits batches with wikipedia.fetch_text swapped for one that notes the articles it was asked for.
+    """
+    def setUp(self):
+        StoreTestCase.setUp(self)
+        self.fetched = []
+        self.fetch_text = wikipedia.fetch_text
+        wikipedia.fetch_text = self.fetch
+
+    def tearDown(self):
+        wikipedia.fetch_text = self.fetch_text
+        StoreTestCase.tearDown(self)
+
+    def fetch(self, url, max_chars=None):
+        self.fetched.append(url)
+        if url.endswith('/Missing'):
+            raise wikipedia.FetchError('Wikipedia answered 404 Not Found.')
+        return '{0} was beginning to get very tired of sitting by her sister on the bank. '.format(url) * 100
+
+    def test_articles_fetched_by_workers(self):
+        text = 'It was a bright cold day in April, and the clocks were striking thirteen. ' * 100
+        id, items = batch.submit([{'text': text}, {'url': 'en.wikipedia.org/wiki/Alice'},
+                                  {'url': 'http://example.com/Alice'}, {'url': 'en.wikipedia.org/wiki/Missing'}])
+        # The batch is recorded before any article is fetched
+        self.assertEqual(self.fetched, [])
+        self.assertIn('id', items[0])
+        self.assertEqual(items[1], {'url': 'http://en.wikipedia.org/wiki/Alice'})
+        self.assertIn('not a Wikipedia article', items[2]['error'])
+        status = batch.status(id)
+        self.assertEqual(status['counts'], {jobs.QUEUED: 3, jobs.RUNNING: 0, jobs.DONE: 0, jobs.FAILED: 1})
+        self.assertEqual(status['items'][1]['message'], 'Fetching the article...')
+
+        store = jobs.get_store()
+        for i in xrange(2):
+            jobs.fetch_step(store, store.claim_fetch())
+        self.assertIsNone(store.claim_fetch())
+        self.assertEqual(sorted(self.fetched), ['http://en.wikipedia.org/wiki/Alice',
+                                                'http://en.wikipedia.org/wiki/Missing'])
+        items = store.get_batch(id)
+        self.assertEqual(store.get(items[1]['id'])['state'], jobs.QUEUED)
+        self.assertEqual(items[3], {'error': 'Wikipedia answered 404 Not Found.'})
+        self.assertEqual(batch.status(id)['counts'], {jobs.QUEUED: 2, jobs.RUNNING: 0, jobs.DONE: 0, jobs.FAILED: 2})
+
+    def test_fetch_leased(self):
+        store = jobs.get_store()
+        store.lease = 0.05
+        id, items = batch.submit([{'url': 'en.wikipedia.org/wiki/Alice'}])
+        fetch = store.claim_fetch()
+        self.assertEqual(fetch['url'], 'http://en.wikipedia.org/wiki/Alice')
+        self.assertIsNone(store.claim_fetch())
+        # A worker that died mid fetch leaves the item to be fetched again
+        time.sleep(0.1)
+        jobs.fetch_step(store, store.claim_fetch())
+        self.assertIn('id', store.get_batch(id)[0])
+
+class JobStoreTest(StoreTestCase):
+    """
+    Admission control, leases and retries of the job queue.
+    """
+    def store(self, **options):
+        return jobs.JobStore(os.path.join(self.path, 'jobs.db'), **options)
+
+    def test_queue_full(self):
+        store = self.store(max_queued=2, retry_after=30)
+        first, created = store.add('a', 'a.txt')
+        store.add('b', 'b.txt')
+        try:
+            store.add('c', 'c.txt')
+        except jobs.QueueFull as err:
+            self.assertEqual(err.retry_after, 30)
+        else:
+            self.fail('QueueFull not raised')
+        # Identical submissions still join the queued job
+        self.assertEqual(store.add('a', 'a.txt'), (first, False))
+
+    def test_queue_full_response(self):
+        jobs._store = self.store(max_queued=0, retry_after=30)
+        text = 'It was a bright cold day in April, and the clocks were striking thirteen. ' * 100
+        response = views.result(RequestFactory().post('/result/', {'text_content': text}))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '30')
+        # The text written for the job that couldn't be queued is removed
+        self.assertEqual(os.listdir(self.text_path), [])
+
+    def test_max_running(self):
+        store = self.store(max_running=1)
+        store.add('a', 'a.txt')
+        store.add('b', 'b.txt')
+        job = store.claim()
+        self.assertEqual(job['key'], 'a')
+        # A project being created counts as running
+        self.assertIsNone(store.claim())
+        store.update(job['id'], state=jobs.RUNNING, next_run=time.time() + 60)
+        self.assertIsNone(store.claim())
+        store.update(job['id'], state=jobs.DONE)
+        self.assertEqual(store.claim()['key'], 'b')
+
+    def test_max_per_client(self):
+        store = self.store(max_per_client=1)
+        store.add('a1', 'a1.txt', client='10.0.0.1')
+        store.add('a2', 'a2.txt', client='10.0.0.1')
+        store.add('b1', 'b1.txt', client='10.0.0.2')
+        self.assertEqual(store.claim()['key'], 'a1')
+        # The first client's second job waits for its first
+        self.assertEqual(store.claim()['key'], 'b1')
+        self.assertIsNone(store.claim())
+
+    def test_lease_expires(self):
+        store = self.store(lease=0.05)
+        id, created = store.add('a', 'a.txt')
+        self.assertEqual(store.claim()['id'], id)
+        self.assertIsNone(store.claim())
+        # The worker that claimed it died, another picks it up
+        time.sleep(0.1)
+        self.assertEqual(store.claim()['id'], id)
+
+    def test_retry_backoff(self):
+        store = self.store()
+        conf = dict(jobs.get_config(), MAX_ATTEMPTS=3, RETRY_BACKOFF=0.05)
+        id, created = store.add('a', 'a.txt')
+        for attempt, backoff in ((1, 0.05), (2, 0.1)):
+            jobs.fail_step(store, store.claim(), conf, utils.ResourceError('Leximancer is down'))
+            job = store.get(id)
+            self.assertEqual((job['state'], job['attempts']), (jobs.QUEUED, attempt))
+            self.assertAlmostEqual(job['next_run'] - job['updated'], backoff, places=2)
+            self.assertIsNone(store.claim())
+            time.sleep(backoff + 0.01)
+        jobs.fail_step(store, store.claim(), conf, utils.ResourceError('Leximancer is down'))
+        job = store.get(id)
+        self.assertEqual((job['state'], job['attempts']), (jobs.FAILED, 3))
+        self.assertIsNone(store.claim())
+
+    def test_queue_position(self):
+        store = self.store()
+        ids = [store.add(key, key + '.txt')[0] for key in 'abc']
+        self.assertEqual([store.queue_position(store.get(id)) for id in ids], [1, 2, 3])
+        # The first job's project is being created, it has left the queue
+        store.claim()
+        self.assertEqual([store.queue_position(store.get(id)) for id in ids], [0, 1, 2])
+
+class CompactStatusTest(StoreTestCase):
+    """
+    The status view sends the compact encoding cached when the job finished rather than working it out again.
+    """
+    def setUp(self):
+        super(CompactStatusTest, self).setUp()
+        self.key = cache.result_key('Alice was beginning to get very tired {0}'.format(time.time()))
+        concepts = dict((str(i), {'id': i, 'value': 'concept{0}'.format(i), 'kind': 'word', 'weight': i,
+                                  'frequency': 2, 'x': 0.5, 'y': 0.25, 'themeId': 0, 'mstEdges': [{'to': (i + 1) % 3}],
+                                  'related': [{'id': str((i + 1) % 3), 'strength': '0.5', 'count': '2', 'prom': '1.5'}]})
+                        for i in range(3))
+        themes = {'0': {'id': 0, 'name': 'concept0', 'hue': 120, 'connectivity': 100}}
+        self.markers = {'concepts': concepts, 'themes': themes, 'iprom': [{'from': 0, 'to': 1, 'weight': 3}],
+                        'numBlocks': '4', 'cloud': {}, 'graph': {}}
+        self.compact_markers = payload.compact_markers
+
+    def tearDown(self):
+        payload.compact_markers = self.compact_markers
+        super(CompactStatusTest, self).tearDown()
+
+    def status(self):
+        response = views.job_status(self.key, True)[0]
+        return json.loads(''.join(response))['markers']
+
+    def test_cached_when_saved(self):
+        jobs.save_result(self.key, self.markers)
+        expected = json.loads(cache.get_compact(self.key))
+        self.assertEqual(expected, json.loads(json.dumps(self.compact_markers(self.markers))))
+
+        def compact_markers(markers):
+            raise AssertionError('The compact encoding was worked out again')
+        payload.compact_markers = compact_markers
+        self.assertEqual(self.status(), expected)
+        # The snapshot is built from the same JSON
+        body = json.loads(snapshots.decompress(snapshots.snapshot_body(self.markers, cache.get_compact(self.key))))
+        self.assertEqual(body['markers'], expected)
+
+    def test_cached_on_first_request(self):
+        # Results cached before the compact encoding was
+        cache.set_result(self.key, self.markers)
+        self.assertIsNone(cache.get_compact(self.key))
+        expected = self.status()
+        self.assertEqual(json.loads(cache.get_compact(self.key)), expected)
+        # Clients that don't ask for it still get the markers as they are
+        self.assertEqual(json.loads(''.join(views.job_status(self.key)[0]))['markers']['numBlocks'], '4')
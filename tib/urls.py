@@ -30,6 +30,12 @@ urlpatterns = patterns('',
     url(r'^feedback/send/$', 'tib.views.feedback', name='send_feedback'),
     url(r'^result/$', 'tib.views.result', name='result'),
     url (r'^result/([\w=%-]+)/$', 'tib.views.status', name='job_status'),
+    url (r'^result/([\w=%-]+)/wait/$', 'tib.views.status_wait', name='job_status_wait'),
+    url(r'^v/([0-9a-f]{40})/$', 'tib.views.permalink', name='permalink'),
+    url(r'^v/([0-9a-f]{40})/markers/$', 'tib.views.snapshot', name='snapshot'),
+    url(r'^batch/$', 'tib.views.batch_submit', name='batch'),
+    url(r'^batch/([0-9a-f]+)/$', 'tib.views.batch_status', name='batch_status'),
+    url(r'^batch/([0-9a-f]+)/markers/$', 'tib.views.batch_markers', name='batch_markers'),
 
     # Blog
     url(r'^blog/', include('zinnia.urls')),
@@ -1,9 +1,22 @@
+import logging
 import os
+import Queue
+import sys
+import threading
+from io import BytesIO
 from django.conf import settings
 import lexrestclient as lex
-import lxml
+from lxml import etree
 import math
+import re
 import time
+import urlparse
+from tib import httppool
+
+logger = logging.getLogger('tib')
+
+# Send all Leximancer traffic over the worker's shared keep-alive connections
+httppool.install_lexrestclient()
 
 class ResourceError(Exception):
     """
@@ -30,18 +43,19 @@ STATUS_MAP = {
     'CLUSTER': 90,
 }
 
-def get_project_folder():
+def get_project_folder(server=None):
     """
     Get the project folder with he name specified in the PROJECT_FOLDER setting.
 
     Returns the lex object (as returned by lexrestclient) representing the project folder.
     """
-    start = lex.LexObject.from_url(settings.LEX_URL, auth=settings.LEX_AUTH)
+    server = server or get_servers()[0]
+    start = lex.LexObject.from_url(server.url, auth=server.auth)
 
     if isinstance(start, lex.Instance):
         top_folder = None
         for pf in start.project_folder:
-            folder = lex.LexObject.from_url(pf.href, auth=settings.LEX_AUTH)
+            folder = lex.LexObject.from_url(pf.href, auth=server.auth)
             if folder.name == settings.TOP_PROJECT_FOLDER:
                 top_folder = folder
                 break
@@ -49,30 +63,31 @@ def get_project_folder():
         user_folder = None
         if top_folder is not None:
             for f in top_folder.project_folder:
-                uf = lex.LexObject.from_url(f.href, auth=settings.LEX_AUTH)
-                if uf.name == settings.LEX_AUTH[0]:
+                uf = lex.LexObject.from_url(f.href, auth=server.auth)
+                if uf.name == server.auth[0]:
                     user_folder = uf
                     break
         else:
             raise ResourceError('Couldn\'t find the top level project folder "{0}".'.format(settings.TOP_PROJECT_FOLDER))
 
         if user_folder is None:
-            raise ResourceError('Couldn\'t find the user project folder "{0}".'.format(settings.LEX_AUTH[0]))
+            raise ResourceError('Couldn\'t find the user project folder "{0}".'.format(server.auth[0]))
 
         return user_folder
 
-def get_data_folder():
+def get_data_folder(server=None):
     """
     Get the data folder with he name specified in the DATA_FOLDER setting.
 
     Returns the lex object (as returned by lexrestclient) representing the data folder.
     """
-    start = lex.LexObject.from_url(settings.LEX_URL, auth=settings.LEX_AUTH)
+    server = server or get_servers()[0]
+    start = lex.LexObject.from_url(server.url, auth=server.auth)
 
     if isinstance(start, lex.Instance):
         top_folder = None
         for df in start.data_folder:
-            folder = lex.LexObject.from_url(df.href, auth=settings.LEX_AUTH)
+            folder = lex.LexObject.from_url(df.href, auth=server.auth)
             if folder.name == settings.TOP_DATA_FOLDER:
                 top_folder = folder
                 break
@@ -85,45 +100,343 @@ def get_data_folder():
             raise ResourceError('Couldn\'t find the top level data folder "{0}".'.format(settings.TOP_DATA_FOLDER))
         raise ResourceError('Couldn\'t  find the data folder "{0}".'.format(settings.DATA_FOLDER))
 
-def create_lex_project(name, doc, mimetype=None):
+def folder_gone(err, folder, server):
+    """
+    Return true if a call on a cached folder failed because the folder is no longer there, so it is worth finding
+    the folder again and retrying. That is a ResourceError, or the folder itself answering 404 or 410. Other
+    failures, timeouts and server errors say, aren't retried here: a create that timed out may still have gone
+    through and repeating it would make a second project.
+    """
+    if isinstance(err, ResourceError):
+        return True
+    try:
+        resp, content = httppool.rest_invoke(folder.href, auth=server.auth)
+    except StandardError:
+        # Can't tell, so the original failure stands
+        return False
+    return resp.status in (404, 410)
+
+class FolderCache(object):
+    """
+    Per process cache of a Leximancer folder found by walking the server (see get_project_folder and
+    get_data_folder).
+
+    The first call to get loads the folder. After ttl seconds the cached folder is still handed out but a
+    background thread fetches a fresh one. Call invalidate when the folder turns out to be gone (eg. a 404)
+    so the next get walks the server again.
+    """
+    def __init__(self, loader, ttl):
+        self.loader = loader
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._folder = None
+        self._loaded = 0
+        self._refreshing = False
+
+    def get(self):
+        """
+        Get the folder, loading it if it isn't cached.
+        """
+        with self._lock:
+            folder = self._folder
+            stale = folder is not None and not self._refreshing and time.time() - self._loaded > self.ttl
+            if stale:
+                self._refreshing = True
+        if folder is None:
+            return self.refresh()
+        if stale:
+            refresher = threading.Thread(target=self._refresh_quietly)
+            refresher.daemon = True
+            refresher.start()
+        return folder
+
+    def refresh(self):
+        """
+        Walk the server for the folder now and cache it.
+        """
+        folder = None
+        try:
+            folder = self.loader()
+        finally:
+            with self._lock:
+                if folder is not None:
+                    self._folder = folder
+                    self._loaded = time.time()
+                self._refreshing = False
+        return folder
+
+    def invalidate(self):
+        """
+        Forget the cached folder.
+        """
+        with self._lock:
+            self._folder = None
+
+    def _refresh_quietly(self):
+        try:
+            self.refresh()
+        except StandardError as err:
+            # Keep handing out the old folder, if it's really gone the caller will invalidate it.
+            logger.warning('Refreshing Leximancer folder failed: {0}'.format(err))
+
+class LexServer(object):
+    """
+    A Leximancer server projects can be scheduled on, configured by an entry in settings.LEX_SERVERS.
+
+    Keeps its own folder caches and the health and latency figures choose_server schedules with. These are
+    per process, each job worker learns them for itself.
+    """
+    def __init__(self, name, url, auth, max_running=None):
+        self.name = name
+        self.url = url
+        self.auth = auth
+        self.max_running = max_running
+        ttl = getattr(settings, 'LEX_FOLDER_CACHE_TTL', 300)
+        self.project_folder_cache = FolderCache(lambda: get_project_folder(self), ttl)
+        self.data_folder_cache = FolderCache(lambda: get_data_folder(self), ttl)
+        # Exponentially weighted average of request times (seconds), None until something is timed
+        self.latency = None
+        self.failures = 0
+        self.drained_until = 0
+        # Job worker threads finish steps on the same server at once
+        self._lock = threading.Lock()
+
+    def owns(self, url):
+        """
+        Return true if the passed Leximancer URL is on this server.
+        """
+        return _origin(url) == _origin(self.url)
+
+    def healthy(self):
+        """
+        Return true if new projects can be scheduled here.
+        """
+        return time.time() >= self.drained_until
+
+    def record_success(self, elapsed):
+        """
+        Note a request to this server that took elapsed seconds.
+        """
+        with self._lock:
+            self.failures = 0
+            self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+
+    def record_failure(self):
+        """
+        Note a failed request. Too many in a row drains the server: it gets no new projects for a while.
+        """
+        with self._lock:
+            self.failures += 1
+            if self.failures < getattr(settings, 'LEX_SERVER_MAX_FAILURES', 3):
+                return
+            failures, self.failures = self.failures, 0
+            self.drained_until = time.time() + getattr(settings, 'LEX_SERVER_DRAIN_TIME', 60)
+        logger.warning('Draining Leximancer server {0} after {1} failures.'.format(self.name, failures))
+
+def _origin(url):
+    scheme, netloc = urlparse.urlsplit(url)[:2]
+    return scheme.lower(), netloc.lower()
+
+_servers = None
+
+def get_servers():
+    """
+    Get the Leximancer servers from settings.LEX_SERVERS, or the single LEX_URL/LEX_AUTH server if that isn't set.
+    """
+    global _servers
+    if _servers is None:
+        confs = getattr(settings, 'LEX_SERVERS', None) or [{'NAME': 'default', 'URL': settings.LEX_URL, 'AUTH': settings.LEX_AUTH}]
+        _servers = [LexServer(c['NAME'], c['URL'], c['AUTH'], c.get('MAX_RUNNING')) for c in confs]
+    return _servers
+
+def get_server(name):
+    """
+    Get the server with the passed name. Falls back to the first server for jobs from before it was renamed.
+    """
+    for server in get_servers():
+        if server.name == name:
+            return server
+    return get_servers()[0]
+
+def server_for_url(url):
+    """
+    Get the server a Leximancer URL belongs to.
+    """
+    for server in get_servers():
+        if server.owns(url):
+            return server
+    return get_servers()[0]
+
+def choose_server(active):
+    """
+    Choose the server to run a new project on: the healthy server with the fewest active projects, breaking ties on
+    recent latency. active maps server names to their number of active projects.
+
+    Returns None if every server is drained or full.
+    """
+    candidates = []
+    for server in get_servers():
+        running = active.get(server.name, 0)
+        if not server.healthy() or (server.max_running is not None and running >= server.max_running):
+            continue
+        candidates.append((running, server.latency or 0, server))
+    if not candidates:
+        return None
+    return min(candidates, key=lambda c: c[:2])[2]
+
+def run_steps(steps, workers):
+    """
+    Run a dependency graph of steps, each on its own thread as soon as the steps it needs are done, up to workers of
+    them at once.
+
+    steps is a list of (name, needs, fn) tuples, where needs are the names of the steps that must finish first and
+    fn is called with a dict of the results of the steps finished so far. If a step raises, no more are started,
+    the ones under way are waited for and the exception is raised again.
+
+    Returns a tuple of dicts mapping each step's name to its result and to the seconds it took.
+    """
+    results = {}
+    timings = {}
+    finished = Queue.Queue()
+
+    def call(name, fn):
+        start = time.time()
+        try:
+            finished.put((name, fn(results), None, time.time() - start))
+        except Exception:
+            finished.put((name, None, sys.exc_info(), time.time() - start))
+
+    pending = list(steps)
+    running = 0
+    error = None
+    while (pending and error is None) or running:
+        if error is None:
+            ready = [step for step in pending if all(need in results for need in step[1])]
+            if not ready and not running:
+                raise ValueError('Steps {0} need steps that never run.'.format(', '.join(step[0] for step in pending)))
+            for step in ready[:max(1, workers) - running]:
+                pending.remove(step)
+                # Not a multiprocessing ThreadPool, closing one polls for 100ms, longer than the steps it would save
+                thread = threading.Thread(target=call, args=(step[0], step[2]), name=step[0])
+                thread.daemon = True
+                thread.start()
+                running += 1
+        name, result, failure, elapsed = finished.get()
+        running -= 1
+        timings[name] = elapsed
+        if failure is None:
+            results[name] = result
+        elif error is None:
+            error = failure
+    if error is not None:
+        raise error[0], error[1], error[2]
+    return results, timings
+
+def create_lex_project(name, doc, mimetype=None, server=None, text=None, created=None):
     """
-    Create a project with the passed name and start it running.
+    Create a project with the passed name on the passed server (the first server by default) and start it running.
+
+    If text is passed it is uploaded to the project's docset as the document doc, otherwise doc is a file written
+    by save_text that the server reads through its data folder. doc can also be a list of documents, with text a
+    matching list, to give the docset several files.
+
+    The REST calls that don't depend on each other are made at once, up to LEX_CREATE_WORKERS of them: finding the
+    project folder and creating the project alongside finding the data folder and the documents in it, then setting
+    the configuration alongside adding the documents to the docset. Each step's time is logged.
+
+    created, if it is passed, is called with the project as soon as it exists, so a caller can clean it up if a
+    later call fails.
 
     Return the created project.
     """
-    project_folder = get_project_folder()
-    data_folder = get_data_folder()
-    lex_project = project_folder.create_project(name, auth=settings.LEX_AUTH)
+    server = server or get_servers()[0]
+    docs = doc if isinstance(doc, list) else [doc]
+    texts = text if isinstance(text, list) else [text] * len(docs)
+
+    def create_project(results):
+        folder = results['project_folder']
+        try:
+            project = folder.create_project(name, auth=server.auth)
+        except StandardError as err:
+            if not folder_gone(err, folder, server):
+                raise
+            # The cached folder has been removed or renamed on the server, look it up again.
+            logger.info('Creating project {0} failed, refreshing the project folder: {1}'.format(name, err))
+            server.project_folder_cache.invalidate()
+            project = server.project_folder_cache.get().create_project(name, auth=server.auth)
+        if created is not None:
+            created(project)
+        return project
+
+    def configure(results):
+        conf_href = '{0}{1}'.format(results['project'].href, '_/project-configuration')
+        lex.rest.rest_invoke(conf_href, method="POST", auth=server.auth, headers={"Content-Type": "text/xml", "X-HTTP-Method-Override": "PUT"}, body=settings.PROJECT_CONF_XML)
 
-    # Set some settings
-    conf_href = '{0}{1}'.format(lex_project.href, '_/project-configuration')
-    lex.rest.rest_invoke(conf_href, method="POST", auth=settings.LEX_AUTH, headers={"Content-Type": "text/xml", "X-HTTP-Method-Override": "PUT"}, body=settings.PROJECT_CONF_XML)
+    def find_document(doc):
+        def find(results):
+            folder = results['data_folder']
+            try:
+                return lex.LexObject.from_url(u'{0}/{1}'.format(folder.href, doc), auth=server.auth)
+            except StandardError as err:
+                if not folder_gone(err, folder, server):
+                    raise
+                logger.info('Finding document {0} failed, refreshing the data folder: {1}'.format(doc, err))
+                server.data_folder_cache.invalidate()
+                return lex.LexObject.from_url(u'{0}/{1}'.format(server.data_folder_cache.get().href, doc), auth=server.auth)
+        return find
 
+    def add_document(doc, text, found):
+        def add(results):
+            docset = results['project'].docset[0]
+            if text is not None:
+                upload_text(docset, doc, text, server)
+            else:
+                docset.create_file(doc, results[found], auth=server.auth, mimetype=mimetype)
+        return add
+
+    steps = [
+        ('project_folder', (), lambda results: server.project_folder_cache.get()),
+        ('project', ('project_folder',), create_project),
+        ('configuration', ('project',), configure),
+    ]
+    if any(text is None for text in texts):
+        steps.append(('data_folder', (), lambda results: server.data_folder_cache.get()))
     # Select the data
-    docset = lex_project.docset[0]
-    df = lex.LexObject.from_url(u'{0}/{1}'.format(data_folder.href, doc), auth=settings.LEX_AUTH)
-    docset.create_file(doc, df, auth=settings.LEX_AUTH, mimetype=mimetype)
-    run_project(lex_project.project_status[0])
+    added = []
+    for i, (doc, text) in enumerate(zip(docs, texts)):
+        needs = ('project',)
+        if text is None:
+            steps.append(('document_{0}'.format(i), ('data_folder',), find_document(doc)))
+            needs += ('document_{0}'.format(i),)
+        added.append('docset_file_{0}'.format(i))
+        steps.append((added[-1], needs, add_document(doc, text, 'document_{0}'.format(i))))
+    steps.append(('run', ('configuration',) + tuple(added),
+                  lambda results: run_project(results['project'].project_status[0], server)))
 
-    return lex_project
+    start = time.time()
+    results, timings = run_steps(steps, getattr(settings, 'LEX_CREATE_WORKERS', 4))
+    logger.info('Created project {0} in {1:.3f}s: {2}'.format(
+        name, time.time() - start, ', '.join('{0} {1:.3f}s'.format(step[0], timings[step[0]]) for step in steps)))
+    return results['project']
 
-def run_project(status):
+def run_project(status, server=None):
     """
     Run the project using the passed status object.
     """
+    server = server or server_for_url(status.href)
     stage = status.stage.get('name')
     state = status.stage.get('state')
     if state.lower() == 'next' and stage.lower() <> 'map':
         status.set_updatable_attrs('{0}:{1}'.format(stage, 'MAP'), 'active')
-        status.syncronize(auth=settings.LEX_AUTH)
-    return lex.project.ProjectStatus.from_url(status.href, auth=settings.LEX_AUTH)
+        status.syncronize(auth=server.auth)
+    return lex.project.ProjectStatus.from_url(status.href, auth=server.auth)
 
 def get_project_status(url):
     """
     Get the project status for the for the project at the passed URL.
     """
     try:
-        project = lex.LexObject.from_url(url, auth=settings.LEX_AUTH)
+        project = lex.LexObject.from_url(url, auth=server_for_url(url).auth)
         status = project.project_status[0]
         return status.stage.get("name"), status.stage.get('state'), status.message, project.href
     except StandardError:
@@ -133,68 +446,187 @@ def get_markers(markers_url, cookie):
     """
     Get the markers for the project at URL.
     """
-    resp, content = lex.rest.rest_invoke(markers_url , auth=settings.LEX_AUTH, headers={'Cookie':cookie})
+    resp, content = lex.rest.rest_invoke(markers_url , auth=server_for_url(markers_url).auth, headers={'Cookie':cookie})
     if resp.status == 200:
         return content
 
-def delete_project(url):
+def upload_text(docset, doc, text, server):
     """
-    Delete project at URL. Also delete the file.
+    Send text straight to a project's docset as the document doc, so no file is needed in TEXT_PATH.
     """
-    project = lex.LexObject.from_url(url, auth=settings.LEX_AUTH)
-    text_path = os.path.join(settings.TEXT_PATH, "{0}.txt".format(project.name))
+    body = text
+    if isinstance(body, unicode):
+        body = body.encode('ascii', 'ignore')
+    resp, content = lex.rest.rest_invoke(u'{0}/{1}'.format(docset.href, doc), method="POST", auth=server.auth,
+                                         headers={"Content-Type": "text/plain", "X-HTTP-Method-Override": "PUT"}, body=body)
+    if resp.status not in (200, 201, 204):
+        raise ResourceError('Uploading {0} failed with status {1}'.format(doc, resp.status))
+
+def save_text(name, text):
+    """
+    Write text to a file in TEXT_PATH for Leximancer to read.
+
+    Returns the document name.
+    """
+    # Really shouldn't need to do this but oh well.
+    doc = "{0}.txt".format(name)
+    text_path = os.path.join(settings.TEXT_PATH, doc)
+    if not os.path.exists(os.path.dirname(text_path)):
+        os.makedirs(os.path.dirname(text_path))
+    destination = open(text_path, 'wb+')
+    out = text
+    if isinstance(out, unicode):
+        out = out.encode('ascii', 'ignore')
+    destination.write(out)
+    destination.close()
+    return doc
+
+def read_text(doc):
+    """
+    Read a document written by save_text or corpus.sample_upload.
+
+    Returns the text as a byte string.
+    """
+    with open(os.path.join(settings.TEXT_PATH, doc), 'rb') as f:
+        return f.read()
+
+def remove_text(doc):
+    """
+    Remove a document written by save_text.
+    """
+    text_path = os.path.join(settings.TEXT_PATH, doc)
     if os.path.exists(text_path):
         os.remove(text_path)
-    lex.rest_invoke(url, method='DELETE', auth=settings.LEX_AUTH)
+
+# Names save_text gives documents: a result key followed by a hex timestamp, and a part number for the files a
+# large document is split into. Samples being written have temporary names until their job is queued.
+DOC_RE = re.compile(r'^([0-9a-f]{41,}(-[0-9]+)?\.txt|\.sample\w+\.part)$')
+
+def sweep_text(max_age, keep=()):
+    """
+    Remove documents written by save_text that haven't changed in max_age seconds, other than the ones named in
+    keep. These are left behind when a job fails before its project can be deleted.
+
+    Returns a tuple of the number of files removed and the bytes reclaimed.
+    """
+    removed = reclaimed = 0
+    cutoff = time.time() - max_age
+    try:
+        names = os.listdir(settings.TEXT_PATH)
+    except OSError:
+        return removed, reclaimed
+    for name in names:
+        if not DOC_RE.match(name) or name in keep:
+            continue
+        text_path = os.path.join(settings.TEXT_PATH, name)
+        try:
+            stat = os.stat(text_path)
+            if stat.st_mtime >= cutoff:
+                continue
+            os.remove(text_path)
+        except OSError:
+            continue
+        removed += 1
+        reclaimed += stat.st_size
+    return removed, reclaimed
+
+def delete_project(url, keep_text=False):
+    """
+    Delete project at URL. Also delete its file in TEXT_PATH, unless keep_text is true: its text was sent straight
+    to the docset, or the project is about to be created again.
+    """
+    auth = server_for_url(url).auth
+    if not keep_text:
+        project = lex.LexObject.from_url(url, auth=auth)
+        remove_text("{0}.txt".format(project.name))
+    lex.rest_invoke(url, method='DELETE', auth=auth)
 
 def get_concepts(markers_xml):
     """
     Convert the markers XML file to JSON.
+
+    The XML is parsed in a single streaming pass. Elements are read when they start and each concept, theme
+    and edge is thrown away when it ends, so memory stays flat no matter how many concepts there are.
     """
     num_blocks = None
     entities = {}
     themes = {}
     prominence = []
-    markers = lxml.etree.fromstring(markers_xml)
 
-    for marker in markers:
-        if marker.tag == 'markers':
-            num_blocks = marker.attrib['cbcount']
-            for entity in marker:
+    # Depth of the current element (the root is 1) and the top level section it is in
+    depth = 0
+    section = None
+    # Working state for the section being parsed
+    e = None
+    related = None
+    mst_edges = None
+    child = 0
+
+    for event, elem in etree.iterparse(BytesIO(markers_xml), events=('start', 'end')):
+        if event == 'end':
+            if depth == 3 or (depth == 4 and section == 'prominence'):
+                # Attributes were read on start, so drop the element and everything before it
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+            depth -= 1
+            continue
+
+        depth += 1
+        if depth == 2:
+            section = elem.tag
+            child = 0
+            if section == 'markers':
+                num_blocks = elem.get('cbcount')
+        elif section == 'markers':
+            attrib = elem.attrib
+            if depth == 5:
+                related.append({
+                    'id': attrib['id'],
+                    'strength': attrib['str'],
+                    'count': attrib['ct'],
+                    'prom': attrib['pr']
+                })
+            elif depth == 4:
+                related = e['related'] = []
+            elif depth == 3:
+                entity_id = int(attrib['id'])
                 e = {
-                    'id': int(entity.attrib['id']),
-                    'weight': float(entity.attrib['ctv']),
-                    'frequency': int(entity.attrib['freq']),
+                    'id': entity_id,
+                    'weight': float(attrib['ctv']),
+                    'frequency': int(attrib['freq']),
                     'mstEdges': [],
-                    'value': entity.attrib['value'],
-                    'kind': entity.attrib['kind'],
-                    'x': float(entity.attrib['x']),
-                    'y': float(entity.attrib['y'])
+                    'value': attrib['value'],
+                    'kind': attrib['kind'],
+                    'x': float(attrib['x']),
+                    'y': float(attrib['y'])
                 }
-                if 'tid' in entity.attrib.keys():
-                    e['themeId'] = entity.attrib['tid']
-                entities[int(entity.attrib['id'])] = e
-                for rels in entity:
-                    related = []
-                    for rel in rels:
-                        related.append({
-                            'id': rel.attrib['id'],
-                            'strength': rel.attrib['str'],
-                            'count': rel.attrib['ct'],
-                            'prom': rel.attrib['pr']
-                        })
-                    entities[int(entity.attrib['id'])]['related'] = related
-        if marker.tag == 'themes':
-            for theme in marker:
-                themes[int(theme.attrib['index'])] = {'id': int(theme.attrib['index']), 'name': theme.attrib['name'], 'hue': theme.attrib['hue'], "connectivity": theme.attrib['connectiv']}
-        if marker.tag == 'mst':
-            for node in marker:
-                for edge in node[0]:
-                    entities[int(node.attrib['id'])]['mstEdges'].append({'to': int(edge.attrib['id'])})
-        if marker.tag == 'prominence':
-            for node in marker[0]:
-                if node.tag == 'edge':
-                    prominence.append({'from': int(node.attrib['from']), 'to': int(node.attrib['to']), 'weight': float(node.attrib['w'])})
+                tid = attrib.get('tid')
+                if tid is not None:
+                    e['themeId'] = tid
+                entities[entity_id] = e
+        elif section == 'themes':
+            if depth == 3:
+                attrib = elem.attrib
+                index = int(attrib['index'])
+                themes[index] = {'id': index, 'name': attrib['name'], 'hue': attrib['hue'], "connectivity": attrib['connectiv']}
+        elif section == 'mst':
+            if depth == 5:
+                # Only the first child of a node holds its edges
+                if child == 1:
+                    mst_edges.append({'to': int(elem.get('id'))})
+            elif depth == 4:
+                child += 1
+            elif depth == 3:
+                mst_edges = entities[int(elem.get('id'))]['mstEdges']
+                child = 0
+        elif section == 'prominence':
+            if depth == 4:
+                if child == 1 and elem.tag == 'edge':
+                    attrib = elem.attrib
+                    prominence.append({'from': int(attrib['from']), 'to': int(attrib['to']), 'weight': float(attrib['w'])})
+            elif depth == 3:
+                child += 1
     return entities, themes, prominence, num_blocks
 
 def update_map(project_url):
@@ -204,13 +636,14 @@ def update_map(project_url):
     """
     name = '@map1'
     copy_url = project_url + '_/cluster/markersets/default/copy'
+    auth = server_for_url(project_url).auth
     
     
-    resp, content = lex.rest.rest_invoke(copy_url , auth=settings.LEX_AUTH,  method="POST", params={'name' : name})
+    resp, content = lex.rest.rest_invoke(copy_url , auth=auth,  method="POST", params={'name' : name})
     map_url = resp['location']    
     cookie = resp['set-cookie']
     
     # Set theme size
-    lex.rest.rest_invoke(map_url + '/cluster' , auth=settings.LEX_AUTH,  method="POST", headers={'Cookie':cookie}, params={'themeonly' : True, 'themesize' : settings.PROJECT_THEME_SIZE})
+    lex.rest.rest_invoke(map_url + '/cluster' , auth=auth,  method="POST", headers={'Cookie':cookie}, params={'themeonly' : True, 'themesize' : settings.PROJECT_THEME_SIZE})
     
     return (map_url + '/map', cookie)
\ No newline at end of file
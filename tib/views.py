@@ -1,22 +1,25 @@
-import base64
 import hashlib
 import json
 import logging
-import os
 import smtplib
-import urllib
 import boto
 from django.conf import settings
 from django.core.mail import mail_admins
-from django.core.validators import URLValidator
-from django.core.exceptions import ValidationError
-from django.http import HttpResponse, HttpResponseServerError, HttpResponseBadRequest
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse, HttpResponseServerError, HttpResponseBadRequest, HttpResponseNotFound, Http404
 from django.shortcuts import redirect, render
+from django.views.decorators.csrf import csrf_exempt
 import time
-import httplib2
 
-from tib import html2text
-from tib import utils
+from tib import batch
+from tib import cache
+from tib import corpus
+from tib import inflight
+from tib import jobs
+from tib import payload
+from tib import serialize
+from tib import snapshots
+from tib import wikipedia
 from tib.forms import ContactForm, FeedbackForm
 
 logger = logging.getLogger('tib')
@@ -26,79 +29,252 @@ def result(request):
     This view accepts text and creates a leximancer project for that text.
     """
     if request.method == "POST":
+        # Turn away files that are too big before Django reads them in
+        if request.META.get('CONTENT_TYPE', '').startswith('multipart/form-data'):
+            if int(request.META.get('CONTENT_LENGTH') or 0) > corpus.get_config()['MAX_UPLOAD_BYTES'] + 64 * 1024:
+                return render(request, 'create.html', {'file_size_error': True})
+        if 'text_file' in request.FILES:
+            return large_result(request, request.FILES['text_file'])
+
         text = None
         if 'text_content' in request.POST:
             # User has submitted their text
             text = request.POST['text_content']
-            if len(text) < 5000 or len(text) > 105000:
+            if not jobs.text_length_ok(text):
                 return render(request, 'create.html', {'text_error': True})
         else:
             # Wikipedia link
-            url = request.POST['wiki_url']
-            url = url.replace('https://', 'http://')
-            if not url.startswith('http://'):
-                url = 'http://' + url
-
-             # Validate URL
-            val = URLValidator(verify_exists=False)
             try:
-                val(url)
-            except ValidationError, e:
+                url = wikipedia.article_url(request.POST['wiki_url'])
+            except wikipedia.NotAnArticle:
                 return render(request, 'create.html', {'wiki_error': True})
 
-            if 'wikipedia.org/wiki/' in url:
-                resp, content = httplib2.Http().request(url, headers={'User-Agent':'textisbeautiful.net/1.0'})
-                text = html2text.html2text(content.decode('utf-8', errors='ignore'))
-            else:
-                return render(request, 'create.html', {'wiki_error': True})
+            # Concurrent submissions of the same article share one fetch
+            try:
+                text, shared = inflight.flight.do('wiki:{0}'.format(url), wikipedia.fetch_text, url, jobs.MAX_TEXT_LENGTH)
+            except wikipedia.TextTooLong:
+                return render(request, 'create.html', {'wiki_size_error': True})
+            except wikipedia.FetchError as err:
+                logger.warning(err.msg)
+                return render(request, 'create.html', {'wiki_fetch_error': True})
+            if not jobs.text_length_ok(text):
+                return render(request, 'create.html', {'wiki_size_error': True})
+
+        # Have we already visualised this text?
+        key = cache.result_key(text)
+        if cache.get_result(key) is not None:
+            return render(request, "result.html", {"id": key})
 
-        # Unique ID for this search uses current time and the text
-        id = hashlib.md5('{0}:{1}'.format(time.time(), text.encode('utf8'))).hexdigest()
-        # Write the text to a file (really shouldn't need to do this but oh well).
-        doc = "{0}.txt".format(id)
-        text_path = os.path.join(settings.TEXT_PATH, doc)
-        if not os.path.exists(os.path.dirname(text_path)):
-            os.makedirs(os.path.dirname(text_path))
-        destination = open(text_path, 'wb+')
-        out = text
-        if isinstance(out, unicode):
-            out = out.encode('ascii', 'ignore')
-        destination.write(out)
-        destination.close()
-        # Create the project
-        proj_url = utils.create_lex_project(id, doc).href
-        run_id = urllib.quote(base64.urlsafe_b64encode(proj_url))
+        # Queue the Leximancer run, joining an identical one if it is already queued or running
+        try:
+            run_id = jobs.submit(key, text, client_ip(request))
+        except jobs.QueueFull as err:
+            response = HttpResponse("We're very busy right now, please try again in a minute or two.", status=503)
+            response['Retry-After'] = str(err.retry_after)
+            return response
         return render(request, "result.html", {"id": run_id})
     else:
         return HttpResponseBadRequest("We only accept POST.")
 
-def status(request, id):
+def large_result(request, upload):
     """
-    This view reports on the status of a running leximancer project. The id is actually the Leximancer URL base64 encoded.
+    Create a leximancer project for a large document uploaded as a file, sampling it down if it is too long. The
+    file is read a chunk at a time so its size doesn't matter.
     """
-    url = base64.urlsafe_b64decode(id.encode('ascii'))
+    try:
+        sample = corpus.sample_upload(upload)
+    except corpus.UploadError as err:
+        logger.info(err.msg)
+        return render(request, 'create.html', {'file_size_error': True})
+    if sample.kept_chars < jobs.MIN_TEXT_LENGTH:
+        sample.discard()
+        return render(request, 'create.html', {'file_size_error': True})
+    sampling = sample.describe()
+    logger.info(u'{0}: {1}'.format(upload.name, sampling))
 
+    if cache.get_result(sample.key) is not None:
+        sample.discard()
+        return render(request, "result.html", {"id": sample.key, "sampling": sampling})
     try:
-        result = utils.get_project_status(url)
-    except utils.ResourceError:
-        return HttpResponseServerError("There was a problem with your query, please try again (ERR: Could\'t fetch project).")
-
-    if not result:
-        return HttpResponse(json.dumps({"message": 'Creating Leximancer project...', 'progress': 0, 'completed': False}), content_type='text/json')
-    elif result[0] == 'MAP':
-        project_url = result[3]
-        (markers_url, markers_cookie) = utils.update_map(project_url)
-        concepts, themes, prominence, num_blocks = utils.get_concepts(utils.get_markers(markers_url, markers_cookie))
-        # We don't want tp keep projects around.
-        utils.delete_project(url)
-        return HttpResponse(json.dumps({"message": 'Here come the visualisations...', 'completed': True, 'progress': 100,
-                                        'markers': {"concepts": concepts, "themes": themes, "iprom": prominence, "numBlocks" : num_blocks}})
-                            , content_type='text/json')
+        run_id = jobs.submit_sample(sample, client_ip(request))
+    except jobs.QueueFull as err:
+        response = HttpResponse("We're very busy right now, please try again in a minute or two.", status=503)
+        response['Retry-After'] = str(err.retry_after)
+        return response
+    return render(request, "result.html", {"id": run_id, "sampling": sampling})
+
+def client_ip(request):
+    """
+    Get the IP address of the client that made the request. nginx appends the address it saw to X-Forwarded-For.
+    """
+    forwarded = request.META.get('HTTP_X_FORWARDED_FOR')
+    if forwarded:
+        return forwarded.split(',')[-1].strip()
+    return request.META.get('REMOTE_ADDR')
+
+def status(request, id):
+    """
+    This view reports on the status of a queued leximancer job. The id is the job id, or a result key for a cached
+    visualisation. Identical submissions share the same id.
+
+    The Leximancer project is driven by the job workers, this view only reads the state they record. The markers
+    are sent in the compact encoding if the client asks for it (see tib.payload).
+    """
+    response, token = job_status(id, payload.wants_compact(request))
+    return payload.compress_response(request, response)
+
+def status_wait(request, id):
+    """
+    Long-poll version of the status view. Holds the request open until the job's progress differs from the token
+    passed as ?since= (the token from the last response) or STATUS_WAIT_TIMEOUT seconds pass, so the browser hears
+    about stage changes as the job workers record them without polling.
+    """
+    since = request.GET.get('since')
+    compact = payload.wants_compact(request)
+    deadline = time.time() + getattr(settings, 'STATUS_WAIT_TIMEOUT', 25)
+    while True:
+        response, token = job_status(id, compact)
+        if token is None or token != since or time.time() >= deadline:
+            return payload.compress_response(request, response)
+        time.sleep(getattr(settings, 'STATUS_WAIT_INTERVAL', 0.5))
+
+def job_status(id, compact=False):
+    """
+    Build the status response for a job, with the markers in the compact encoding if compact is true.
+
+    Returns a tuple of the response and a token identifying the job's progress, or None if the job is finished.
+    """
+    if cache.is_result_key(id):
+        key = id
+        markers = cache.get_result(id)
     else:
-        if result[1] == 'error':
-            return HttpResponseServerError("Leximancer project failed to run - {0}".format(result[2]))
+        job = jobs.get_store().get(id)
+        if job is None:
+            return HttpResponseServerError("There was a problem with your query, please try again (ERR: Could\'t find job)."), None
+        elif job['state'] == jobs.FAILED:
+            return HttpResponseServerError("Leximancer project failed to run - {0}".format(job['message'])), None
+        elif job['state'] in jobs.ACTIVE_STATES:
+            position = None
+            if job['state'] == jobs.QUEUED:
+                position = jobs.get_store().queue_position(job)
+                if position > 1:
+                    message = 'Waiting for Leximancer, you are number {0} in the queue...'.format(position)
+                else:
+                    message = 'Creating Leximancer project...'
+            elif job['stage'] is None:
+                message = job['message']
+            else:
+                message = "Running stage {0}: {1}".format(job['stage'], job['message'])
+            token = hashlib.md5(u'{0}:{1}'.format(job['state'], message).encode('utf8')).hexdigest()
+            return HttpResponse(serialize.dumps({"message": message, 'progress': job['progress'], 'completed': False, 'token': token,
+                                            'queuePosition': position}), content_type='text/json'), token
+        key = job['key']
+        markers = cache.get_result(key)
+
+    if markers is None:
+        return HttpResponseServerError("Your visualisation has expired, please submit your text again."), None
+    # Results cached before the cloud layout and the wheels' graphs were worked out on the server get them from
+    # the job workers, the browser works them out itself meanwhile
+    jobs.request_backfill(key, markers)
+    store = snapshots.get_store()
+    permalink = reverse('permalink', args=[key]) if store is not None and store.exists(key) else None
+    # Streamed, the markers are encoded a concept at a time as the response is sent, or in the compact encoding
+    # sent as it was cached when the job finished
+    markers = payload.cached_markers(key, markers, compact)
+    return HttpResponse(serialize.iterencode({"message": 'Here come the visualisations...', 'completed': True,
+                                              'progress': 100, 'markers': markers, 'permalink': permalink}, compact),
+                        content_type='text/json'), None
+
+def permalink(request, key):
+    """
+    This view shows a saved visualisation, drawn from its snapshot rather than a job.
+    """
+    store = snapshots.get_store()
+    if store is None or not store.exists(key):
+        raise Http404
+    return render(request, "result.html", {"id": key, "snapshot": True})
+
+def snapshot(request, key):
+    """
+    This view serves a saved visualisation's markers straight from the snapshot store, gzipped as they were saved
+    unless the client can't take it. Result keys address their content so the response can be cached for a long
+    time, and revalidated by ETag once it has been. The gzipped and plain bodies have ETags of their own.
+    """
+    store = snapshots.get_store()
+    if store is None:
+        raise Http404
+    gzipped = payload.accepts(request, 'gzip')
+    etag = '"{0}{1}"'.format(key, '-gzip' if gzipped else '')
+    # A revalidation is a view too, it keeps the snapshot from being evicted
+    if etag in [tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')] and store.touch(key):
+        response = HttpResponse(status=304)
+    else:
+        body = store.get(key)
+        if body is None:
+            raise Http404
+        if gzipped:
+            response = HttpResponse(body, content_type='text/json')
+            response['Content-Encoding'] = 'gzip'
         else:
-            return HttpResponse(json.dumps({"message": "Running stage {0}: {1}".format(result[0], result[2]), 'progress': utils.STATUS_MAP[result[0]], 'completed': False}), content_type='text/json')
+            response = HttpResponse(snapshots.decompress(body), content_type='text/json')
+        response['Content-Length'] = str(len(response.content))
+    response['ETag'] = etag
+    response['Cache-Control'] = 'public, max-age={0}'.format(snapshots.get_config()['CACHE_SECONDS'])
+    response['Vary'] = 'Accept-Encoding'
+    return response
+
+@csrf_exempt
+def batch_submit(request):
+    """
+    This view accepts a JSON batch of texts and Wikipedia URLs, {"items": [{"text": ...}, {"url": ...}, ...]}, and
+    queues a leximancer project for each.
+
+    Responds with the batch id and, for each item, the id to follow it by or why it was turned away. Articles are
+    fetched by the job workers after the response is sent, their items are followed through the batch status.
+    """
+    if request.method != "POST":
+        return HttpResponseBadRequest("We only accept POST.")
+    try:
+        items = json.loads(request.body).get('items')
+    except (ValueError, AttributeError):
+        return HttpResponseBadRequest("The body must be a JSON object with a list of items.")
+    try:
+        id, results = batch.submit(items, client_ip(request))
+    except batch.BatchError as err:
+        return HttpResponseBadRequest(err.msg)
+    return HttpResponse(serialize.dumps({'id': id, 'items': results}), content_type='text/json')
+
+def batch_status(request, id):
+    """
+    This view reports on every item of a batch at once: the number in each state, the overall progress and each
+    item's progress.
+    """
+    status = batch.status(id)
+    if status is None:
+        return HttpResponseNotFound("Couldn't find batch.")
+    return HttpResponse(serialize.dumps(status), content_type='text/json')
+
+def batch_markers(request, id):
+    """
+    This view returns the markers of every finished item of a batch in one response, streamed an item at a time
+    so the whole batch is never held in memory. The markers are sent in the compact encoding if the client asks
+    for it.
+    """
+    results = batch.markers(id)
+    if results is None:
+        return HttpResponseNotFound("Couldn't find batch.")
+    compact = payload.wants_compact(request)
+
+    def generate():
+        yield '{{"id": {0}, "items": ['.format(serialize.dumps(id))
+        for i, (status, markers) in enumerate(results):
+            status['markers'] = None if markers is None else payload.encode_markers(markers, compact)
+            if i:
+                yield ', '
+            for chunk in serialize.iterencode(status, compact):
+                yield chunk
+        yield ']}'
+    return payload.compress_response(request, HttpResponse(generate(), content_type='text/json'))
 
 def contact_email(request):
     """
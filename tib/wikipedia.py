@@ -0,0 +1,628 @@
+"""
+Fetch Wikipedia pages and turn them into text.
+
+Most of a Wikipedia page's HTML isn't article text: navigation, sidebars, infoboxes, navboxes, reference lists
+and footers. extract_article keeps only the article body so html2text parses a fraction of the bytes and
+Leximancer only sees the prose.
+
+Pages are streamed into the extractor as they arrive, within a byte cap and a deadline, and converted pages are
+kept in an on-disk PageCache so popular articles aren't downloaded and converted again for every submission.
+"""
+import hashlib
+import httplib
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
+from lxml import etree
+from tib import html2text
+from tib import httppool
+
+logger = logging.getLogger('tib')
+
+USER_AGENT = 'textisbeautiful.net/1.0'
+
+DEFAULTS = {
+    # Directory the page cache is kept in, None turns the cache off
+    'PATH': '/var/tib/wiki',
+    # Most bytes the cached pages may take up, the least recently used are removed past this
+    'MAX_BYTES': 200 * 1024 * 1024,
+    # Seconds a cached page is used without asking Wikipedia whether it has changed
+    'MAX_AGE': 60 * 60,
+    # Writes between scans of the directory, which also catch pages other processes have added
+    'EVICT_EVERY': 100,
+}
+
+FETCH_DEFAULTS = {
+    # Most bytes of HTML read for one page
+    'MAX_BYTES': 5 * 1024 * 1024,
+    # Socket timeout, and the most seconds the whole fetch may take
+    'TIMEOUT': 10,
+    'DEADLINE': 20,
+    # Bytes read from the socket at a time and fed to the parser
+    'CHUNK_SIZE': 16 * 1024,
+    'MAX_REDIRECTS': 5,
+}
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+# Fewest bytes handed to the HTML parser at once
+MIN_FEED_SIZE = 4096
+
+# Bytes of an already downloaded page parsed at a time by extract_article
+EXTRACT_CHUNK_SIZE = 64 * 1024
+
+# Most bytes left after the article that are read to keep the connection, past this it is closed instead
+DRAIN_BYTES = 64 * 1024
+
+class FetchError(Exception):
+    """
+    Exception thrown when a Wikipedia page can't be fetched or is too big.
+
+    Attributes:
+        msg -- explanation of the error.
+    """
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return repr(self.msg)
+
+class TextTooLong(FetchError):
+    """
+    Exception thrown when an article has more text than was asked for.
+    """
+
+class NotAnArticle(FetchError):
+    """
+    Exception thrown when a submitted URL isn't a Wikipedia article.
+    """
+
+# id of the element MediaWiki puts the article body in
+CONTENT_ID = 'mw-content-text'
+
+# Elements with any of these classes are dropped from the article along with everything inside them
+BOILERPLATE_CLASSES = frozenset([
+    'ambox', 'authority-control', 'catlinks', 'gallery', 'hatnote', 'infobox', 'metadata', 'mw-cite-backlink',
+    'mw-editsection', 'mw-empty-elt', 'mw-references-wrap', 'navbox', 'navbox-styles', 'noprint', 'portalbox',
+    'printfooter', 'refbegin', 'reference', 'references', 'reflist', 'shortdescription', 'side-box', 'sidebar',
+    'sistersitebox', 'thumb', 'toc', 'vertical-navbox',
+])
+
+# Elements that never hold article text
+BOILERPLATE_TAGS = frozenset(['figure', 'noscript', 'script', 'style'])
+
+# Sections at the end of an article that list sources and links rather than say anything
+TRAILING_SECTIONS = frozenset([
+    'bibliography', 'citations', 'external links', 'footnotes', 'further reading', 'notes', 'notes and references',
+    'references', 'see also', 'sources', 'works cited',
+])
+
+def classes(elem):
+    """
+    Get the set of classes on an element.
+    """
+    return frozenset(elem.get('class', '').split())
+
+def is_boilerplate(elem):
+    """
+    Return true if the element is navigation, an infobox, a reference list or anything else that isn't prose.
+    """
+    return elem.tag in BOILERPLATE_TAGS or elem.get('id') == 'toc' or not BOILERPLATE_CLASSES.isdisjoint(classes(elem))
+
+def drop(elem):
+    """
+    Remove an element and everything in it, keeping the text that follows it.
+    """
+    parent = elem.getparent()
+    if elem.tail:
+        previous = elem.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or '') + elem.tail
+        else:
+            parent.text = (parent.text or '') + elem.tail
+    parent.remove(elem)
+
+def is_section_heading(elem):
+    """
+    Return true if the element is a top level section heading, either a bare h2 or the div newer MediaWiki
+    versions wrap it in.
+    """
+    return elem.tag == 'h2' or 'mw-heading2' in classes(elem)
+
+def drop_trailing_sections(content):
+    """
+    Remove the References, External links, See also... sections from the article.
+    """
+    for heading in list(content.iter('h2')):
+        block = heading.getparent()
+        if not is_section_heading(block):
+            block = heading
+        parent = block.getparent()
+        # Skip headings inside a section that has already gone
+        if parent is None or content not in block.iterancestors():
+            continue
+        title = u' '.join(u''.join(heading.itertext()).split()).lower()
+        if title not in TRAILING_SECTIONS:
+            continue
+        sibling = block.getnext()
+        while sibling is not None and not is_section_heading(sibling):
+            following = sibling.getnext()
+            parent.remove(sibling)
+            sibling = following
+        parent.remove(block)
+
+class ArticleExtractor(object):
+    """
+    Streaming article extraction. Feed it the page's raw (UTF-8) HTML as it arrives and close it at the end.
+
+    Everything before the article body is thrown away as soon as it has been parsed and boilerplate inside the
+    body is dropped when its parent ends. Once the body has ended done is set and the rest of the page needn't be fed (or
+    downloaded). text_length keeps a running count of the article's text so far, whitespace collapsed, leaving out the
+    sections drop_trailing_sections removes.
+    """
+    def __init__(self):
+        self.parser = etree.HTMLPullParser(events=('start', 'end'), encoding='utf-8', remove_comments=True,
+                                           remove_pis=True)
+        self.article = None
+        self.done = False
+        self.text_length = 0
+        # True after the heading of a section that is dropped at the end, until the next section heading
+        self.trailing = False
+        # How deep inside boilerplate the parser is
+        self.skipping = 0
+        # Data not given to the parser yet, and how many bytes of it there are
+        self.pending = []
+        self.pending_size = 0
+
+    def feed(self, data):
+        if self.done:
+            return
+        # libxml2's push parser can lose its place, or worse, when it is fed a few bytes at a time
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= MIN_FEED_SIZE:
+            self.flush()
+
+    def flush(self):
+        data = ''.join(self.pending)
+        self.pending = []
+        self.pending_size = 0
+        if data:
+            self.parser.feed(data)
+            self.read_events()
+
+    def read_events(self):
+        for event, elem in self.parser.read_events():
+            if event == 'start':
+                if self.article is None:
+                    if elem.get('id') == CONTENT_ID:
+                        self.article = elem
+                elif self.skipping or is_boilerplate(elem):
+                    self.skipping += 1
+            elif self.article is None:
+                # Not in the article yet, nothing here is needed. The tail may still be being parsed so only what
+                # has been finished with goes: the element's content and the siblings before it.
+                elem.text = None
+                del elem[:]
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+            elif self.skipping:
+                self.skipping -= 1
+            else:
+                # The children's tails are complete now this element has ended, so boilerplate children can be
+                # dropped without losing the text after them
+                for child in list(elem):
+                    if is_boilerplate(child):
+                        drop(child)
+                if elem.tag == 'h2':
+                    title = u' '.join(u''.join(elem.itertext()).split()).lower()
+                    self.trailing = title in TRAILING_SECTIONS
+                if not self.trailing:
+                    pieces = [elem.text or u''] + [child.tail or u'' for child in elem]
+                    self.text_length += len(u' '.join(u' '.join(pieces).split()))
+                if elem is self.article:
+                    self.done = True
+                    break
+
+    def close(self):
+        """
+        Finish parsing. Returns the article as an HTML unicode string, or None if the page has no article body.
+        """
+        if not self.done:
+            try:
+                self.flush()
+                self.parser.close()
+            except etree.LxmlError:
+                return None
+            self.read_events()
+        if self.article is None:
+            return None
+        drop_trailing_sections(self.article)
+        self.article.tail = None
+        return etree.tostring(self.article, method='html', encoding=unicode)
+
+def extract_article(content):
+    """
+    Get the article body out of the raw (UTF-8) HTML of a Wikipedia page, parsed in a single streaming pass that
+    stops at the end of the body so the footer and navigation are never parsed.
+
+    Returns the article as an HTML unicode string, or None if the page has no article body.
+    """
+    extractor = ArticleExtractor()
+    try:
+        for start in xrange(0, len(content), EXTRACT_CHUNK_SIZE):
+            extractor.feed(content[start:start + EXTRACT_CHUNK_SIZE])
+            if extractor.done:
+                break
+    except etree.LxmlError:
+        return None
+    return extractor.close()
+
+def to_text(html, mode='plain'):
+    """
+    Convert HTML to text. mode is 'plain' to keep just the text and paragraph breaks or 'markdown' for the full
+    html2text conversion.
+    """
+    if mode == 'markdown':
+        return html2text.html2text(html)
+    return html2text.html2plain(html)
+
+def convert(content, mode='plain'):
+    """
+    Convert the raw (UTF-8) HTML of a Wikipedia page to text, see to_text for the modes.
+
+    Only the article is converted, unless the page doesn't look like a Wikipedia article.
+    """
+    html = extract_article(content)
+    if html is None:
+        html = content.decode('utf-8', errors='ignore')
+    return to_text(html, mode)
+
+def article_url(url):
+    """
+    Tidy a submitted article URL, adding the scheme if it is missing and fetching over http.
+
+    Returns the URL. Raises NotAnArticle if it isn't a valid Wikipedia article URL.
+    """
+    url = url.strip().replace('https://', 'http://')
+    if not url.startswith('http://'):
+        url = 'http://' + url
+    try:
+        URLValidator(verify_exists=False)(url)
+    except ValidationError:
+        raise NotAnArticle(u'{0} is not a valid URL.'.format(url))
+    if 'wikipedia.org/wiki/' not in url:
+        raise NotAnArticle(u'{0} is not a Wikipedia article.'.format(url))
+    return url
+
+def normalise_url(url):
+    """
+    Normalise an article URL so the different ways of writing it share a cache entry.
+
+    The host is lower cased and the mobile site mapped to the desktop one, the query and fragment are dropped, and
+    the title is quoted the way Wikipedia does with spaces as underscores.
+    """
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    scheme, host, path = urlparse.urlsplit(url)[:3]
+    host = host.lower().replace('.m.wikipedia.org', '.wikipedia.org')
+    path = urllib.quote(urllib.unquote(path).replace(' ', '_'), safe="/:@!$&'()*+,;=-._~")
+    return urlparse.urlunsplit((scheme.lower(), host, path, '', ''))
+
+def page_key(url, mode):
+    """
+    Get the cache key for the text of the page at the normalised URL converted with mode.
+    """
+    return hashlib.sha1('{0}\0{1}'.format(url, mode)).hexdigest()
+
+class PageCache(object):
+    """
+    Size bounded on-disk cache of converted Wikipedia pages, one JSON file per page.
+
+    Each entry holds the page's text and the ETag and Last-Modified validators it was served with. A file's mtime
+    is bumped every time it is read, so eviction removes the least recently used pages first. Files are written
+    to a temporary name and renamed into place, so any number of processes can share the directory.
+
+    The directory is only scanned for eviction every evict_every writes, or sooner once the bytes this process
+    has written since the last scan take the cache past max_bytes.
+
+    path -- directory the entries are kept in.
+    max_bytes -- most bytes the entries may take up.
+    max_age -- seconds an entry is used without revalidating it.
+    evict_every -- most writes between scans.
+    """
+    def __init__(self, path, max_bytes, max_age, evict_every=100):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.evict_every = evict_every
+        # Bytes in the cache as of the last scan plus those written since, None until the first scan
+        self._bytes = None
+        self._writes = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def get(self, key):
+        """
+        Get the entry for key, or None if there isn't one.
+        """
+        name = self._file(key)
+        try:
+            with open(name, 'rb') as entry_file:
+                entry = json.load(entry_file)
+            os.utime(name, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return entry
+
+    def set(self, key, entry):
+        """
+        Store the entry for key, then evict pages if the cache may have grown past max_bytes.
+        """
+        name = self._file(key)
+        fd, temp_name = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as entry_file:
+                json.dump(entry, entry_file)
+            size = os.path.getsize(temp_name)
+            try:
+                size -= os.path.getsize(name)
+            except OSError:
+                pass
+            os.rename(temp_name, name)
+        except (IOError, OSError):
+            logger.exception('Could not cache {0}'.format(entry.get('url')))
+            try:
+                os.remove(temp_name)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            self._writes += 1
+            if self._bytes is not None:
+                self._bytes += size
+            due = self._bytes is None or self._bytes > self.max_bytes or self._writes >= self.evict_every
+        if due:
+            self.evict()
+
+    def evict(self):
+        """
+        Scan the directory and remove the least recently used entries until the cache is back under 90% of
+        max_bytes.
+
+        Returns a tuple of the number of entries removed and the bytes they took up.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+        if total <= self.max_bytes:
+            self._scanned(total)
+            return 0, 0
+
+        removed = reclaimed = 0
+        entries.sort()
+        for mtime, size, name in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                # Another process got to it first
+                pass
+            else:
+                removed += 1
+                reclaimed += size
+            total -= size
+        self._scanned(total)
+        return removed, reclaimed
+
+    def _scanned(self, total):
+        with self._lock:
+            self._bytes = total
+            self._writes = 0
+
+_page_cache = None
+_page_cache_lock = threading.Lock()
+
+def get_page_cache():
+    """
+    Get the page cache configured by settings.WIKI_CACHE, or None if it is turned off.
+    """
+    global _page_cache
+    with _page_cache_lock:
+        if _page_cache is None:
+            conf = dict(DEFAULTS)
+            conf.update(getattr(settings, 'WIKI_CACHE', {}))
+            if not conf['PATH']:
+                return None
+            _page_cache = PageCache(conf['PATH'], conf['MAX_BYTES'], conf['MAX_AGE'], conf['EVICT_EVERY'])
+        return _page_cache
+
+def get_fetch_config():
+    """
+    Get the fetch settings, settings.WIKI_FETCH overrides FETCH_DEFAULTS.
+    """
+    conf = dict(FETCH_DEFAULTS)
+    conf.update(getattr(settings, 'WIKI_FETCH', {}))
+    return conf
+
+def open_page(url, headers, conf, deadline):
+    """
+    Send a GET for URL, following redirects, on a keep-alive connection from the streaming connection pool (see
+    httppool.ConnectionPool).
+
+    Returns a tuple of the connection and the response, whose body hasn't been read yet. Give the connection back
+    with httppool.get_connection_pool().put once done with the response.
+    """
+    pool = httppool.get_connection_pool()
+    for redirect in xrange(conf['MAX_REDIRECTS'] + 1):
+        scheme, host, path, query = urlparse.urlsplit(url)[:4]
+        if scheme not in ('http', 'https'):
+            raise FetchError('Can\'t fetch {0}.'.format(url))
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise FetchError('Timed out fetching {0}.'.format(url))
+        timeout = min(conf['TIMEOUT'], remaining)
+        conn, reused = pool.get(scheme, host, timeout)
+        try:
+            try:
+                conn.request('GET', '{0}?{1}'.format(path, query) if query else path, headers=headers)
+                resp = conn.getresponse()
+            except (socket.error, httplib.HTTPException):
+                if not reused:
+                    raise
+                # Wikipedia closed the idle connection, try again on a new one
+                conn.close()
+                conn, reused = pool.get(scheme, host, timeout, reuse=False)
+                conn.request('GET', '{0}?{1}'.format(path, query) if query else path, headers=headers)
+                resp = conn.getresponse()
+        except (socket.error, httplib.HTTPException) as err:
+            conn.close()
+            raise FetchError('Couldn\'t fetch {0}: {1}'.format(url, err))
+        if resp.status not in REDIRECT_STATUSES or not resp.getheader('location'):
+            return conn, resp
+        url = urlparse.urljoin(url, resp.getheader('location'))
+        try:
+            # Redirect bodies are tiny, reading them lets the connection be used again
+            resp.read()
+        except (socket.error, httplib.HTTPException):
+            pass
+        pool.put(conn, resp)
+    raise FetchError('Too many redirects fetching {0}.'.format(url))
+
+def read_page(conn, resp, conf, deadline, max_chars=None):
+    """
+    Stream the body of a page into an ArticleExtractor, CHUNK_SIZE bytes at a time, stopping once the article
+    has ended. If no more than DRAIN_BYTES of the page are left then they are read too, so the connection goes
+    back in the pool, otherwise it is closed.
+
+    Raises FetchError if the page is bigger than MAX_BYTES or takes past the deadline, and TextTooLong as soon as
+    the article has more than max_chars characters of text. Returns a tuple of the extractor and the page
+    received before the article started, which is only needed if it turns out there's no article.
+    """
+    extractor = ArticleExtractor()
+    head = []
+    received = 0
+    if resp.getheader('content-encoding') == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+        decompressor = None
+    # The response's own socket, taken now as the response lets go of it once the body has been read and the
+    # connection drops its reference when the server says it'll close
+    sock = resp.fp._sock
+    try:
+        while not extractor.done and not resp.isclosed():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise FetchError('Timed out fetching the page after {0}s.'.format(conf['DEADLINE']))
+            sock.settimeout(min(conf['TIMEOUT'], remaining))
+            chunk = resp.read(conf['CHUNK_SIZE'])
+            if not chunk:
+                break
+            if decompressor is not None:
+                chunk = decompressor.decompress(chunk)
+            received += len(chunk)
+            if received > conf['MAX_BYTES']:
+                raise FetchError('The page is bigger than {0} bytes.'.format(conf['MAX_BYTES']))
+            if extractor.article is None:
+                head.append(chunk)
+            elif head:
+                head = []
+            extractor.feed(chunk)
+            if max_chars is not None and extractor.text_length > max_chars:
+                raise TextTooLong('The article has more than {0} characters of text.'.format(max_chars))
+        drained = 0
+        while not resp.isclosed() and drained <= DRAIN_BYTES and time.time() < deadline:
+            sock.settimeout(min(conf['TIMEOUT'], deadline - time.time()))
+            chunk = resp.read(conf['CHUNK_SIZE'])
+            if not chunk:
+                break
+            drained += len(chunk)
+    except (socket.error, httplib.HTTPException, zlib.error) as err:
+        raise FetchError('Couldn\'t fetch the page: {0}'.format(err))
+    except etree.LxmlError as err:
+        raise FetchError('Couldn\'t parse the page: {0}'.format(err))
+    finally:
+        httppool.get_connection_pool().put(conn, resp)
+    return extractor, ''.join(head)
+
+def fetch_text(url, max_chars=None):
+    """
+    Get the text of the Wikipedia page at URL.
+
+    A page cached less than MAX_AGE seconds ago is used as is, with no request and no conversion. An older one is
+    revalidated with If-None-Match/If-Modified-Since and only downloaded and converted again if it has changed.
+    settings.WIKI_TEXT_MODE picks the conversion, see to_text.
+
+    Pages are streamed into the article extractor as they arrive, within the limits in settings.WIKI_FETCH.
+    Raises FetchError if the page can't be fetched and TextTooLong if the article has more than max_chars
+    characters of text, as soon as that is known.
+    """
+    mode = getattr(settings, 'WIKI_TEXT_MODE', 'plain')
+    conf = get_fetch_config()
+    deadline = time.time() + conf['DEADLINE']
+    url = normalise_url(url)
+    key = page_key(url, mode)
+    page_cache = get_page_cache()
+    entry = page_cache.get(key) if page_cache is not None else None
+
+    headers = {'User-Agent': USER_AGENT, 'Accept-Encoding': 'gzip'}
+    if entry is not None:
+        if time.time() - entry['fetched'] < page_cache.max_age:
+            return entry['text']
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    conn, resp = open_page(url, headers, conf, deadline)
+    if entry is not None and resp.status == 304:
+        try:
+            resp.read()
+        except (socket.error, httplib.HTTPException):
+            pass
+        httppool.get_connection_pool().put(conn, resp)
+        entry['fetched'] = time.time()
+        page_cache.set(key, entry)
+        return entry['text']
+    if resp.status != 200:
+        httppool.get_connection_pool().put(conn, resp)
+        raise FetchError('Wikipedia answered {0} {1}.'.format(resp.status, resp.reason))
+
+    extractor, head = read_page(conn, resp, conf, deadline, max_chars)
+    html = extractor.close()
+    if html is None:
+        # Not an article, use the whole page
+        html = head.decode('utf-8', errors='ignore')
+    text = to_text(html, mode)
+    if page_cache is not None:
+        page_cache.set(key, {
+            'url': url,
+            'etag': resp.getheader('etag'),
+            'last_modified': resp.getheader('last-modified'),
+            'fetched': time.time(),
+            'text': text,
+        })
+    return text